@@ -1,47 +1,66 @@
+import logging
 import os
+from functools import partial
+
 import flask
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-import time
-import threading
 
 from script import script
-from utils.api_utils import credentials_to_dict
+from scheduler import Scheduler
+from model.main_model import PREDICTION_WORKERS, start_prediction_pool
+from model.model_registry import warm_up
+from utils.credential_store import CredentialStore
+from utils.metrics import CONTENT_TYPE, render_metrics
 
 app = flask.Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
 CLIENT_SECRETS_FILE = os.getenv('CLIENT_SECRETS_FILE', 'auth/client_secret.json')
 SCOPES = ['https://www.googleapis.com/auth/calendar', 'https://www.googleapis.com/auth/gmail.readonly']
-SCRIPT_PERIOD = 30  # every 15 minutes
+SCRIPT_PERIOD = 30  # seconds between cycles of a mailbox, adapted to its mail rate by the scheduler
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 4))
+
+scheduler = Scheduler(max_workers=SCHEDULER_WORKERS, period=SCRIPT_PERIOD)
+credential_store = CredentialStore()
+logger = logging.getLogger(__name__)
+
+
+def run_script(account: str) -> int:
+    # the store refreshes tokens in the background, so every cycle starts with a valid one
+    creds = credential_store.get(account)
+    if creds is None:
+        logger.warning('No credentials for account %s', account)
+        scheduler.cancel(account)
+        return 0
+    logger.info('Script started')
+    result = script(creds)
+    logger.info('%s', result)
+    return result.letters
 
 
 @app.route('/')
 def index():
-    if 'credentials' not in flask.session:
+    if 'credentials' in flask.session:
+        # sessions created before the credential store kept the credentials themselves
+        flask.session['account'] = credential_store.save(Credentials(**flask.session.pop('credentials')))
+    account = flask.session.get('account')
+    credentials = credential_store.get(account) if account is not None else None
+    if credentials is None:
         return flask.redirect('authorize')
-    credentials = Credentials(**flask.session['credentials'])
-
-    @flask.copy_current_request_context
-    def run_script(creds):
-        while True:
-            start_time = time.time()
-            print('Script started')
-            log = script(creds)
-            flask.session['credentials'] = credentials_to_dict(creds)
-            print(log)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            sleep_time = SCRIPT_PERIOD - elapsed_time
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-
-    script_thread = threading.Thread(target=run_script, args=(credentials,))
-    script_thread.start()
+    # sessions created before accounts were keyed by their address move to the new key
+    account = flask.session['account'] = credential_store.save(credentials)
 
+    if not scheduler.schedule(account, partial(run_script, account)):
+        return 'Script is already running.'
     return 'Script started.'
 
 
+@app.route('/metrics')
+def metrics():
+    return flask.Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 @app.route('/authorize')
 def authorize():
     flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES)
@@ -58,12 +77,20 @@ def oauth2callback():
     flow.redirect_uri = flask.url_for('oauth2callback', _external=True)
     authorization_response = flask.request.url
     flow.fetch_token(authorization_response=authorization_response)
-    credentials = flow.credentials
-    flask.session['credentials'] = credentials_to_dict(credentials)
+    flask.session['account'] = credential_store.save(flow.credentials)
 
     return flask.redirect(flask.url_for('index'))
 
 
 if __name__ == '__main__':
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    # the debug reloader runs this module again in a child process that serves the requests, while the first
+    # process only watches the files, so it must not load the model or start workers
+    if os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up()
+        # the pool forks its workers, so it starts before the refresh thread exists
+        if PREDICTION_WORKERS > 1:
+            start_prediction_pool()
+        credential_store.start()
     app.run('localhost', 8080, debug=True)
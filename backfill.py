@@ -0,0 +1,194 @@
+"""
+Finds the meetings in letters that arrived before the account was connected.
+
+Run from the repository root: python backfill.py --after 2024-01-01
+The progress is checkpointed after every page of messages, so running the same command again after an interruption
+continues where it stopped. Events are recorded in the calendar ledger, so a letter processed twice gets one event.
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date
+from functools import partial
+from typing import Any
+
+from google.oauth2.credentials import Credentials
+
+from gmail import GMAIL_BATCH_SIZE, GMAIL_PAGE_SIZE, fetch_raw_messages, list_message_page, parse_letters
+from google_calendar import add_events
+from model.main_model import letters_prediction
+from utils.api_utils import AppType, account_key, create_service
+from utils.metrics import BACKFILL_MESSAGES, EMAILS_PREDICTED, EMAILS_SKIPPED, STAGE_SECONDS
+from utils.storage import delete_backfill_checkpoint, get_backfill_checkpoint, save_backfill_checkpoint
+from utils.transport import TokenBucket
+
+# Live polling shares the per-user quota of 250 units a second, 50 messages at 5 units each,
+# so the default budget leaves it more than half
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 2))
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 20))  # messages per second
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BackfillConfig:
+    label: str | None = None  # None walks the whole mailbox
+    after: date | None = None
+    before: date | None = None
+    workers: int = BACKFILL_WORKERS
+    rate: float = BACKFILL_RATE
+    page_size: int = GMAIL_PAGE_SIZE
+    chunk_size: int = GMAIL_BATCH_SIZE
+
+    @property
+    def query(self) -> str | None:
+        terms = []
+        if self.after is not None:
+            terms.append(f"after:{self.after:%Y/%m/%d}")
+        if self.before is not None:
+            terms.append(f"before:{self.before:%Y/%m/%d}")
+        return ' '.join(terms) or None
+
+    @property
+    def scope(self) -> str:
+        # the checkpoint of one range never resumes a backfill of another
+        return f"{self.label or '*'} {self.query or ''}".strip()
+
+
+@dataclass
+class BackfillProgress:
+    processed: int = 0
+    events: int = 0
+    total: int = 0
+    done: bool = False
+    resumed_at: int = 0  # messages processed by earlier runs, which do not count towards the rate
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.processed - self.resumed_at) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """
+        Seconds left at the current rate; Gmail only estimates the total, so this is a rough guide.
+        """
+        if self.done:
+            return 0.0
+        if not self.rate:
+            return None
+        return max(self.total - self.processed, 0) / self.rate
+
+    def __str__(self) -> str:
+        total = max(self.total, self.processed)
+        percent = 100 * self.processed / total if total else 100.0
+        eta = 'unknown' if self.eta is None else f"{int(self.eta) // 60}m {int(self.eta) % 60:02d}s"
+        return (f"{self.processed}/{total} messages ({percent:.1f}%), {self.events} events, "
+                f"{self.rate:.1f} messages/s, ETA {eta}")
+
+
+def _process_chunk(creds: Credentials, limiter: TokenBucket,
+                   message_ids: list[str]) -> tuple[dict[str, dict[str, str]], dict[str, dict[str, Any]], list[str]]:
+    """
+    Fetches and predicts a chunk of messages; returns the letters, their predictions and the ids of the messages
+    that could not be downloaded.
+    """
+    limiter.acquire(len(message_ids))
+    # each worker thread gets its own cached service
+    gmail_service = create_service(creds, app=AppType.GMAIL)
+    raw_messages, failed_ids = fetch_raw_messages(gmail_service, message_ids)
+    letters = parse_letters(raw_messages)
+    with STAGE_SECONDS.time(stage='backfill_predict'):
+        predictions = letters_prediction(letters) if letters else {}
+    EMAILS_PREDICTED.inc(len(letters))
+    EMAILS_SKIPPED.inc(len(letters) - len(predictions))
+    return letters, predictions, failed_ids
+
+
+def run_backfill(creds: Credentials, config: BackfillConfig | None = None, restart: bool = False) -> BackfillProgress:
+    """
+    Walks the messages of `config.label` and date range page by page, newest first, and adds their events.
+
+    The messages of a page are fetched and predicted in chunks by `config.workers` threads, at most `config.rate`
+    messages a second, and the events of the page are written with batch requests. The next page token is
+    checkpointed once a page is done; `restart` drops the checkpoint and starts over. A page with a message that
+    could not be downloaded or an event that could not be written stops the run before its checkpoint, so the next
+    run does the page again.
+    """
+    config = config or BackfillConfig()
+    account = account_key(creds)
+    if restart:
+        delete_backfill_checkpoint(account, config.scope)
+
+    page_token = None
+    progress = BackfillProgress()
+    checkpoint = get_backfill_checkpoint(account, config.scope)
+    if checkpoint is not None:
+        page_token, progress.processed, progress.events, progress.total, progress.done = checkpoint
+        progress.resumed_at = progress.processed
+        if progress.done:
+            logger.info("Backfill of %s is already done: %s", config.scope, progress)
+            return progress
+        logger.info("Resuming backfill of %s at %s", config.scope, progress)
+
+    gmail_service = create_service(creds, app=AppType.GMAIL)
+    calendar_service = create_service(creds, app=AppType.CALENDAR)
+    limiter = TokenBucket(config.rate, capacity=config.chunk_size)
+    with ThreadPoolExecutor(max_workers=config.workers) as executor:
+        while not progress.done:
+            message_ids, next_page_token, estimate = list_message_page(gmail_service, page_token, config.label,
+                                                                       config.query, config.page_size)
+            progress.total = max(progress.total, estimate)
+
+            chunks = [message_ids[start:start + config.chunk_size]
+                      for start in range(0, len(message_ids), config.chunk_size)]
+            letters, predictions, failed_ids = {}, {}, []
+            for chunk_letters, chunk_predictions, chunk_failed_ids in executor.map(
+                    partial(_process_chunk, creds, limiter), chunks):
+                letters.update(chunk_letters)
+                predictions.update(chunk_predictions)
+                failed_ids.extend(chunk_failed_ids)
+            if predictions:
+                with STAGE_SECONDS.time(stage='backfill_calendar'):
+                    _, written, unwritten_ids = add_events(calendar_service, predictions, letters)
+                # letters that already have an unchanged event do not count again
+                progress.events += written
+                failed_ids.extend(unwritten_ids)
+            if failed_ids:
+                # the checkpoint keeps the token of this page; its events written so far are in the ledger, so doing
+                # the page again neither duplicates nor counts them twice
+                save_backfill_checkpoint(account, config.scope, page_token, progress.processed, progress.events,
+                                         progress.total, progress.done)
+                logger.error("Stopped the backfill of %s, %s messages of the page failed; run it again to retry",
+                             config.scope, len(failed_ids))
+                return progress
+
+            BACKFILL_MESSAGES.inc(len(message_ids))
+            progress.processed += len(message_ids)
+            progress.done = next_page_token is None
+            page_token = next_page_token
+            save_backfill_checkpoint(account, config.scope, page_token, progress.processed, progress.events,
+                                     progress.total, progress.done)
+            logger.info("Backfill of %s: %s", config.scope, progress)
+    return progress
+
+
+if __name__ == '__main__':
+    from script import get_credentials
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label', help='only letters with this label, e.g. INBOX; by default the whole mailbox')
+    parser.add_argument('--after', type=date.fromisoformat, help='first day, YYYY-MM-DD')
+    parser.add_argument('--before', type=date.fromisoformat, help='day after the last one, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='threads fetching and predicting')
+    parser.add_argument('--rate', type=float, default=BACKFILL_RATE, help='messages per second')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start over')
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    backfill_config = BackfillConfig(label=args.label, after=args.after, before=args.before, workers=args.workers,
+                                     rate=args.rate)
+    print(run_backfill(get_credentials(), backfill_config, restart=args.restart))
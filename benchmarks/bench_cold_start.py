@@ -0,0 +1,61 @@
+"""
+Compares reading the vector table into memory with memory-mapping it: time to the first prediction and the memory
+of several model processes running side by side.
+
+Proportional set size (PSS) splits shared pages between the processes that map them, so the summed PSS is the
+physical memory the processes take together. Linux only, as it reads /proc/self/smaps_rollup.
+Run from the repository root: python -m benchmarks.bench_cold_start [--model lg] [--processes 4]
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+from pathlib import Path
+
+WARM_UP_TEXT = "Let's meet tomorrow at 5 pm in Zoom to discuss the project."
+
+
+def memory_mib() -> dict[str, float]:
+    memory = {}
+    for line in Path('/proc/self/smaps_rollup').read_text().splitlines()[1:]:
+        name, value = line.split(':')
+        memory[name] = int(value.split()[0]) / 1024
+    return memory
+
+
+def first_prediction(model_name: str, mmap_vectors: bool, done_barrier: threading.Barrier) -> dict[str, float]:
+    start_time = time.perf_counter()
+    from model.custom_spacy_model import MySpaCyModel
+
+    model = MySpaCyModel(model_name, mmap_vectors=mmap_vectors)
+    model.classify_event_type(model.predict(WARM_UP_TEXT))
+    seconds = time.perf_counter() - start_time
+    # every process has loaded the model before any of them reads its memory
+    done_barrier.wait()
+    memory = memory_mib()
+    return {'seconds': seconds, 'rss': memory['Rss'], 'pss': memory['Pss']}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='lg', help='size, package name or model directory')
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'vectors':<8} {'first prediction s':>18} {'RSS MiB/process':>16} {'total PSS MiB':>14}")
+    for mmap_vectors in (False, True):
+        manager = context.Manager()
+        done_barrier = manager.Barrier(args.processes)
+        with context.Pool(args.processes) as pool:
+            results = pool.starmap(first_prediction,
+                                   [(args.model, mmap_vectors, done_barrier)] * args.processes)
+        manager.shutdown()
+        seconds = max(result['seconds'] for result in results)
+        rss = sum(result['rss'] for result in results) / len(results)
+        pss = sum(result['pss'] for result in results)
+        print(f"{'mmap' if mmap_vectors else 'read':<8} {seconds:>18.2f} {rss:>16.0f} {pss:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
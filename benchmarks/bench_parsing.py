@@ -0,0 +1,57 @@
+"""
+Measures gmail.parse_raw_message on a large marketing-style HTML email.
+
+Run from the repository root: python -m benchmarks.bench_parsing
+"""
+import base64
+import json
+import timeit
+import tracemalloc
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Callable
+
+from bs4 import BeautifulSoup
+
+from gmail import html_to_text, parse_raw_message
+
+TEST_FILES = Path(__file__).parent.parent / 'test_files'
+HTML_REPEATS = 50
+
+
+def make_newsletter() -> tuple[str, str]:
+    paragraphs = [line for path in sorted(TEST_FILES.glob('*.json'))
+                  for line in json.loads(path.read_text())['body'].splitlines()]
+    rows = ''.join(f'<tr><td style="padding:8px;font-family:Arial"><p class="text"><span>{line}</span></p></td></tr>'
+                   for line in paragraphs)
+    html = (f'<html><head><style>td {{color: #333}}</style></head><body><table>{rows * HTML_REPEATS}</table>'
+            f'<img src="https://example.com/pixel.gif"></body></html>')
+
+    email_msg = EmailMessage()
+    email_msg['From'] = 'news@example.com'
+    email_msg['Subject'] = 'Newsletter'
+    email_msg.set_content('')
+    email_msg.add_alternative(html, subtype='html')
+    email_msg.add_attachment(b'\0' * 2 * 1024 * 1024, maintype='application', subtype='pdf', filename='promo.pdf')
+    return html, base64.urlsafe_b64encode(email_msg.as_bytes()).decode('utf-8')
+
+
+def measure(name: str, func: Callable[[], object], number: int = 5) -> None:
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<28} {seconds * 1000:>10.1f} ms {peak / 1024 / 1024:>10.1f} MiB peak")
+
+
+def main() -> None:
+    html, raw_message = make_newsletter()
+    print(f"HTML part: {len(html) / 1024:.0f} KiB, raw message: {len(raw_message) / 1024:.0f} KiB")
+    measure('BeautifulSoup get_text', lambda: BeautifulSoup(html, 'html.parser').get_text(), number=1)
+    measure('html_to_text', lambda: html_to_text(html))
+    measure('parse_raw_message', lambda: parse_raw_message(raw_message))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Compares the single-pass feature extraction of model.patterns with one helper call per feature, and the batch
+scorer with scoring one letter at a time.
+
+Run from the repository root: python -m benchmarks.bench_patterns
+"""
+import json
+import timeit
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+from model.meeting_scorer import get_scorer
+from model.patterns import (check_calendaring_phrases, check_conditional_statements, check_confirmatory_closures,
+                            check_sender_recipient_info, check_subject_and_body_for_meeting, contains_date_entity,
+                            contains_location_or_tool, contains_multiple_persons, contains_video_conferencing_ref,
+                            get_meeting_probabilities, get_meeting_probability,
+                            meeting_features)
+
+TEST_FILES = Path(__file__).parent.parent / 'test_files'
+BODY_REPEATS = (1, 10, 100)
+BATCH_SIZES = (100, 1000, 10000)
+ENTITIES = [('5 pm', 'TIME'), ('tomorrow', 'DATE'), ('Anna', 'PERSON'), ('Moscow', 'LOC')]
+
+
+def separate_checks(email_dict: dict[str, str], doc: SimpleNamespace) -> None:
+    text = email_dict['body']
+    entities = [(ent.text, ent.label_) for ent in doc.ents]
+    contains_date_entity(entities)
+    check_sender_recipient_info(email_dict['sender'], doc)
+    check_calendaring_phrases(text)
+    check_conditional_statements(text)
+    check_confirmatory_closures(text)
+    contains_location_or_tool(entities, text)
+    contains_multiple_persons(entities)
+    check_subject_and_body_for_meeting(email_dict['subject'], text)
+    contains_video_conferencing_ref(text)
+    contains_video_conferencing_ref(text)
+
+
+def main() -> None:
+    letters = [json.loads(path.read_text()) for path in sorted(TEST_FILES.glob('*.json'))]
+    body = '\n'.join(letter['body'] for letter in letters)
+    doc = SimpleNamespace(ents=[SimpleNamespace(text=text, label_=label) for text, label in ENTITIES])
+
+    print(f"{'body chars':>12} {'separate, ms':>14} {'single pass, ms':>16} {'speedup':>8}")
+    for repeats in BODY_REPEATS:
+        email_dict = {'body': '\n'.join([body] * repeats), 'subject': 'Hello', 'sender': 'Anna'}
+        number = max(1, 100 // repeats)
+        separate = min(timeit.repeat(lambda: separate_checks(email_dict, doc), number=number, repeat=5)) / number
+        single = min(timeit.repeat(lambda: get_meeting_probability(email_dict, doc), number=number, repeat=5)) / number
+        print(f"{len(email_dict['body']):>12} {separate * 1000:>14.3f} {single * 1000:>16.3f} {separate / single:>7.1f}x")
+
+    # the batch time is mostly feature extraction; the matrix product alone is the last column
+    scorer = get_scorer()
+    print(f"\n{'letters':>12} {'one by one, ms':>14} {'batch, ms':>16} {'speedup':>8} {'product, ms':>12}")
+    for size in BATCH_SIZES:
+        email_dicts = [letters[index % len(letters)] | {'sender': 'Anna'} for index in range(size)]
+        docs = [doc] * size
+        single = min(timeit.repeat(lambda: [get_meeting_probability(email_dict, doc) for email_dict in email_dicts],
+                                   number=1, repeat=3))
+        batch = min(timeit.repeat(lambda: get_meeting_probabilities(email_dicts, docs), number=1, repeat=3))
+        features = np.array([meeting_features(email_dict, doc)[0] for email_dict in email_dicts], dtype=np.float64)
+        product = min(timeit.repeat(lambda: scorer.probabilities(features), number=10, repeat=3)) / 10
+        print(f"{size:>12} {single * 1000:>14.3f} {batch * 1000:>16.3f} {single / batch:>7.1f}x {product * 1000:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Measures letters_prediction throughput with 1..N worker processes on the test_files corpus.
+
+Run from the repository root: python -m benchmarks.bench_prediction [--repeats 20]
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+from model.main_model import letters_prediction, shutdown_prediction_pool
+from model.model_registry import warm_up
+
+TEST_FILES = Path(__file__).parent.parent / 'test_files'
+
+
+def load_corpus(repeats: int) -> dict[str, dict[str, str]]:
+    letters = [json.loads(path.read_text()) for path in sorted(TEST_FILES.glob('*.json'))]
+    return {f'{i}-{letter["email_id"]}': letter for i in range(repeats) for letter in letters}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=20, help='copies of the corpus to predict')
+    parser.add_argument('--chunk-size', type=int, default=16)
+    args = parser.parse_args()
+
+    letters = load_corpus(args.repeats)
+    warm_up()
+    worker_counts = [1] + [workers for workers in (2, 4, 8, 16) if workers <= (os.cpu_count() or 1)]
+
+    baseline = None
+    print(f"{len(letters)} letters")
+    print(f"{'workers':>8} {'seconds':>9} {'letters/s':>10} {'speedup':>8}")
+    for workers in worker_counts:
+        letters_prediction(letters, workers=workers, chunk_size=args.chunk_size)  # starts the pool
+        start_time = time.perf_counter()
+        letters_prediction(letters, workers=workers, chunk_size=args.chunk_size)
+        seconds = time.perf_counter() - start_time
+        shutdown_prediction_pool()
+
+        baseline = baseline or seconds
+        print(f"{workers:>8} {seconds:>9.2f} {len(letters) / seconds:>10.1f} {baseline / seconds:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Reports the recall and the speedup of the pre-filter against the full pipeline for a range of thresholds.
+
+Recall is the share of letters the full pipeline predicts as meetings that the pre-filter lets through.
+Run from the repository root: python -m benchmarks.bench_prefilter [--letters DIR] [--repeats 20]
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any
+
+from model.main_model import letters_prediction
+from model.model_registry import warm_up
+from model.prefilter import prefilter_report
+
+TEST_FILES = Path(__file__).parent.parent / 'test_files'
+THRESHOLDS = [0.0, 0.15, 0.3, 0.5, 0.65, 0.8]
+
+
+def load_corpus(letters_dir: Path, repeats: int) -> dict[str, dict[str, str]]:
+    letters = [json.loads(path.read_text()) for path in sorted(letters_dir.glob('*.json'))]
+    return {f'{i}-{path_index}': letter for i in range(repeats) for path_index, letter in enumerate(letters)}
+
+
+def timed_prediction(letters: dict[str, dict[str, str]], threshold: float) -> tuple[dict[str, dict[str, Any]], float]:
+    start_time = time.perf_counter()
+    predictions = letters_prediction(letters, use_cache=False, prefilter_threshold=threshold)
+    return predictions, time.perf_counter() - start_time
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--letters', type=Path, default=TEST_FILES, help='directory of letter JSON files')
+    parser.add_argument('--repeats', type=int, default=20, help='copies of the corpus to predict')
+    args = parser.parse_args()
+
+    letters = load_corpus(args.letters, args.repeats)
+    warm_up()
+    full_predictions, full_seconds = timed_prediction(letters, 0)
+
+    print(f"{len(letters)} letters, {len(full_predictions)} meetings, full pipeline {full_seconds:.2f} s")
+    print(f"{'threshold':>9} {'pass rate':>9} {'recall':>7} {'seconds':>8} {'speedup':>8}")
+    for threshold in THRESHOLDS:
+        report = prefilter_report(letters, full_predictions, threshold)
+        _, seconds = timed_prediction(letters, threshold)
+        print(f"{threshold:>9.2f} {report.pass_rate:>9.1%} {report.recall:>7.1%} {seconds:>8.2f} "
+              f"{full_seconds / seconds:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares the NLP model sizes and pipeline profiles: load time, peak memory and per-letter latency on test_files.
+
+Every combination is measured in a fresh process, so the memory of one model does not count towards the next.
+Run from the repository root: python -m benchmarks.bench_profiles [--models sm,md,lg] [--profiles full,ner]
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import statistics
+import time
+from pathlib import Path
+
+TEST_FILES = Path(__file__).parent.parent / 'test_files'
+
+
+def measure_profile(model_name: str, profile: str, repeats: int) -> dict[str, str | float]:
+    from model.custom_spacy_model import MySpaCyModel
+
+    texts = [json.loads(path.read_text())['body'] for path in sorted(TEST_FILES.glob('*.json'))]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    model = MySpaCyModel(model_name, profile)
+    load_seconds = time.perf_counter() - start_time
+    model.predict(texts[0])
+
+    latencies = []
+    for _ in range(repeats):
+        for text in texts:
+            start_time = time.perf_counter()
+            model.classify_event_type(model.predict(text))
+            latencies.append(time.perf_counter() - start_time)
+    return {
+        'components': ','.join(model.nlp.pipe_names),
+        'load_seconds': load_seconds,
+        'memory_mib': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        'p50_ms': statistics.median(latencies) * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default='sm,md,lg', help='sizes, package names or model directories')
+    parser.add_argument('--profiles', default='full,ner')
+    parser.add_argument('--repeats', type=int, default=5, help='passes over the corpus per profile')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'model':<16} {'profile':<8} {'load s':>7} {'MiB':>7} {'p50 ms':>7}  components")
+    for model_name in args.models.split(','):
+        for profile in args.profiles.split(','):
+            with context.Pool(1) as pool:
+                result = pool.apply(measure_profile, (model_name, profile, args.repeats))
+            print(f"{model_name:<16} {profile:<8} {result['load_seconds']:>7.2f} {result['memory_mib']:>7.0f} "
+                  f"{result['p50_ms']:>7.2f}  {result['components']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Times every stage of the pipeline separately on the test_files corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --update-baseline     # store the current numbers as the baseline
+    python -m benchmarks.run_benchmarks                       # exits with 1 if a stage regressed past the baseline
+
+Stages that need the spaCy model are skipped when it cannot be loaded.
+"""
+import argparse
+import base64
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Any, Callable
+
+from gmail import form_json_data, parse_raw_message
+from google_calendar import create_event_structure
+from model.date_parsing import _parse_date_on, _parse_single_time, parse_date, parse_time
+from model.language import detect_language
+from model.patterns import get_meeting_probability
+
+BENCHMARK_DIR = Path(__file__).parent
+TEST_FILES = BENCHMARK_DIR.parent / 'test_files'
+BASELINE_FILE = BENCHMARK_DIR / 'baseline.json'
+TIME_PHRASES = ['5 pm', '17:30', '14:00 - 15:00', "five o'clock", 'noon', '9am-10:30am']
+DATE_PHRASES = ['tomorrow', 'in 3 days', f'{datetime.now().year + 1}-03-01', 'December 5', 'next Friday']
+
+Stage = tuple[str, list[Any], Callable[[Any], Any]]
+
+
+def load_letters() -> list[dict[str, str]]:
+    return [json.loads(path.read_text()) for path in sorted(TEST_FILES.glob('*.json'))]
+
+
+def make_raw_message(letter: dict[str, str]) -> str:
+    email_msg = EmailMessage()
+    email_msg['From'] = letter['sender']
+    email_msg['To'] = letter['receiver']
+    email_msg['Subject'] = letter['subject']
+    email_msg['Date'] = format_datetime(datetime(2024, 1, 17, 12))
+    email_msg.set_content(letter['body'])
+    return base64.urlsafe_b64encode(email_msg.as_bytes()).decode('utf-8')
+
+
+def make_event_fields(letter: dict[str, str]) -> dict[str, Any]:
+    start = datetime(2024, 1, 17, 12)
+    return {'title': letter['subject'], 'description': '', 'start': {'dateTime': start.isoformat()},
+            'end': {'dateTime': (start + timedelta(hours=1)).isoformat()}}
+
+
+def measure(items: list[Any], func: Callable[[Any], Any], repeats: int) -> dict[str, float]:
+    latencies = []
+    for _ in range(repeats):
+        for item in items:
+            start_time = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # statistics.quantiles needs two samples; a single one, such as a model load, is every percentile
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'emails': len(latencies),
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'emails_per_second': len(latencies) / sum(latencies),
+        'peak_memory_mib': peak / 1024 / 1024,
+    }
+
+
+def parse_phrase(phrase: tuple[Callable[[str], Any], str]) -> None:
+    parser, text = phrase
+    try:
+        parser(text)
+    except ValueError:
+        pass
+
+
+def parse_phrase_uncached(phrase: tuple[Callable[[str], Any], str]) -> None:
+    _parse_single_time.cache_clear()
+    _parse_date_on.cache_clear()
+    parse_phrase(phrase)
+
+
+def model_stages(letters: list[dict[str, str]]) -> list[Stage]:
+    try:
+        from model.custom_spacy_model import MySpaCyModel
+        model = MySpaCyModel()
+    except (ImportError, OSError) as error:
+        print(f"Skipping model stages: {error}", file=sys.stderr)
+        return []
+
+    docs = [(letter, model.predict(letter['body'])) for letter in letters]
+    entity_phrases = [(parse_time if ent.label_ == 'TIME' else parse_date, ent.text)
+                      for _, doc in docs for ent in doc.ents if ent.label_ in ('TIME', 'DATE')]
+    return [
+        ('model_load', [None], lambda _: MySpaCyModel()),
+        ('nlp', letters, lambda letter: model.predict(letter['body'])),
+        ('get_meeting_probability', docs, lambda pair: get_meeting_probability(*pair)),
+        ('parse_entities', entity_phrases, parse_phrase),
+        ('classify_event_type', [doc for _, doc in docs], model.classify_event_type),
+    ]
+
+
+def run(repeats: int) -> dict[str, dict[str, float]]:
+    letters = load_letters()
+    raw_messages = [make_raw_message(letter) for letter in letters]
+    parsed_messages = [parse_raw_message(raw_message) for raw_message in raw_messages]
+    phrases = [(parse_time, text) for text in TIME_PHRASES] + [(parse_date, text) for text in DATE_PHRASES]
+
+    stages: list[Stage] = [
+        ('parse_raw_message', raw_messages, parse_raw_message),
+        ('form_json_data', parsed_messages, lambda parsed: form_json_data(*parsed)),
+        ('parse_time_date_cold', phrases, parse_phrase_uncached),
+        ('parse_time_date_cached', phrases, parse_phrase),
+        ('create_event_structure', letters, lambda letter: create_event_structure(**make_event_fields(letter))),
+        ('detect_language', letters, lambda letter: detect_language(letter['body'])),
+    ]
+    stages += model_stages(letters)
+
+    results = {}
+    for name, items, func in stages:
+        if not items:
+            continue
+        results[name] = measure(items, func, 1 if name == 'model_load' else repeats)
+    return results
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]],
+            tolerance: float) -> list[str]:
+    regressions = []
+    for name, stage in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]['p50_ms'] * (1 + tolerance)
+        if stage['p50_ms'] > limit:
+            regressions.append(f"{name}: p50 {stage['p50_ms']:.3f} ms > {limit:.3f} ms "
+                               f"(baseline {baseline[name]['p50_ms']:.3f} ms + {tolerance:.0%})")
+    return regressions
+
+
+def print_table(results: dict[str, dict[str, float]]) -> None:
+    print(f"{'stage':<26} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'emails/s':>10} {'peak MiB':>9}")
+    for name, stage in results.items():
+        print(f"{name:<26} {stage['p50_ms']:>9.3f} {stage['p95_ms']:>9.3f} {stage['p99_ms']:>9.3f} "
+              f"{stage['emails_per_second']:>10.1f} {stage['peak_memory_mib']:>9.2f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5, help='passes over the corpus per stage')
+    parser.add_argument('--output', type=Path, help='write the results as JSON')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = run(args.repeats)
+    print_table(results)
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'stages': results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        return 0
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create it", file=sys.stderr)
+        return 0
+    regressions = compare(results, json.loads(args.baseline.read_text())['stages'], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,39 @@
 import base64
+import logging
+import os
+import re
+import time
 from email import message_from_bytes
 from email.header import decode_header
 from email.message import Message
+from html import unescape
 
 from bs4 import BeautifulSoup
 
 from utils.error_handling import http_error_catcher
+from utils.metrics import API_RETRIES, record_api_call
+from utils.transport import HTTP_MAX_RETRIES, backoff_delay, is_retryable
+from utils.storage import get_history_id
 from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+
+HISTORY_EXPIRED_STATUS = 404
+GMAIL_PAGE_SIZE = 500  # the largest maxResults accepted by messages.list
+GMAIL_BATCH_SIZE = 50  # Gmail accepts up to 100 calls per batch, but throttles batches larger than 50
+
+MAX_BODY_CHARS = int(os.getenv('MAX_BODY_CHARS', 20000))
+MAX_PART_BYTES = int(os.getenv('MAX_PART_BYTES', 1024 * 1024))
+# encoded characters that are enough for a decoded byte, line breaks included
+ENCODED_CHARS_PER_BYTE = {'base64': 2, 'quoted-printable': 4}
+TEXT_CONTENT_TYPES = ('text/plain', 'text/html')
+MESSAGES_GET_METHOD = 'gmail.users.messages.get'
+
+HTML_COMMENT_REGEX = re.compile(r'<!--.*?(?:-->|$)', re.DOTALL)
+HTML_HIDDEN_REGEX = re.compile(r'<(script|style|head|title)\b.*?(?:</\1\s*>|$)', re.DOTALL | re.IGNORECASE)
+HTML_BLOCK_TAG_REGEX = re.compile(r'</?(?:p|div|br|hr|tr|li|ul|ol|table|h[1-6]|blockquote)\b[^>]*>', re.IGNORECASE)
+HTML_TAG_REGEX = re.compile(r'<[a-zA-Z/!?][^>]*(?:>|$)')
+
+logger = logging.getLogger(__name__)
 
 
 def remove_empty_lines(text: str) -> str:
@@ -16,46 +43,78 @@ def remove_empty_lines(text: str) -> str:
     return text.strip()
 
 
+def decode_bytes(data: bytes, encoding: str | None) -> str:
+    try:
+        return data.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
 def decode_text(text: str) -> str:
     decoded_parts = decode_header(text)
     decoded_text = ""
     for part, encoding in decoded_parts:
         if isinstance(part, bytes):
-            decoded_text += part.decode(encoding or "utf-8")
+            decoded_text += decode_bytes(part, encoding)
         else:
             decoded_text += part
     return decoded_text
 
 
+def html_to_text(html: str) -> str:
+    """
+    Strips tags, comments, scripts and styles with regular expressions, which is much cheaper than building a tree.
+
+    Documents with CDATA sections are left to BeautifulSoup.
+    """
+    if '<![CDATA[' in html:
+        return BeautifulSoup(html, 'html.parser').get_text()
+    text = HTML_COMMENT_REGEX.sub('', html)
+    text = HTML_HIDDEN_REGEX.sub('', text)
+    text = HTML_BLOCK_TAG_REGEX.sub('\n', text)
+    text = HTML_TAG_REGEX.sub('', text)
+    return unescape(text)
+
+
+def decode_payload(part: Message, limit: int) -> bytes:
+    """
+    Returns at most `limit` bytes of the decoded payload of a part; of a base64 or quoted-printable payload only the
+    prefix holding those bytes is decoded.
+    """
+    encoding = str(part.get('content-transfer-encoding', '')).lower()
+    encoded = part.get_payload()
+    if encoding in ENCODED_CHARS_PER_BYTE and isinstance(encoded, str):
+        prefix = Message()
+        prefix['Content-Transfer-Encoding'] = encoding
+        prefix.set_payload(encoded[:limit * ENCODED_CHARS_PER_BYTE[encoding]])
+        payload = prefix.get_payload(decode=True)
+    else:
+        payload = part.get_payload(decode=True)
+    return payload[:limit] if isinstance(payload, bytes) else b''
+
+
+def extract_body(part: Message) -> str:
+    """
+    Decodes a text part and returns at most MAX_BODY_CHARS characters of its text.
+    """
+    body = decode_bytes(decode_payload(part, MAX_PART_BYTES), part.get_content_charset())
+    if part.get_content_type() == 'text/html':
+        body = html_to_text(body)
+    return remove_empty_lines(body[:MAX_BODY_CHARS])
+
+
 def parse_raw_message(raw_message: str) -> tuple[Message, str]:
     decoded_bytes = base64.urlsafe_b64decode(raw_message)
     email_message = message_from_bytes(decoded_bytes)
 
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            if part.get_content_type() in ('text/plain', 'text/html'):
-                body = part.get_payload(decode=True)
-                if part.get_content_type() == 'text/html':
-                    soup = BeautifulSoup(body, 'html.parser')
-                    body = soup.get_text()
-                else:
-                    body = body.decode('utf-8')
-                clean_body = remove_empty_lines(body)
-                if clean_body:
-                    return email_message, clean_body
-    else:
-        if email_message.get_content_type() in ('text/plain', 'text/html'):
-            body = email_message.get_payload(decode=True)
-            if email_message.get_content_type() == 'text/html':
-                soup = BeautifulSoup(body, 'html.parser')
-                body = soup.get_text()
-            else:
-                body = body.decode('utf-8')
-            clean_body = remove_empty_lines(body)
-            if clean_body:
-                return email_message, clean_body
-        else:
-            return Message(), ''
+    # attachments and non-text parts are skipped before their payload is decoded
+    for part in email_message.walk():
+        if part.get_content_type() not in TEXT_CONTENT_TYPES or part.get_content_disposition() == 'attachment':
+            continue
+        clean_body = extract_body(part)
+        if clean_body:
+            return email_message, clean_body
+    return Message(), ''
 
 
 def form_json_data(email: Message, full_body: str) -> dict[str, str]:
@@ -68,16 +127,172 @@ def form_json_data(email: Message, full_body: str) -> dict[str, str]:
     return data
 
 
+def list_message_page(service: Resource, page_token: str | None = None, labels: str | list[str] | None = 'INBOX',
+                      query: str | None = None, page_size: int = GMAIL_PAGE_SIZE) -> tuple[list[str], str | None, int]:
+    """
+    Lists one page of message ids, newest first, matching the labels and a Gmail search query such as
+    "after:2024/01/01".
+
+    Returns the ids, the token of the next page or None after the last one, and Gmail's estimate of the total.
+    """
+    message_results = service.users().messages().list(userId='me', labelIds=labels, q=query, maxResults=page_size,
+                                                      pageToken=page_token).execute()
+    message_ids = [message['id'] for message in message_results.get('messages', [])]
+    return message_ids, message_results.get('nextPageToken'), message_results.get('resultSizeEstimate', 0)
+
+
+def list_message_ids(service: Resource, limit: int, labels: str | list[str] = 'INBOX') -> list[str]:
+    message_ids: list[str] = []
+    page_token = None
+    while len(message_ids) < limit:
+        page_size = min(GMAIL_PAGE_SIZE, limit - len(message_ids))
+        page_ids, page_token, _ = list_message_page(service, page_token, labels, page_size=page_size)
+        message_ids.extend(page_ids)
+        if page_token is None:
+            break
+    return message_ids[:limit]
+
+
+def fetch_raw_messages(service: Resource, message_ids: list[str],
+                       batch_size: int = GMAIL_BATCH_SIZE) -> tuple[dict[str, str], list[str]]:
+    """
+    Downloads raw messages with one batch HTTP request per `batch_size` messages.
+
+    Messages rejected by a rate limit or a server error are fetched again in a later batch after a backoff;
+    any other failed message is reported and skipped without affecting the rest of its batch.
+    Returns the raw messages and the ids of the messages still failing after HTTP_MAX_RETRIES retries.
+    """
+    raw_messages = {}
+    retry_ids: list[str] = []
+
+    def on_message(message_id: str, message_info: dict[str, str], error: HttpError | None) -> None:
+        if error is not None:
+            record_api_call(MESSAGES_GET_METHOD, error.resp.status)
+            if is_retryable(error.resp.status, error.content):
+                retry_ids.append(message_id)
+            else:
+                logger.error("An error occurred: %s", error)
+            return
+        record_api_call(MESSAGES_GET_METHOD)
+        raw_messages[message_id] = message_info['raw']
+
+    pending_ids = message_ids
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        if attempt > 0:
+            logger.warning("Retrying %s messages after a rate limit or server error", len(pending_ids))
+            API_RETRIES.inc(len(pending_ids), api='gmail', status='batch')
+            time.sleep(backoff_delay(attempt - 1))
+        for start in range(0, len(pending_ids), batch_size):
+            batch = service.new_batch_http_request(callback=on_message)
+            for message_id in pending_ids[start:start + batch_size]:
+                batch.add(service.users().messages().get(userId='me', id=message_id, format='raw'),
+                          request_id=message_id)
+            batch.execute()
+        if not retry_ids:
+            pending_ids = []
+            break
+        pending_ids, retry_ids = retry_ids, []
+    else:
+        logger.error("Gave up on %s messages after %s retries", len(pending_ids), HTTP_MAX_RETRIES)
+
+    ordered = {message_id: raw_messages[message_id] for message_id in message_ids if message_id in raw_messages}
+    return ordered, pending_ids
+
+
+def get_raw_messages(service: Resource, message_ids: list[str], batch_size: int = GMAIL_BATCH_SIZE) -> dict[str, str]:
+    raw_messages, _ = fetch_raw_messages(service, message_ids, batch_size)
+    return raw_messages
+
+
+def parse_letter(raw_message: str) -> dict[str, str] | None:
+    email, body = parse_raw_message(raw_message)
+    if not body:
+        return None
+    return form_json_data(email, body)
+
+
+def parse_letters(raw_messages: dict[str, str]) -> dict[str, dict[str, str]]:
+    letters = {}
+    for message_id, raw_message in raw_messages.items():
+        letter = parse_letter(raw_message)
+        if letter is not None:
+            letters[message_id] = letter
+    return letters
+
+
+def get_messages(service: Resource, message_ids: list[str],
+                 batch_size: int = GMAIL_BATCH_SIZE) -> dict[str, dict[str, str]]:
+    return parse_letters(get_raw_messages(service, message_ids, batch_size))
+
+
 def get_letters(service: Resource, limit: int = 10, labels: str | list[str] = 'INBOX') -> dict[str, dict[str, str]]:
     letters = {}
     with http_error_catcher():
-        message_results = service.users().messages().list(userId='me', labelIds=labels, maxResults=limit).execute()
-        messages = message_results.get('messages', [])
-
-        for i, message in enumerate(messages):
-            message_info = service.users().messages().get(userId='me', id=message['id'], format='raw').execute()
-            raw_message = message_info.get('raw')
-            email, raw_message = parse_raw_message(raw_message)
-            json_data = form_json_data(email, raw_message)
-            letters[message['id']] = json_data
+        message_ids = list_message_ids(service, limit, labels)
+        letters = get_messages(service, message_ids)
     return letters
+
+
+def list_added_message_ids(service: Resource, start_history_id: str, label: str = 'INBOX') -> tuple[list[str], str]:
+    """
+    Lists the messages added to the label since `start_history_id`.
+
+    Returns the message ids and the history id to continue from on the next call.
+    """
+    message_ids: dict[str, None] = {}
+    page_token = None
+    while True:
+        history_results = service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                         historyTypes='messageAdded', labelId=label,
+                                                         maxResults=GMAIL_PAGE_SIZE, pageToken=page_token).execute()
+        for record in history_results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_ids[added['message']['id']] = None
+        history_id = history_results['historyId']
+        page_token = history_results.get('nextPageToken')
+        if page_token is None:
+            break
+    return list(message_ids), history_id
+
+
+def sync_message_ids(service: Resource, account: str, limit: int = 10, label: str = 'INBOX') -> tuple[list[str], str]:
+    """
+    Lists the ids of the letters that arrived since the stored history id of the account.
+
+    Returns the ids and the history id to store once they are processed. Without a stored history id, or after it
+    has expired, the `limit` latest letters are listed instead.
+    """
+    history_id = get_history_id(account)
+    if history_id is not None:
+        try:
+            return list_added_message_ids(service, history_id, label)
+        except HttpError as error:
+            if error.resp.status != HISTORY_EXPIRED_STATUS:
+                raise
+
+    # take the cursor before listing, so letters arriving meanwhile are picked up by the next sync
+    history_id = service.users().getProfile(userId='me').execute()['historyId']
+    return list_message_ids(service, limit, label), history_id
+
+
+def sync_letters(service: Resource, account: str, limit: int = 10,
+                 label: str = 'INBOX') -> tuple[dict[str, dict[str, str]], str | None]:
+    """
+    Returns the letters that arrived since the stored history id of the account, and the history id to store with
+    save_history_id once they are processed.
+
+    The history id is None if the letters could not all be listed and downloaded, so that the next sync lists
+    them again instead of losing them.
+    """
+    letters: dict[str, dict[str, str]] = {}
+    history_id = None
+    with http_error_catcher():
+        message_ids, next_history_id = sync_message_ids(service, account, limit, label)
+        raw_messages, failed_ids = fetch_raw_messages(service, message_ids)
+        letters = parse_letters(raw_messages)
+        if failed_ids:
+            logger.warning("Keeping the history id of account %s, %s letters could not be downloaded", account,
+                           len(failed_ids))
+        else:
+            history_id = next_history_id
+    return letters, history_id
@@ -1,9 +1,27 @@
+import hashlib
+import json
+import logging
+import time
+import weakref
 from datetime import datetime, timedelta
 from typing import Any
 import pytz
 from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
 
 from utils.error_handling import http_error_catcher
+from utils.metrics import API_RETRIES, CALENDAR_EVENTS, record_api_call
+from utils.storage import get_calendar_events, save_calendar_event, save_calendar_events
+from utils.transport import HTTP_MAX_RETRIES, backoff_delay, is_retryable
+
+PRIMARY_CALENDAR_TTL = 60 * 60  # seconds
+CALENDAR_LOG_HEADER = 'Logging of Google Calendar:\n'
+CALENDAR_BATCH_SIZE = 50  # calls per batch HTTP request
+EVENT_METHODS = {'inserted': 'calendar.events.insert', 'patched': 'calendar.events.patch'}
+
+logger = logging.getLogger(__name__)
+
+_primary_calendar_ids: weakref.WeakKeyDictionary[Resource, tuple[str, float]] = weakref.WeakKeyDictionary()
 
 
 def create_event_structure(event_type='Meeting', **fields):
@@ -29,15 +47,144 @@ def create_event_structure(event_type='Meeting', **fields):
     return event
 
 
-def add_event(service: Resource, events: dict[str, dict[str, str | Any]], emails: dict[str, dict[str, str]]) -> str:
-    log = 'Logging of Google Calendar:\n'
+def get_primary_calendar_id(service: Resource) -> str | None:
+    cached = _primary_calendar_ids.get(service)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    calendars_result = service.calendarList().list().execute()
+    calendars = calendars_result.get('items', [])
+    primary_calendar_id = next((calendar['id'] for calendar in calendars if calendar.get('primary')), None)
+    if primary_calendar_id is not None:
+        _primary_calendar_ids[service] = (primary_calendar_id, time.monotonic() + PRIMARY_CALENDAR_TTL)
+    return primary_calendar_id
+
+
+def event_fingerprint(event: dict[str, Any]) -> str:
+    """
+    Fingerprints the content of an event. The dates of a letter are read as of the time it was sent, so processing
+    it again on a later day gives the same fingerprint, and its event is only patched when the prediction changed.
+    """
+    return hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()
+
+
+def add_event(service: Resource, events: dict[str, dict[str, str | Any]],
+              emails: dict[str, dict[str, str]]) -> tuple[str, list[str]]:
+    """
+    Creates a calendar event per predicted email.
+
+    Emails that already have an event are skipped, or their event is patched if its content has changed.
+    Returns the log and the ids of the emails whose event could not be written.
+    """
+    log = CALENDAR_LOG_HEADER
+    done: set[str] = set()
+    with http_error_catcher():
+        primary_calendar_id = get_primary_calendar_id(service)
+        if primary_calendar_id is None:
+            logger.error("No primary calendar found, %s events were not written", len(events))
+            return log, list(events)
+
+        new_events = {}
+        for email_id, event_info in events.items():
+            event_info['title'] = emails[email_id]['subject']
+            new_events[email_id] = create_event_structure(**event_info)
+        known_events = get_calendar_events(primary_calendar_id, list(new_events))
+
+        for email_id, event in new_events.items():
+            fingerprint = event_fingerprint(event)
+            if email_id not in known_events:
+                event = service.events().insert(calendarId=primary_calendar_id, body=event).execute()
+                log += f"Event created: {event.get('htmlLink')}\n"
+                CALENDAR_EVENTS.inc(action='inserted')
+            else:
+                known_fingerprint, event_id = known_events[email_id]
+                if known_fingerprint == fingerprint:
+                    CALENDAR_EVENTS.inc(action='unchanged')
+                    done.add(email_id)
+                    continue
+                event = service.events().patch(calendarId=primary_calendar_id, eventId=event_id, body=event).execute()
+                log += f"Event updated: {event.get('htmlLink')}\n"
+                CALENDAR_EVENTS.inc(action='patched')
+            save_calendar_event(primary_calendar_id, email_id, fingerprint, event['id'])
+            done.add(email_id)
+    return log, [email_id for email_id in events if email_id not in done]
+
+
+def add_events(service: Resource, events: dict[str, dict[str, str | Any]], emails: dict[str, dict[str, str]],
+               batch_size: int = CALENDAR_BATCH_SIZE) -> tuple[str, int, list[str]]:
+    """
+    Creates or updates events like add_event, sending up to `batch_size` calls per batch HTTP request and recording
+    each batch in the ledger in one transaction. Returns the log, the number of events inserted or patched and the
+    ids of the emails whose event could not be written.
+
+    Calls rejected by a rate limit are sent again in a later batch after a backoff, and so are patches rejected by a
+    server error; an insert that failed with a server error may have been applied, so it is not repeated.
+    """
+    log = [CALENDAR_LOG_HEADER]
+    written = 0
+    done: set[str] = set()
     with http_error_catcher():
-        calendars_result = service.calendarList().list().execute()
-        calendars = calendars_result.get('items', [])
-        primary_calendar_id = next((calendar['id'] for calendar in calendars if calendar.get('primary')), None)
+        primary_calendar_id = get_primary_calendar_id(service)
+        if primary_calendar_id is None:
+            logger.error("No primary calendar found, %s events were not written", len(events))
+            return ''.join(log), 0, list(events)
+
+        new_events = {}
         for email_id, event_info in events.items():
             event_info['title'] = emails[email_id]['subject']
-            event = create_event_structure(**event_info)
-            event = service.events().insert(calendarId=primary_calendar_id, body=event).execute()
-            log += f"Event created: {event.get('htmlLink')}\n"
-    return log
+            new_events[email_id] = create_event_structure(**event_info)
+        known_events = get_calendar_events(primary_calendar_id, list(new_events))
+
+        calls: dict[str, tuple[str, dict[str, Any]]] = {}
+        for email_id, event in new_events.items():
+            if email_id not in known_events:
+                calls[email_id] = ('inserted', {'calendarId': primary_calendar_id, 'body': event})
+            elif known_events[email_id][0] != event_fingerprint(event):
+                calls[email_id] = ('patched', {'calendarId': primary_calendar_id, 'eventId': known_events[email_id][1],
+                                               'body': event})
+            else:
+                CALENDAR_EVENTS.inc(action='unchanged')
+                done.add(email_id)
+
+        saved: list[tuple[str, str, str]] = []
+        retry_ids: list[str] = []
+
+        def on_event(email_id: str, event: dict[str, Any], error: HttpError | None) -> None:
+            nonlocal written
+            action = calls[email_id][0]
+            if error is not None:
+                record_api_call(EVENT_METHODS[action], error.resp.status)
+                status = error.resp.status
+                if is_retryable(status, error.content) and (action == 'patched' or status < 500):
+                    retry_ids.append(email_id)
+                else:
+                    logger.error("An error occurred: %s", error)
+                return
+            record_api_call(EVENT_METHODS[action])
+            CALENDAR_EVENTS.inc(action=action)
+            written += 1
+            done.add(email_id)
+            log.append(f"Event {'created' if action == 'inserted' else 'updated'}: {event.get('htmlLink')}\n")
+            saved.append((email_id, event_fingerprint(new_events[email_id]), event['id']))
+
+        pending_ids = list(calls)
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            if attempt > 0:
+                logger.warning("Retrying %s calendar calls after a rate limit or server error", len(pending_ids))
+                API_RETRIES.inc(len(pending_ids), api='calendar', status='batch')
+                time.sleep(backoff_delay(attempt - 1))
+            for start in range(0, len(pending_ids), batch_size):
+                batch = service.new_batch_http_request(callback=on_event)
+                for email_id in pending_ids[start:start + batch_size]:
+                    action, arguments = calls[email_id]
+                    method = service.events().insert if action == 'inserted' else service.events().patch
+                    batch.add(method(**arguments), request_id=email_id)
+                batch.execute()
+                save_calendar_events(primary_calendar_id, saved)
+                saved.clear()
+            if not retry_ids:
+                break
+            pending_ids, retry_ids = retry_ids, []
+        else:
+            logger.error("Gave up on %s calendar calls after %s retries", len(pending_ids), HTTP_MAX_RETRIES)
+    return ''.join(log), written, [email_id for email_id in events if email_id not in done]
@@ -1,98 +1,203 @@
-import random
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy
 import spacy
+import srsly
 import torch
-from spacy.util import minibatch, compounding
-from spacy.training import Example
+from spacy.util import minibatch, compounding, fix_random_seed
 from torch.utils.tensorboard import SummaryWriter
 from spacy.cli import download
 
+from model.language import ENTITY_PATTERNS, EVENT_TYPE_WORDS
+from model.training_data import read_examples, shard_order
+
+MODEL_SIZES = {"sm": "en_core_web_sm", "md": "en_core_web_md", "lg": "en_core_web_lg"}
+# Downstream code only reads doc.ents and doc.vector, so the "ner" profile leaves out every other component
+PROFILES = {
+    "full": (),
+    "ner": ("tagger", "parser", "lemmatizer", "attribute_ruler", "senter", "morphologizer"),
+}
+# NLP_MODEL is a size from MODEL_SIZES, a package name or the directory of a serialized pipeline
+NLP_MODEL = os.getenv("NLP_MODEL", "lg")
+DEFAULT_MODEL = MODEL_SIZES.get(NLP_MODEL, NLP_MODEL)
+RU_MODEL_SIZES = {"sm": "ru_core_news_sm", "md": "ru_core_news_md", "lg": "ru_core_news_lg"}
+NLP_MODEL_RU = os.getenv("NLP_MODEL_RU", NLP_MODEL if NLP_MODEL in RU_MODEL_SIZES else "lg")
+# Letters are routed to the pipeline of their language; letters in other languages are not predicted
+LANGUAGE_MODELS = {
+    language: model_name for language, model_name in (
+        ("en", DEFAULT_MODEL),
+        ("ru", RU_MODEL_SIZES.get(NLP_MODEL_RU, NLP_MODEL_RU)),
+    ) if language in os.getenv("NLP_LANGUAGES", "en,ru").split(",")
+}
+DEFAULT_PROFILE = os.getenv("NLP_PROFILE", "full")
+# Map the vector table from the model directory instead of reading it, so processes share one copy in the page cache
+MMAP_VECTORS = os.getenv("NLP_MMAP_VECTORS", "1") == "1"
+EVENT_TYPES = ["Meeting", "Call", "Reminder", "Unknown", "Webinar", "Conference"]
+UNKNOWN_EVENT_TYPE = "Unknown"
+EVENT_TYPE_THRESHOLD = 0.2
+
+logger = logging.getLogger(__name__)
+
 
 class MySpaCyModel(torch.nn.Module):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, model_name=DEFAULT_MODEL, profile=DEFAULT_PROFILE, mmap_vectors=MMAP_VECTORS, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.doc = None
-        model_name = "en_core_web_lg"
+        self.model_name = MODEL_SIZES.get(model_name, model_name)
+        self.profile = profile
+        excluded = PROFILES[profile] + (("vectors",) if mmap_vectors else ())
 
         try:
-            nlp = spacy.load(model_name)
+            self.nlp = spacy.load(self.model_name, exclude=excluded)
         except OSError:
-            download(model_name)
-            nlp = spacy.load(model_name)
-        self.writer = SummaryWriter()
-
-    def fit(self, train_data):
+            if os.path.isdir(self.model_name):
+                raise
+            download(self.model_name)
+            self.nlp = spacy.load(self.model_name, exclude=excluded)
+
+        # in the en_core_web pipelines ner embeds its own tok2vec, so the shared one only feeds excluded components
+        if PROFILES[profile] and "tok2vec" in self.nlp.pipe_names and \
+                not self.nlp.get_pipe("tok2vec").listening_components:
+            self.nlp.remove_pipe("tok2vec")
+        if mmap_vectors:
+            _load_vectors_mmap(self.nlp)
+        _add_entity_patterns(self.nlp)
+
+        # Label vectors come straight from the vocab, so they never change for a loaded model
+        words = EVENT_TYPE_WORDS.get(self.nlp.lang, {})
+        label_vectors = [self.nlp.make_doc(words.get(event_type, event_type)).vector for event_type in EVENT_TYPES]
+        self.label_matrix = _normalize(numpy.array(label_vectors, dtype=numpy.float32))
+
+    def fit(self, shards, output_dir, checkpoint_dir=None, epochs=10, dropout=0.2, seed=0):
+        """
+        Trains the NER on DocBin shards written by model.training_data, holding one shard in memory at a time.
+
+        After every shard the pipeline and the position in the run are saved to `checkpoint_dir`, and a later call
+        with the same arguments resumes from there. The optimizer state is not saved, so it restarts on resume.
+        """
         if torch.cuda.is_available():
-            torch_device = torch.device('cuda')
             spacy.require_gpu()
-            print("Using GPU for training")
+            logger.info("Using GPU for training")
         else:
-            torch_device = torch.device('cpu')
-            print("Using CPU for training")
-
-        examples = []
-        cnt = 0
-        for doc in train_data:
-            for sent in doc['sentences']:
-                doc = self.nlp.make_doc(' '.join(sent['words']))
-                entities = []
-                for ent in doc.ents:
-                    ent_label = sent['named_entities'][ent.start:ent.end]
-                    entities.append((ent.start, ent.end, ent.label_, ent_label))
-                example = Example.from_dict(doc, {'entities': entities})
-                examples.append(example)
-            cnt += 1
+            logger.info("Using CPU for training")
+        fix_random_seed(seed)
 
-        optimizer = self.nlp.create_optimizer()
+        state = {"epoch": 0, "shards_done": 0, "losses": {}}
+        state_path = Path(checkpoint_dir, "state.json") if checkpoint_dir else None
+        if state_path is not None and state_path.exists():
+            state = json.loads(state_path.read_text())
+            self.nlp = spacy.load(Path(checkpoint_dir, "model"))
+            logger.info("Resuming training at epoch %s, shard %s", state["epoch"], state["shards_done"])
 
-        print('Begin training')
+        writer = SummaryWriter()
+        optimizer = self.nlp.create_optimizer()
 
-        for itn in range(10):
-            losses = {}
-            batches = minibatch(examples, size=compounding(4.0, 32.0, 1.001))
-            for batch in batches:
-                self.nlp.update(batch, drop=0.2, sgd=optimizer, losses=losses)
-            print(f"Iteration {itn} complete, loss: {losses}")
+        logger.info('Begin training')
+
+        for itn in range(state["epoch"], epochs):
+            losses = state["losses"] if itn == state["epoch"] else {}
+            shards_done = state["shards_done"] if itn == state["epoch"] else 0
+            order = shard_order(shards, seed, itn)
+            for shard_index in range(shards_done, len(order)):
+                examples = read_examples(self.nlp, order[shard_index], seed, itn)
+                with self.nlp.select_pipes(enable=["ner"]):
+                    for batch in minibatch(examples, size=compounding(4.0, 32.0, 1.001)):
+                        self.nlp.update(batch, drop=dropout, sgd=optimizer, losses=losses)
+                if state_path is not None:
+                    self._save_checkpoint(checkpoint_dir, {"epoch": itn, "shards_done": shard_index + 1,
+                                                           "losses": {key: float(value) for key, value in
+                                                                      losses.items()}})
+            logger.info("Iteration %s complete, loss: %s", itn, losses)
 
             # Log metrics to TensorBoard
             for key, value in losses.items():
-                self.writer.add_scalar(f"Loss/{key}", value, itn)
-
-        self.nlp.to_disk("/results/my_model")
-        self.writer.close()
+                writer.add_scalar(f"Loss/{key}", value, itn)
+            if state_path is not None:
+                # the model on disk already includes the last shard of the epoch
+                self._save_checkpoint(checkpoint_dir, {"epoch": itn + 1, "shards_done": 0, "losses": {}},
+                                      save_model=False)
+
+        self.nlp.to_disk(output_dir)
+        writer.close()
+
+    def _save_checkpoint(self, checkpoint_dir, state, save_model=True):
+        # the new model is complete on disk before the state points past the shards it was trained on
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if save_model:
+            temporary_dir = checkpoint_dir / "model.tmp"
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            self.nlp.to_disk(temporary_dir)
+            shutil.rmtree(checkpoint_dir / "model", ignore_errors=True)
+            temporary_dir.rename(checkpoint_dir / "model")
+        temporary_state = checkpoint_dir / "state.json.tmp"
+        temporary_state.write_text(json.dumps(state))
+        temporary_state.replace(checkpoint_dir / "state.json")
 
     def predict(self, text):
-        self.doc = self.nlp(text)
-        return self.doc
-
-    def classify_event_type(self):
-        if self.doc is None:
-            raise ValueError("Document not set. Call predict() first.")
-
-        event_types = ["Meeting", "Call", "Reminder", "Unknown", "Webinar", "Conference"]
-        event_type_scores = {}
-
-        print(f"Classifying event type for doc: {self.doc.text}")
-
-        for event_type in event_types:
-            event_type_doc = self.nlp(event_type)
-            score = self.doc.similarity(event_type_doc)
-            event_type_scores[event_type] = score
-            print(f"Score for {event_type}: {score}")
-
-        highest_score = max(event_type_scores.values())
-        chosen_event_type = [k for k, v in event_type_scores.items() if v == highest_score]
-
-        print(f"Event type scores: {event_type_scores}")
-        print(f"Highest score: {highest_score}, Chosen event type(s): {chosen_event_type}")
-
-        if highest_score < 0.2:
-            print("Highest score below threshold, returning 'Unknown'")
-            return "Unknown"
-
-        if len(chosen_event_type) > 1:
-            chosen = random.choice(chosen_event_type)
-            print(f"Multiple event types with the same score, randomly chosen: {chosen}")
-            return chosen
-
-        print(f"Chosen event type: {chosen_event_type[0]}")
-        return chosen_event_type[0]
+        return self.nlp(text)
+
+    def predict_batch(self, texts_with_context, batch_size=32, n_process=1):
+        """
+        Streams (text, context) pairs through the pipeline and yields (doc, context) pairs in input order.
+        """
+        return self.nlp.pipe(texts_with_context, as_tuples=True, batch_size=batch_size, n_process=n_process)
+
+    def classify_event_type(self, doc):
+        return self.classify_event_types([doc])[0]
+
+    def classify_event_types(self, docs):
+        """
+        Picks the event type whose label vector is the most similar to each document vector.
+
+        Ties are resolved in favour of the label that comes first in EVENT_TYPES.
+        """
+        doc_vectors = _normalize(numpy.array([doc.vector for doc in docs], dtype=numpy.float32))
+        scores = doc_vectors @ self.label_matrix.T
+        best = scores.argmax(axis=1)
+        if logger.isEnabledFor(logging.DEBUG):
+            for row in scores:
+                logger.debug("Event type similarities: %s", dict(zip(EVENT_TYPES, row.round(3).tolist())))
+        return [EVENT_TYPES[label] if scores[row, label] >= EVENT_TYPE_THRESHOLD else UNKNOWN_EVENT_TYPE
+                for row, label in enumerate(best)]
+
+
+def _load_vectors_mmap(nlp):
+    """
+    Attaches the vector table of a pipeline loaded without vectors as a read-only memory map of its .npy file.
+
+    Tables in another mode than "default", such as floret, are read into memory as usual.
+    """
+    if nlp.path is None:
+        return
+    vocab_dir = Path(nlp.path, "vocab")
+    vectors = nlp.vocab.vectors
+    settings_path = vocab_dir / "vectors.cfg"
+    settings = srsly.read_json(settings_path) if settings_path.exists() else {}
+    if not (vocab_dir / "vectors").exists() or settings.get("mode", "default") != "default":
+        vectors.from_disk(vocab_dir, exclude=["strings"])
+        return
+    vectors.data = numpy.load(vocab_dir / "vectors", mmap_mode="r")
+    # "vectors" also excludes vectors.cfg, which only holds the mode checked above
+    vectors.from_disk(vocab_dir, exclude=["strings", "vectors"])
+
+
+def _add_entity_patterns(nlp):
+    """
+    Adds rules for the TIME and DATE entities to pipelines of languages whose NER does not predict them.
+    """
+    if nlp.lang not in ENTITY_PATTERNS:
+        return
+    if "ner" in nlp.pipe_names and "TIME" in nlp.get_pipe("ner").labels:
+        return
+    ruler = nlp.add_pipe("entity_ruler", name="time_ruler", after="ner" if "ner" in nlp.pipe_names else None)
+    ruler.add_patterns(ENTITY_PATTERNS[nlp.lang])
+
+
+def _normalize(vectors):
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
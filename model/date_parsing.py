@@ -0,0 +1,157 @@
+import os
+import re
+from datetime import date, datetime, time, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+import dateparser
+
+DATE_LANGUAGES = tuple(os.getenv('DATE_LANGUAGES', 'en,ru').split(','))
+DATE_CACHE_SIZE = 4096
+
+WORD_TO_HOUR = {
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6,
+    "seven": 7,
+    "eight": 8,
+    "nine": 9,
+    "ten": 10,
+    "eleven": 11,
+    "twelve": 12
+}
+TOMORROW_PHRASES = {"tomorrow", "tomorrow's", "tomorrow's day"}
+
+TIME_RANGE_REGEX = re.compile(r'\s*[-–]\s*')
+OCLOCK_REGEX = re.compile(r"(\w+) o'clock", re.IGNORECASE)
+# "5 pm", "5:30 p.m.", "17:30"; a bare number is left to dateparser
+CLOCK_REGEX = re.compile(r'(\d{1,2})(?::(\d{2})\s*([ap])\.?m\.?|:(\d{2})|\s*([ap])\.?m\.?)', re.IGNORECASE)
+ISO_DATE_REGEX = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+RELATIVE_DAYS_REGEX = re.compile(r'in (\d+)(?: days?)?')
+# Russian names the part of the day instead of am/pm: "5 вечера", "9.30 утра", "в 2 дня"
+DAYTIME_REGEX = re.compile(r'(?:в\s+)?(\d{1,2})(?:[:.](\d{2}))?\s+(утра|дня|вечера|ночи)', re.IGNORECASE)
+# a whole number of "дня" without "в" is a number of days: "через 2 дня", "3 дня назад"
+DAY_COUNT_REGEX = re.compile(r'(?<![\d:.])(?<!\bв\s)\b\d{1,2}\s+дня\b', re.IGNORECASE)
+WORD_TIMES = {'полдень': time(12, 0), 'полночь': time(0, 0)}
+
+
+def _clock_time(hour: int, minute: int, meridiem: str | None) -> time | None:
+    if meridiem is not None:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem.lower() == 'p' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return time(hour, minute)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_single_time(time_part: str, now: datetime, languages: tuple[str, ...]) -> time | None:
+    """
+    Parses one time; `now` is the base of relative times such as "in 2 hours" and part of the cache key, so it is
+    given to the minute.
+    """
+    match = OCLOCK_REGEX.fullmatch(time_part)
+    if match:
+        word = match.group(1).lower()
+        hour = WORD_TO_HOUR.get(word, int(word) if word.isdigit() else None)
+        if hour is not None:
+            return _clock_time(hour, 0, None)
+
+    match = CLOCK_REGEX.fullmatch(time_part)
+    if match:
+        hour_text, minute_with_meridiem, meridiem, minute_text, bare_meridiem = match.groups()
+        parsed_time = _clock_time(int(hour_text), int(minute_with_meridiem or minute_text or 0),
+                                  meridiem or bare_meridiem)
+        if parsed_time is not None:
+            return parsed_time
+
+    if time_part.lower() in WORD_TIMES:
+        return WORD_TIMES[time_part.lower()]
+    if DAY_COUNT_REGEX.search(time_part):
+        return None
+    match = DAYTIME_REGEX.fullmatch(time_part)
+    if match:
+        hour, minute, daytime = int(match.group(1)), int(match.group(2) or 0), match.group(3).lower()
+        if daytime in ('дня', 'вечера') and hour < 12:
+            hour += 12
+        elif daytime == 'ночи' and hour == 12:
+            hour = 0
+        parsed_time = _clock_time(hour, minute, None)
+        if parsed_time is not None:
+            return parsed_time
+
+    parsed_time = dateparser.parse(time_part, languages=list(languages), settings={'RELATIVE_BASE': now})
+    return parsed_time.time() if parsed_time else None
+
+
+def letter_sent_time(send_date: str | None) -> datetime | None:
+    """
+    Reads the Date header of a letter as a naive local time, or returns None if it is missing or malformed.
+    """
+    if not send_date:
+        return None
+    try:
+        sent = parsedate_to_datetime(send_date)
+    except (TypeError, ValueError):
+        return None
+    if sent.tzinfo is None:
+        # "-0000" marks a time in UTC sent from an unknown zone
+        sent = sent.replace(tzinfo=timezone.utc)
+    return sent.astimezone().replace(tzinfo=None)
+
+
+def parse_time(time_str: str, languages: tuple[str, ...] = DATE_LANGUAGES,
+               now: datetime | None = None) -> tuple[time, time | None]:
+    """
+    Parses a time such as "5 pm" or a range such as "14:00 - 15:00" into start and end times; relative times such
+    as "in 2 hours" are resolved against `now`, the current time by default.
+    """
+    parts = TIME_RANGE_REGEX.split(time_str.strip(), maxsplit=1)
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    times = []
+    for time_part in parts:
+        parsed_time = _parse_single_time(time_part, now, languages)
+        if parsed_time is None:
+            raise ValueError(f"Unable to parse time: {time_part}")
+        times.append(parsed_time)
+    return times[0], times[1] if len(times) > 1 else None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date_on(date_str: str, today: date, languages: tuple[str, ...]) -> tuple[datetime | None, bool]:
+    """
+    Resolves a date relative to `today`; the day is part of the cache key, so entries expire at midnight.
+
+    Returns the date and whether it was given explicitly rather than relative to today.
+    """
+    lowered = date_str.lower()
+    midnight = datetime.combine(today, time())
+    if lowered in TOMORROW_PHRASES:
+        return midnight + timedelta(days=1), False
+    if lowered == "in a day":
+        return midnight + timedelta(days=2), False
+    match = RELATIVE_DAYS_REGEX.fullmatch(lowered)
+    if match:
+        return midnight + timedelta(days=int(match.group(1))), False
+
+    match = ISO_DATE_REGEX.fullmatch(lowered)
+    if match:
+        year, month, day = map(int, match.groups())
+        try:
+            return datetime(year, month, day), True
+        except ValueError:
+            return None, True
+
+    return dateparser.parse(date_str, languages=list(languages), settings={'RELATIVE_BASE': midnight}), True
+
+
+def parse_date(date_str: str, languages: tuple[str, ...] = DATE_LANGUAGES, now: datetime | None = None) -> str:
+    now = now or datetime.now()
+    parsed_date, is_explicit = _parse_date_on(date_str, now.date(), languages)
+    if parsed_date is None or (is_explicit and parsed_date < now):
+        raise ValueError("Invalid date format")
+    return parsed_date.strftime("%d.%m.%Y")
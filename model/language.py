@@ -0,0 +1,67 @@
+import re
+from collections import Counter
+
+DEFAULT_LANGUAGE = 'en'
+LANGUAGE_SAMPLE_CHARS = 2000  # the script of a letter is clear long before its end
+ENGLISH_MIN_WORDS = 20  # shorter Latin texts are taken as English without the function word check
+ENGLISH_MIN_SHARE = 0.05
+
+URL_REGEX = re.compile(r'\S+://\S+|www\.\S+|\S+@\S+')
+WORD_REGEX = re.compile(r'[^\W\d_]+')
+LETTER_REGEX = re.compile(r'[^\W\d_]')
+LATIN_REGEX = re.compile(r'[a-z]')
+CYRILLIC_REGEX = re.compile(r'[а-яёіїєґ]')
+UKRAINIAN_REGEX = re.compile(r'[іїєґ]')
+ENGLISH_FUNCTION_WORDS = frozenset(
+    "the a an and or of to in on at for with is are be was will you your we our i it this that please".split())
+UKRAINIAN_MIN_SHARE = 0.01  # of the Cyrillic letters, so a quoted Ukrainian word keeps a letter Russian
+
+# The ru_core_news pipelines only label PER, LOC and ORG, so times and dates come from rules
+ENTITY_PATTERNS = {
+    'ru': [
+        {'label': 'TIME', 'pattern': [{'TEXT': {'REGEX': r'^\d{1,2}:\d{2}$'}}, {'ORTH': '-', 'OP': '?'},
+                                      {'TEXT': {'REGEX': r'^\d{1,2}:\d{2}$'}, 'OP': '?'}]},
+        {'label': 'TIME', 'pattern': [{'TEXT': {'REGEX': r'^\d{1,2}$'}},
+                                      {'LOWER': {'IN': ['утра', 'вечера', 'ночи']}}]},
+        # "дня" also counts days, as in "через 2 дня", so it only names the afternoon after "в"
+        {'label': 'TIME', 'pattern': [{'LOWER': 'в'}, {'TEXT': {'REGEX': r'^\d{1,2}$'}}, {'LOWER': 'дня'}]},
+        {'label': 'TIME', 'pattern': [{'LOWER': {'IN': ['полдень', 'полночь']}}]},
+        {'label': 'DATE', 'pattern': [{'LOWER': {'IN': ['сегодня', 'завтра', 'послезавтра']}}]},
+        {'label': 'DATE', 'pattern': [{'TEXT': {'REGEX': r'^\d{1,2}\.\d{1,2}\.\d{2,4}$'}}]},
+        {'label': 'DATE', 'pattern': [
+            {'TEXT': {'REGEX': r'^\d{1,2}$'}},
+            {'LOWER': {'REGEX': r'^(январ|феврал|март|апрел|ма[йя]|июн|июл|август|сентябр|октябр|ноябр|декабр)'}},
+        ]},
+    ],
+}
+# Label vectors for the event type classification, in the vocabulary of each language
+EVENT_TYPE_WORDS = {
+    'ru': {'Meeting': 'встреча', 'Call': 'звонок', 'Reminder': 'напоминание', 'Unknown': 'неизвестно',
+           'Webinar': 'вебинар', 'Conference': 'конференция'},
+}
+
+
+def detect_language(text: str) -> str | None:
+    """
+    Guesses the language of a letter from the alphabet of its first LANGUAGE_SAMPLE_CHARS characters.
+
+    Links and addresses are ignored. Cyrillic text is Russian unless it has Ukrainian letters, Latin text is English
+    if it uses English function words, and None means no alphabet or language could be told.
+    """
+    sample = URL_REGEX.sub(' ', text[:LANGUAGE_SAMPLE_CHARS]).lower()
+    latin = len(LATIN_REGEX.findall(sample))
+    cyrillic = len(CYRILLIC_REGEX.findall(sample))
+    scripts = Counter(latin=latin, cyrillic=cyrillic, other=len(LETTER_REGEX.findall(sample)) - latin - cyrillic)
+    if not sum(scripts.values()):
+        return DEFAULT_LANGUAGE
+
+    script, _ = scripts.most_common(1)[0]
+    if script == 'cyrillic':
+        ukrainian = len(UKRAINIAN_REGEX.findall(sample))
+        return 'uk' if ukrainian >= UKRAINIAN_MIN_SHARE * cyrillic else 'ru'
+    if script == 'latin':
+        words = [word for word in WORD_REGEX.findall(sample) if word.isascii()]
+        if len(words) < ENGLISH_MIN_WORDS or \
+                sum(word in ENGLISH_FUNCTION_WORDS for word in words) >= ENGLISH_MIN_SHARE * len(words):
+            return 'en'
+    return None
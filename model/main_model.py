@@ -1,82 +1,50 @@
-import re
-
-from model.patterns import get_meeting_probability
+import logging
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any
+
+from spacy.tokens import Doc
+
+from model.patterns import get_meeting_probabilities
 from datetime import datetime, timedelta
-import model.custom_spacy_model as custom_model
-import dateparser
-
-
-def parse_time(time_str):
-    def parse_single_time(time_part):
-        # Regex to match phrases like "five o'clock"
-        match = re.match(r"(\w+) o'clock", time_part, re.IGNORECASE)
-        if match:
-            # Convert the matched word to a number
-            word_to_number = {
-                "one": "1:00",
-                "two": "2:00",
-                "three": "3:00",
-                "four": "4:00",
-                "five": "5:00",
-                "six": "6:00",
-                "seven": "7:00",
-                "eight": "8:00",
-                "nine": "9:00",
-                "ten": "10:00",
-                "eleven": "11:00",
-                "twelve": "12:00"
-            }
-            normalized_time_part = word_to_number.get(match.group(1).lower(), time_part)
-        else:
-            normalized_time_part = time_part
-
-        parsed_time = dateparser.parse(normalized_time_part)
-        if parsed_time:
-            return parsed_time.time()
-        else:
-            raise ValueError(f"Unable to parse time: {time_part}")
-
-    if "-" in time_str:
-        start_time_str, end_time_str = map(str.strip, time_str.split(" - "))
-        start_time = parse_single_time(start_time_str)
-        end_time = parse_single_time(end_time_str)
-        return start_time, end_time
-    else:
-        time_obj = parse_single_time(time_str)
-        return time_obj, None
-
-
-def parse_date(date_str):
-    if date_str.lower() in {"tomorrow", "tomorrow's", "tomorrow's day"}:
-        return (datetime.now() + timedelta(days=1)).strftime("%d.%m.%Y")
-    elif date_str.lower() == "in a day":
-        return (datetime.now() + timedelta(days=2)).strftime("%d.%m.%Y")
-    elif date_str.lower().startswith("in "):
-        try:
-            num_days = int(date_str.lower().split()[1])
-            return (datetime.now() + timedelta(days=num_days)).strftime("%d.%m.%Y")
-        except ValueError:
-            raise ValueError("Invalid format for relative date")
-    else:
-        try:
-            parsed_date = dateparser.parse(date_str, settings={'RELATIVE_BASE': datetime.now()})
-            if parsed_date < datetime.now():
-                raise ValueError("Date cannot be in the past")
-            return parsed_date.strftime("%d.%m.%Y")
-        except ValueError:
-            raise ValueError("Invalid date format")
-
-
-def extract_date_time_info(doc):
+from model.date_parsing import letter_sent_time, parse_date, parse_time
+from model.custom_spacy_model import LANGUAGE_MODELS, MySpaCyModel
+from model.language import DEFAULT_LANGUAGE, detect_language
+from model.model_registry import get_language_model, get_model
+from model.prediction_cache import cached_prediction
+from model.prefilter import PREFILTER_THRESHOLD, is_candidate
+from utils.metrics import EMAILS_BY_LANGUAGE, EMAILS_PREFILTERED
+
+NLP_BATCH_SIZE = int(os.getenv('NLP_BATCH_SIZE', 32))
+NLP_N_PROCESS = int(os.getenv('NLP_N_PROCESS', 1))
+PREDICTION_WORKERS = int(os.getenv('PREDICTION_WORKERS', 0))  # 0 or 1 keeps the prediction in the calling process
+PREDICTION_CHUNK_SIZE = int(os.getenv('PREDICTION_CHUNK_SIZE', 16))
+PREDICTION_CACHE = os.getenv('PREDICTION_CACHE', '1') == '1'
+
+logger = logging.getLogger(__name__)
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def extract_date_time_info(doc, language=DEFAULT_LANGUAGE, now=None):
+    # dateparser only tries the language of the letter instead of detecting it for every phrase
+    languages = (language,)
+    # relative dates are read as of `now`, the time the letter was sent, so a letter always gets the same dates
+    now = now or datetime.now()
     date_entities = [ent for ent in doc.ents if ent.label_ == 'DATE']
     time_entities = [ent for ent in doc.ents if ent.label_ == 'TIME']
     date = [ent.text for ent in date_entities]
     time = [ent.text for ent in time_entities]
-    time_parsed = parse_time(time[0])
+    time_parsed = parse_time(time[0], languages, now)
     if len(date) != 0:
-        date_parsed = parse_date(date[0])
+        date_parsed = parse_date(date[0], languages, now)
     else:
-        date_parsed = datetime.now().strftime("%d.%m.%Y")
+        date_parsed = now.strftime("%d.%m.%Y")
 
     start_datetime = datetime.strptime(date_parsed, "%d.%m.%Y")
     start_datetime = start_datetime.replace(hour=time_parsed[0].hour, minute=time_parsed[0].minute, second=0)
@@ -89,19 +57,11 @@ def extract_date_time_info(doc):
     return start_datetime, end_datetime
 
 
-def _letter_prediction(data):
-    text = data['body']
-    model = custom_model.MySpaCyModel()
-
-    doc = model.predict(text)
-
-    answer = get_meeting_probability(data, doc)
+def _letter_prediction(answer, doc, model, language=DEFAULT_LANGUAGE, now=None):
     is_meeting = answer['is_meeting']
+    logger.debug("Letter with meeting: %s (Probability: %s)", is_meeting, answer['probability'])
     if not is_meeting:
         return None
-    # prob = answer['probability']
-
-    # print(f"Letter with meeting: {is_meeting} (Probability: {prob})")
 
     loc_entities = [ent for ent in doc.ents if ent.label_ == 'LOC']
     loc = [ent.text for ent in loc_entities]
@@ -112,9 +72,9 @@ def _letter_prediction(data):
     elif len(loc) > 0:
         description = f'Location of meeting: {loc[0]}'
 
-    start_datetime, end_datetime = extract_date_time_info(doc)
+    start_datetime, end_datetime = extract_date_time_info(doc, language, now)
 
-    event_type = model.classify_event_type()
+    event_type = model.classify_event_type(doc)
 
     data = {
         'description': description,
@@ -130,10 +90,122 @@ def _letter_prediction(data):
     return data
 
 
-def letters_prediction(letters: dict[str, dict[str, str]]):
+def _predict_letters(letters: dict[str, dict[str, str]], language: str = DEFAULT_LANGUAGE,
+                     batch_size: int = NLP_BATCH_SIZE, n_process: int = NLP_N_PROCESS) -> dict[str, dict[str, Any]]:
+    model = get_language_model(language)
+    texts = ((letter['body'], email_id) for email_id, letter in letters.items())
+
+    # only letters with a time can be meetings, so the other docs are dropped at once, and the rest are scored
+    # every `batch_size` docs, so no more than a batch of Docs is held at a time
     predictions = {}
-    for email_id, letter in letters.items():
-        prediction = _letter_prediction(letter)
+    docs: dict[str, Doc] = {}
+    for doc, email_id in model.predict_batch(texts, batch_size=batch_size, n_process=n_process):
+        if any(ent.label_ == 'TIME' for ent in doc.ents):
+            docs[email_id] = doc
+        if len(docs) >= batch_size:
+            predictions.update(_score_docs(letters, docs, model, language))
+            docs = {}
+    if docs:
+        predictions.update(_score_docs(letters, docs, model, language))
+    return predictions
+
+
+def _score_docs(letters: dict[str, dict[str, str]], docs: dict[str, Doc], model: MySpaCyModel,
+                language: str) -> dict[str, dict[str, Any]]:
+    answers = get_meeting_probabilities([letters[email_id] for email_id in docs], list(docs.values()))
+
+    predictions = {}
+    for (email_id, doc), answer in zip(docs.items(), answers):
+        try:
+            prediction = _letter_prediction(answer, doc, model, language,
+                                            letter_sent_time(letters[email_id].get('send_date')))
+        except ValueError:
+            # a date or time the parsers cannot read only costs this letter its event
+            logger.warning("Could not read the date or time of letter %s", email_id, exc_info=True)
+            continue
         if prediction:
             predictions[email_id] = prediction
     return predictions
+
+
+def start_prediction_pool(workers: int = PREDICTION_WORKERS) -> ProcessPoolExecutor:
+    """
+    Starts the worker processes for letters_prediction, loading the model first.
+
+    Where fork is available the workers inherit the loaded model and share its memory copy-on-write, so the pool
+    should be started before other threads are, e.g. right after warm-up. Elsewhere each worker loads the model once.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            get_model()
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+                                        initializer=get_model)
+            # a fork pool starts all of its workers on the first task
+            _pool.submit(get_model).result()
+    return _pool
+
+
+def shutdown_prediction_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def letters_prediction(letters: dict[str, dict[str, str]], batch_size: int = NLP_BATCH_SIZE,
+                       n_process: int = NLP_N_PROCESS, workers: int = PREDICTION_WORKERS,
+                       chunk_size: int = PREDICTION_CHUNK_SIZE, use_cache: bool = PREDICTION_CACHE,
+                       prefilter_threshold: float = PREFILTER_THRESHOLD):
+    """
+    Predicts the events of the letters, keyed by email id.
+
+    Letters scoring below `prefilter_threshold` in the regex pre-filter are treated as non-meetings without running
+    the model. The rest are routed by language to the pipeline of that language, and letters in a language without
+    one in LANGUAGE_MODELS are skipped. Letters with already predicted content are answered from the prediction cache.
+    With more than one worker the rest is split into chunks predicted in the process pool; workers send back the
+    plain prediction dicts, never Docs.
+
+    Dates are read as of the time each letter was sent, and events that have already ended are left out.
+    """
+    candidates: dict[str | None, dict[str, dict[str, str]]] = defaultdict(dict)
+    for email_id, letter in letters.items():
+        if is_candidate(letter, prefilter_threshold):
+            candidates[detect_language(letter['body'])][email_id] = letter
+    EMAILS_PREFILTERED.inc(len(letters) - sum(map(len, candidates.values())))
+
+    predictions: dict[str, Any] = {}
+    for language, language_letters in candidates.items():
+        EMAILS_BY_LANGUAGE.inc(len(language_letters), language=language or 'unknown')
+        if language is None or language not in LANGUAGE_MODELS:
+            logger.debug("Skipped %s letters in language %s", len(language_letters), language)
+            continue
+        predict = partial(_pooled_prediction, language=language, batch_size=batch_size, n_process=n_process,
+                          workers=workers, chunk_size=chunk_size)
+        predictions.update(cached_prediction(language_letters, predict, language) if use_cache
+                           else predict(language_letters))
+    now = datetime.now()
+    return {email_id: prediction for email_id, prediction in predictions.items() if _event_end(prediction) > now}
+
+
+def _event_end(prediction: dict[str, Any]) -> datetime:
+    if prediction['end']['dateTime'] is not None:
+        return datetime.fromisoformat(prediction['end']['dateTime'])
+    # the calendar gives an event without an end one hour
+    return datetime.fromisoformat(prediction['start']['dateTime']) + timedelta(hours=1)
+
+
+def _pooled_prediction(letters: dict[str, dict[str, str]], language: str, batch_size: int, n_process: int,
+                       workers: int, chunk_size: int):
+    if workers <= 1 or len(letters) <= chunk_size:
+        return _predict_letters(letters, language, batch_size, n_process)
+
+    pool = start_prediction_pool(workers)
+    items = list(letters.items())
+    chunks = [dict(items[start:start + chunk_size]) for start in range(0, len(items), chunk_size)]
+    predictions = {}
+    for chunk_predictions in pool.map(_predict_letters, chunks, [language] * len(chunks), [batch_size] * len(chunks)):
+        predictions.update(chunk_predictions)
+    return predictions
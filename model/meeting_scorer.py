@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+SCORING_CONFIG = os.getenv('SCORING_CONFIG', str(Path(__file__).parent / 'scoring.json'))
+
+# Column order of the feature matrix; every feature is 0 or 1
+FEATURES = (
+    'has_date',
+    'sender_recipient',
+    'calendaring_phrases',
+    'conditional_statements',
+    'confirmatory_closures',
+    'location_or_tool',
+    'multiple_persons',
+    'meeting_keywords',
+    'reference',
+)
+
+
+@dataclass(frozen=True)
+class MeetingScorer:
+    """
+    Scores letters from their feature matrix, adding one weighted column at a time.
+
+    A linear scorer sums the weights of the features present; a logistic one, as fitted by `fit_logistic`, turns the
+    sum into a probability. Letters above `threshold` are meetings.
+    """
+    weights: np.ndarray
+    bias: float = 0.0
+    threshold: float = 0.15
+    logistic: bool = False
+
+    def probabilities(self, features: np.ndarray) -> np.ndarray:
+        # the weights are added in FEATURES order, as a letter at a time did, since a matrix product may sum them in
+        # another order and the rounding difference flips scores that land on the threshold
+        scores = np.zeros(len(features))
+        for column, weight in zip(np.asarray(features, dtype=np.float64).T, self.weights):
+            scores += column * weight
+        scores += self.bias
+        if self.logistic:
+            scores = 1 / (1 + np.exp(-scores))
+        return scores
+
+    def to_config(self) -> dict[str, Any]:
+        return {
+            'weights': dict(zip(FEATURES, self.weights.tolist())),
+            'bias': self.bias,
+            'threshold': self.threshold,
+            'logistic': self.logistic,
+        }
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> 'MeetingScorer':
+        return cls(weights=np.array([config['weights'][feature] for feature in FEATURES], dtype=np.float64),
+                   bias=config.get('bias', 0.0), threshold=config['threshold'], logistic=config.get('logistic', False))
+
+
+def load_scorer(path: str | Path = SCORING_CONFIG) -> MeetingScorer:
+    return MeetingScorer.from_config(json.loads(Path(path).read_text()))
+
+
+def save_scorer(scorer: MeetingScorer, path: str | Path = SCORING_CONFIG) -> None:
+    Path(path).write_text(json.dumps(scorer.to_config(), indent=4) + '\n')
+
+
+@cache
+def get_scorer() -> MeetingScorer:
+    return load_scorer(SCORING_CONFIG)
+
+
+def fit_logistic(features: np.ndarray, labels: np.ndarray, l2: float = 1e-3, epochs: int = 2000,
+                 learning_rate: float = 0.5, threshold: float = 0.5) -> MeetingScorer:
+    """
+    Fits the weights by logistic regression with L2 regularization, using full-batch gradient descent.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    weights = np.zeros(features.shape[1])
+    bias = 0.0
+    for _ in range(epochs):
+        probabilities = 1 / (1 + np.exp(-(features @ weights + bias)))
+        error = probabilities - labels
+        weights -= learning_rate * (features.T @ error / len(labels) + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return MeetingScorer(weights=weights, bias=bias, threshold=threshold, logistic=True)
+
+
+def main() -> None:
+    from model.model_registry import get_model
+    from model.patterns import meeting_features
+
+    parser = argparse.ArgumentParser(description="Fits the meeting scorer weights on labeled letters.")
+    parser.add_argument('labeled', help="JSON lines of letters with body, subject, sender and a boolean is_meeting")
+    parser.add_argument('--output', default=SCORING_CONFIG, help="scoring config to write")
+    parser.add_argument('--l2', type=float, default=1e-3)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    with open(args.labeled) as labeled_file:
+        letters = [json.loads(line) for line in labeled_file if line.strip()]
+    docs = get_model().nlp.pipe(letter['body'] for letter in letters)
+    rows, labels = [], []
+    for letter, doc in zip(letters, docs):
+        row, _ = meeting_features(letter, doc)
+        # letters without a time are never meetings, whatever the weights
+        if row is not None:
+            rows.append(row)
+            labels.append(bool(letter['is_meeting']))
+
+    scorer = fit_logistic(np.array(rows), np.array(labels), l2=args.l2, threshold=args.threshold)
+    predicted = scorer.probabilities(np.array(rows)) > scorer.threshold
+    print(f"Fitted on {len(rows)} letters with a time, training accuracy {np.mean(predicted == labels):.3f}")
+    save_scorer(scorer, args.output)
+
+
+if __name__ == '__main__':
+    main()
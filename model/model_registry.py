@@ -0,0 +1,38 @@
+import threading
+
+from model.custom_spacy_model import MySpaCyModel, DEFAULT_MODEL, DEFAULT_PROFILE, LANGUAGE_MODELS
+
+WARM_UP_TEXT = "Let's meet tomorrow at 5 pm in Zoom to discuss the project."
+
+_models: dict[tuple[str, str], MySpaCyModel] = {}
+_lock = threading.Lock()
+
+
+def get_model(model_name: str = DEFAULT_MODEL, profile: str = DEFAULT_PROFILE) -> MySpaCyModel:
+    """
+    Returns the process-wide instance of the model with the given pipeline profile, loading it on first use.
+
+    The model keeps no per-request state, so a single instance can be shared by all threads.
+    """
+    key = (model_name, profile)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                model = MySpaCyModel(model_name, profile)
+                _models[key] = model
+    return model
+
+
+def get_language_model(language: str, profile: str = DEFAULT_PROFILE) -> MySpaCyModel:
+    """
+    Returns the model for letters in `language`, which must be a key of LANGUAGE_MODELS, loading it on first use.
+    """
+    return get_model(LANGUAGE_MODELS[language], profile)
+
+
+def warm_up(model_name: str = DEFAULT_MODEL, profile: str = DEFAULT_PROFILE) -> None:
+    model = get_model(model_name, profile)
+    doc = model.predict(WARM_UP_TEXT)
+    model.classify_event_type(doc)
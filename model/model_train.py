@@ -1,15 +1,44 @@
-import torch
-from datasets import load_dataset
-from custom_spacy_model import MySpaCyModel
+"""
+Fine-tunes the NER on OntoNotes.
 
+Run from the repository root: python -m model.model_train --output models/my_model
+The corpus is converted into DocBin shards in --data-dir on the first run; an interrupted conversion or training
+continues where it stopped when the same command is run again.
+"""
+import argparse
+import logging
+import os
 
-def train_model():
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    train_data = load_dataset("conll2012_ontonotesv5", "english_v4")['train']
-    train_data = train_data.to(device)
-    model = MySpaCyModel().to(device)
-    model.fit(train_data)
+from model.custom_spacy_model import MySpaCyModel, DEFAULT_MODEL
+from model.training_data import SHARD_SIZE, convert_ontonotes, list_shards
+
+
+def train_model(output_dir: str, data_dir: str = 'training_data', checkpoint_dir: str = 'checkpoints', epochs: int = 10,
+                seed: int = 0, model_name: str = DEFAULT_MODEL, shard_size: int = SHARD_SIZE,
+                workers: int = os.cpu_count() or 1) -> None:
+    shards = list_shards(data_dir)
+    if not shards or os.path.exists(os.path.join(data_dir, 'converting')):
+        # the marker tells a rerun that the last conversion may have stopped before the final shard
+        os.makedirs(data_dir, exist_ok=True)
+        open(os.path.join(data_dir, 'converting'), 'w').close()
+        shards = convert_ontonotes(data_dir, shard_size=shard_size, workers=workers)
+        os.remove(os.path.join(data_dir, 'converting'))
+
+    model = MySpaCyModel(model_name)
+    model.fit(shards, output_dir, checkpoint_dir=checkpoint_dir, epochs=epochs, seed=seed)
 
 
 if __name__ == '__main__':
-    train_model()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', required=True, help='directory for the trained pipeline')
+    parser.add_argument('--data-dir', default='training_data', help='directory of the DocBin shards')
+    parser.add_argument('--checkpoint-dir', default='checkpoints')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    train_model(args.output, args.data_dir, args.checkpoint_dir, args.epochs, args.seed, args.model,
+                args.shard_size, args.workers)
@@ -1,4 +1,30 @@
 import re
+from collections import Counter
+from dataclasses import dataclass
+
+import numpy as np
+
+from model.meeting_scorer import FEATURES, MeetingScorer, get_scorer
+
+SENDER_TITLE_KEYWORDS = ["manager", "coordinator", "secretary", "director", "HR", "head"]
+VIDEO_CONFERENCING_TOOLS = ["zoom", "google meet", "google hangouts", "microsoft teams",
+                            "teams",  # in case "teams" is used without "Microsoft"
+                            "skype", "webex", "gotomeeting", "bluejeans"]
+CALENDARING_PHRASES = [
+    "add to your calendar", "RSVP", "send a calendar invite", "save the date", "schedule", "arrange", "organize",
+    "plan", "discuss", "call", "meet"
+]
+CONDITIONAL_PHRASES = [
+    "if you are available", "should you be able to", "if it fits your schedule"
+]
+CONFIRMATORY_PHRASES = [
+    "please confirm", "kindly confirm", "let me know", "confirm your attendance", "waiting for your reply"
+]
+MEETING_KEYWORDS = ["meeting", "appointment", "schedule", "call", "conference", "discussion", "webinar"]
+
+# One group per tool: a single pass finds every mention, and the group number tells which tool matched
+VIDEO_CONFERENCING_REGEX = re.compile(r'\b(?:' + '|'.join(f'({re.escape(tool)})' for tool in VIDEO_CONFERENCING_TOOLS)
+                                      + r')\b', re.IGNORECASE)
 
 
 def contains_date_entity(entities):
@@ -17,7 +43,6 @@ def contains_multiple_persons(entities):
 
 
 def check_sender_recipient_info(email_info: str, doc):
-    keywords = ["manager", "coordinator", "secretary", "director", "HR", "head"]
     sender_title = email_info.split()[-1]
     recipient_title = email_info.split()[:-1]
 
@@ -26,22 +51,12 @@ def check_sender_recipient_info(email_info: str, doc):
     recipient_spans = [span for span in doc.ents if span.text == " ".join(recipient_title)]
 
     # Check if any of the spans match the keywords
-    return any(keyword in span.text for keyword in keywords for span in sender_spans) or \
-        any(keyword in span.text for keyword in keywords for span in recipient_spans)
+    return any(keyword in span.text for keyword in SENDER_TITLE_KEYWORDS for span in sender_spans) or \
+        any(keyword in span.text for keyword in SENDER_TITLE_KEYWORDS for span in recipient_spans)
 
 
 def contains_video_conferencing_ref(text):
-    video_conferencing_patterns = [
-        r'\b(zoom)\b',
-        r'\b(google meet)\b',
-        r'\b(google hangouts)\b',
-        r'\b(microsoft teams)\b',
-        r'\b(teams)\b',  # in case "teams" is used without "Microsoft"
-        r'\b(skype)\b',
-        r'\b(webex)\b',
-        r'\b(gotomeeting)\b',
-        r'\b(bluejeans)\b'
-    ]
+    video_conferencing_patterns = [rf'\b({re.escape(tool)})\b' for tool in VIDEO_CONFERENCING_TOOLS]
 
     for pattern in video_conferencing_patterns:
         match = re.search(pattern, text, re.IGNORECASE)
@@ -52,39 +67,158 @@ def contains_video_conferencing_ref(text):
 
 
 def check_calendaring_phrases(text):
-    calendaring_phrases = [
-        "add to your calendar", "RSVP", "send a calendar invite", "save the date", "schedule", "arrange", "organize",
-        "plan", "discuss", "call", "meet"
-    ]
-    return any(phrase in text.lower() for phrase in calendaring_phrases)
+    return any(phrase in text.lower() for phrase in CALENDARING_PHRASES)
 
 
 def check_conditional_statements(text):
-    conditional_phrases = [
-        "if you are available", "should you be able to", "if it fits your schedule"
-    ]
-    return any(phrase in text.lower() for phrase in conditional_phrases)
+    return any(phrase in text.lower() for phrase in CONDITIONAL_PHRASES)
 
 
 def check_confirmatory_closures(text):
-    confirmatory_phrases = [
-        "please confirm", "kindly confirm", "let me know", "confirm your attendance", "waiting for your reply"
-    ]
-    return any(phrase in text.lower() for phrase in confirmatory_phrases)
+    return any(phrase in text.lower() for phrase in CONFIRMATORY_PHRASES)
 
 
 def contains_location_or_tool(entities, text):
-    meeting_tools = ["zoom", "google meet", "google hangouts", "microsoft teams", "teams", "skype", "webex",
-                     "gotomeeting", "bluejeans"]
     has_location = any(label == 'LOC' for _, label in entities)
-    has_tool = any(tool in text.lower() for tool in meeting_tools)
+    has_tool = any(tool in text.lower() for tool in VIDEO_CONFERENCING_TOOLS)
     return has_location or has_tool
 
 
 def check_subject_and_body_for_meeting(subject, body):
-    meeting_keywords = ["meeting", "appointment", "schedule", "call", "conference", "discussion", "webinar"]
-    return any(keyword in subject.lower() for keyword in meeting_keywords) or any(
-        keyword in body.lower() for keyword in meeting_keywords)
+    return any(keyword in subject.lower() for keyword in MEETING_KEYWORDS) or any(
+        keyword in body.lower() for keyword in MEETING_KEYWORDS)
+
+
+@dataclass(frozen=True)
+class EntityFeatures:
+    has_time: bool
+    has_date: bool
+    has_location: bool
+    multiple_persons: bool
+    sender_recipient: bool
+
+
+@dataclass(frozen=True)
+class TextFeatures:
+    calendaring_phrases: bool
+    conditional_statements: bool
+    confirmatory_closures: bool
+    meeting_tool: bool
+    meeting_keywords: bool
+    reference: str | None
+
+
+def extract_entity_features(doc, sender: str) -> EntityFeatures:
+    """
+    Collects every entity-based feature in a single walk over the document entities.
+    """
+    sender_parts = sender.split()
+    sender_title = sender_parts[-1]
+    recipient_title = " ".join(sender_parts[:-1])
+    titles = {title for title in (sender_title, recipient_title)
+              if any(keyword in title for keyword in SENDER_TITLE_KEYWORDS)}
+
+    labels = Counter()
+    sender_recipient = False
+    for ent in doc.ents:
+        labels[ent.label_] += 1
+        sender_recipient = sender_recipient or ent.text in titles
+
+    return EntityFeatures(
+        has_time=labels['TIME'] > 0,
+        has_date=labels['DATE'] > 0,
+        has_location=labels['LOC'] > 0,
+        # the ru_core_news pipelines label persons PER
+        multiple_persons=labels['PERSON'] + labels['PER'] > 2,
+        sender_recipient=sender_recipient,
+    )
+
+
+def find_video_conferencing_ref(text: str) -> str | None:
+    reference = None
+    priority = len(VIDEO_CONFERENCING_TOOLS)
+    # the earliest tool in the list wins, like in contains_video_conferencing_ref
+    for match in VIDEO_CONFERENCING_REGEX.finditer(text):
+        if match.lastindex - 1 < priority:
+            reference, priority = match.group(match.lastindex), match.lastindex - 1
+            if priority == 0:
+                break
+    return reference
+
+
+def extract_text_features(subject: str, body: str) -> TextFeatures:
+    """
+    Collects every phrase-based feature, lowering the body only once.
+    """
+    text = body.lower()
+    return TextFeatures(
+        calendaring_phrases=any(phrase in text for phrase in CALENDARING_PHRASES),
+        conditional_statements=any(phrase in text for phrase in CONDITIONAL_PHRASES),
+        confirmatory_closures=any(phrase in text for phrase in CONFIRMATORY_PHRASES),
+        meeting_tool=any(tool in text for tool in VIDEO_CONFERENCING_TOOLS),
+        meeting_keywords=any(keyword in subject.lower() for keyword in MEETING_KEYWORDS) or any(
+            keyword in text for keyword in MEETING_KEYWORDS),
+        reference=find_video_conferencing_ref(body),
+    )
+
+
+def meeting_features(email_dict, doc) -> tuple[list[bool] | None, str | None]:
+    """
+    Returns the feature row of the letter in the order of meeting_scorer.FEATURES and its video conferencing reference.
+
+    Letters without a time are never meetings, so their phrase features are not computed and the row is None.
+    """
+    entity_features = extract_entity_features(doc, email_dict['sender'])
+    if not entity_features.has_time:
+        return None, None
+    text_features = extract_text_features(email_dict['subject'], email_dict['body'])
+    return [
+        entity_features.has_date,
+        entity_features.sender_recipient,
+        text_features.calendaring_phrases,
+        text_features.conditional_statements,
+        text_features.confirmatory_closures,
+        entity_features.has_location or text_features.meeting_tool,
+        entity_features.multiple_persons,
+        text_features.meeting_keywords,
+        text_features.reference is not None,
+    ], text_features.reference
+
+
+def get_meeting_probabilities(email_dicts, docs, scorer: MeetingScorer | None = None):
+    """
+    Scores a batch of letters with one matrix product of their features and the scorer weights.
+
+    Args:
+        email_dicts (list): Dictionaries containing the email information.
+        docs (list): spaCy Doc objects of the email texts, in the same order.
+        scorer (MeetingScorer): Weights and threshold, by default those of the scoring config.
+
+    Returns:
+        list: One dictionary per letter with is_meeting, probability, reference and persons.
+    """
+    scorer = scorer or get_scorer()
+    results = [{"is_meeting": False, "probability": 0, "is_ref": None, "persons": None} for _ in email_dicts]
+    rows, indices, references = [], [], []
+    for index, (email_dict, doc) in enumerate(zip(email_dicts, docs)):
+        row, reference = meeting_features(email_dict, doc)
+        if row is not None:
+            rows.append(row)
+            indices.append(index)
+            references.append(reference)
+    if not rows:
+        return results
+
+    features = np.array(rows, dtype=np.float64)
+    probabilities = scorer.probabilities(features)
+    for index, row, probability, reference in zip(indices, features, probabilities.tolist(), references):
+        results[index] = {
+            "is_meeting": probability > scorer.threshold,
+            "probability": probability,
+            "reference": reference,
+            "persons": bool(row[FEATURES.index('multiple_persons')]),
+        }
+    return results
 
 
 def get_meeting_probability(email_dict, doc):
@@ -96,58 +230,6 @@ def get_meeting_probability(email_dict, doc):
         doc (Doc): A spaCy Doc object containing the processed email text.
 
     Returns:
-        tuple: A tuple containing a boolean indicating if the probability is above the threshold and the calculated probability score.
+        dict: is_meeting, whether the probability is above the threshold, and the probability itself.
     """
-    text = email_dict['body']
-
-    probability_score = 0
-    sender_recipient_score = 0.02
-    data_score = 0.1
-    calendaring_phrases_score = 0.02
-    conditional_statements_score = 0.03
-    confirmatory_closures_score = 0.02
-    meeting_tools_locations_score = 0.1
-    persons = 0.13
-    subject = 0.12
-    ref = 0.2
-
-    entities = [(ent.text, ent.label_) for ent in doc.ents]
-
-    if not contains_time_entity(entities):
-        data = {
-            "is_meeting": False,
-            "probability": 0,
-            "is_ref": None,
-            "persons": None
-        }
-        return data
-
-    if contains_date_entity(entities):
-        probability_score += data_score
-    if check_sender_recipient_info(email_dict['sender'], doc):
-        probability_score += sender_recipient_score
-    if check_calendaring_phrases(text):
-        probability_score += calendaring_phrases_score
-    if check_conditional_statements(text):
-        probability_score += conditional_statements_score
-    if check_confirmatory_closures(text):
-        probability_score += confirmatory_closures_score
-    if contains_location_or_tool(entities, text):
-        probability_score += meeting_tools_locations_score
-    if contains_multiple_persons(entities):
-        probability_score += persons
-    if check_subject_and_body_for_meeting(email_dict['subject'], text):
-        probability_score += subject
-    if contains_video_conferencing_ref(text) is not None:
-        probability_score += ref
-
-    threshold = 0.15
-
-    data = {
-        "is_meeting": probability_score > threshold,
-        "probability": probability_score,
-        "reference": contains_video_conferencing_ref(text),
-        "persons": contains_multiple_persons(entities)
-    }
-
-    return data
+    return get_meeting_probabilities([email_dict], [doc])[0]
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from datetime import date
+from functools import cache
+from pathlib import Path
+from typing import Any, Callable
+
+from model.custom_spacy_model import LANGUAGE_MODELS
+from model.date_parsing import letter_sent_time
+from model.meeting_scorer import get_scorer
+from model.model_registry import get_language_model
+from utils.storage import get_cached_predictions, purge_cached_predictions, save_cached_predictions
+
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 100000))  # entries
+
+MODEL_DIR = Path(__file__).parent
+# a change in any of these files changes the predictions, so it starts a new cache version
+VERSIONED_FILES = ['custom_spacy_model.py', 'date_parsing.py', 'language.py', 'main_model.py', 'meeting_scorer.py',
+                   'patterns.py']
+
+Prediction = dict[str, Any] | None
+
+
+@cache
+def prediction_version(language: str) -> str:
+    """
+    Fingerprints everything a prediction of a letter in `language` depends on: the pipeline of the language, the
+    scoring weights and the code that scores and parses.
+
+    Only the pipeline of `language` is loaded. Entries of other versions for the same language are dropped the first
+    time the version is computed in a process.
+    """
+    model = get_language_model(language)
+    digest = hashlib.sha256(json.dumps([model.model_name, model.nlp.meta.get('version'), model.nlp.pipe_names,
+                                        get_scorer().to_config()]).encode())
+    for file_name in VERSIONED_FILES:
+        digest.update(MODEL_DIR.joinpath(file_name).read_bytes())
+    version = f'{language}:{digest.hexdigest()}'
+    purge_cached_predictions(version, scope=f'{language}:')
+    return version
+
+
+def cache_key(letter: dict[str, str], version: str) -> str:
+    # relative dates such as "tomorrow" resolve against the time the letter was sent, or the current day if its Date
+    # header cannot be read, so that time is part of the key
+    body = ' '.join(letter['body'].split())
+    sent = letter_sent_time(letter.get('send_date'))
+    anchor = sent.isoformat() if sent is not None else date.today().isoformat()
+    content = [letter.get('subject'), letter.get('sender'), body, version, anchor]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+def cached_prediction(letters: dict[str, dict[str, str]],
+                      predict: Callable[[dict[str, dict[str, str]]], dict[str, dict[str, Any]]],
+                      language: str) -> dict[str, dict[str, Any]]:
+    """
+    Runs `predict` only on the letters in `language` whose content has not been predicted yet.
+
+    Letters without a meeting are cached too, so a repeated newsletter never reaches the model again.
+    """
+    version = prediction_version(language)
+    keys = {email_id: cache_key(letter, version) for email_id, letter in letters.items()}
+    cached = get_cached_predictions(list(set(keys.values())))
+
+    predictions = {}
+    misses = {}
+    for email_id, letter in letters.items():
+        if keys[email_id] not in cached:
+            misses[email_id] = letter
+            continue
+        prediction: Prediction = json.loads(cached[keys[email_id]])
+        if prediction is not None:
+            predictions[email_id] = prediction
+
+    if misses:
+        new_predictions = predict(misses)
+        predictions.update(new_predictions)
+        save_cached_predictions({keys[email_id]: json.dumps(new_predictions.get(email_id)) for email_id in misses},
+                                version, PREDICTION_CACHE_SIZE)
+    return {email_id: predictions[email_id] for email_id in letters if email_id in predictions}
@@ -0,0 +1,83 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Any
+
+from model.patterns import MEETING_KEYWORDS, extract_text_features
+
+# 0 lets every letter through to the model
+PREFILTER_THRESHOLD = float(os.getenv('PREFILTER_THRESHOLD', 0.5))
+
+SUBJECT_CUES = MEETING_KEYWORDS + ["invitation", "invite", "agenda", "sync", "interview", "reminder", "demo",
+                                   "catch up", "встреч", "созвон", "собеседование", "приглашение"]
+# A letter without a TIME entity is never a meeting, so a time expression alone passes the default threshold
+PREFILTER_WEIGHTS = {
+    'time_expression': 0.5,
+    'meeting_tool': 0.2,
+    'subject_cue': 0.15,
+    'meeting_keywords': 0.15,
+    'conditional_statements': 0.1,
+    'calendaring_phrases': 0.05,
+    'confirmatory_closures': 0.05,
+}
+
+TIME_EXPRESSION_REGEX = re.compile(
+    r"\b\d{1,2}[:.]\d{2}\b"  # 17:30, 9.30
+    r"|\b\d{1,2}\s*[ap]\.?m\b"  # 5 pm, 5p.m.
+    r"|o'clock"
+    r"|\b(?:noon|midnight|morning|afternoon|evening|tonight)\b"
+    r"|\b(?:\d+|an?|one|two|three|half an)\s+(?:hours?|minutes?|mins?)\b"
+    r"|\b(?:утра|дня|вечера|ночи|полдень|полночь)\b",
+    re.IGNORECASE,
+)
+
+
+def prefilter_score(letter: dict[str, str]) -> float:
+    """
+    Scores how likely a letter is to describe a meeting using only regexes and keyword lists, without spaCy.
+    """
+    subject = letter.get('subject') or ''
+    text_features = extract_text_features(subject, letter['body'])
+    lowered_subject = subject.lower()
+    signals = {
+        'time_expression': TIME_EXPRESSION_REGEX.search(letter['body']) is not None,
+        'meeting_tool': text_features.meeting_tool,
+        'subject_cue': any(cue in lowered_subject for cue in SUBJECT_CUES),
+        'meeting_keywords': text_features.meeting_keywords,
+        'conditional_statements': text_features.conditional_statements,
+        'calendaring_phrases': text_features.calendaring_phrases,
+        'confirmatory_closures': text_features.confirmatory_closures,
+    }
+    return sum(PREFILTER_WEIGHTS[signal] for signal, passed in signals.items() if passed)
+
+
+def is_candidate(letter: dict[str, str], threshold: float = PREFILTER_THRESHOLD) -> bool:
+    return threshold <= 0 or prefilter_score(letter) >= threshold
+
+
+@dataclass
+class PrefilterReport:
+    threshold: float
+    letters: int
+    passed: int
+    meetings: int
+    kept_meetings: int
+
+    @property
+    def pass_rate(self) -> float:
+        return self.passed / self.letters if self.letters else 1.0
+
+    @property
+    def recall(self) -> float:
+        return self.kept_meetings / self.meetings if self.meetings else 1.0
+
+
+def prefilter_report(letters: dict[str, dict[str, str]], predictions: dict[str, Any],
+                     threshold: float = PREFILTER_THRESHOLD) -> PrefilterReport:
+    """
+    Compares the pre-filter with `predictions` of the full pipeline: recall is the share of predicted meetings
+    the filter lets through, pass rate is the share of letters that still reach the model.
+    """
+    passed = {email_id for email_id, letter in letters.items() if is_candidate(letter, threshold)}
+    return PrefilterReport(threshold=threshold, letters=len(letters), passed=len(passed), meetings=len(predictions),
+                           kept_meetings=len(passed & set(predictions)))
@@ -0,0 +1,129 @@
+import itertools
+import os
+import random
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import spacy
+from spacy.tokens import Doc, DocBin, Span
+from spacy.training import Example
+from spacy.vocab import Vocab
+
+ONTONOTES = ("conll2012_ontonotesv5", "english_v4")
+SHARD_SIZE = 5000  # sentences per shard, which bounds the memory of conversion and training
+SHARD_PATTERN = "shard-{:05d}.spacy"
+
+Sentence = tuple[list[str], list[str]]
+
+
+def iob_to_spans(tags: list[str]) -> list[tuple[int, int, str]]:
+    """
+    Converts IOB tags such as ["B-PERSON", "I-PERSON", "O"] into (start, end, label) token spans.
+
+    An I- tag that does not continue a span of the same label starts a new one.
+    """
+    spans: list[tuple[int, int, str]] = []
+    start: int | None = None
+    label: str | None = None
+    for index, tag in enumerate([*tags, "O"]):
+        prefix, _, tag_label = tag.partition("-")
+        if start is not None and label is not None and (prefix != "I" or tag_label != label):
+            spans.append((start, index, label))
+            start, label = None, None
+        if prefix in ("B", "I") and start is None:
+            start, label = index, tag_label
+    return spans
+
+
+def sentence_to_doc(vocab: Vocab, words: list[str], tags: list[str]) -> Doc:
+    doc = Doc(vocab, words=words)
+    doc.ents = [Span(doc, start, end, label=label) for start, end, label in iob_to_spans(tags)]
+    return doc
+
+
+def write_shard(path: Path, sentences: list[Sentence]) -> int:
+    """
+    Saves the sentences as a DocBin, writing to a temporary file first so a shard on disk is always complete.
+    """
+    vocab = spacy.blank("en").vocab
+    doc_bin = DocBin(attrs=["ORTH", "ENT_IOB", "ENT_TYPE"])
+    for words, tags in sentences:
+        doc_bin.add(sentence_to_doc(vocab, words, tags))
+    temporary_path = path.with_suffix(".tmp")
+    doc_bin.to_disk(temporary_path)
+    temporary_path.replace(path)
+    return len(sentences)
+
+
+def list_shards(data_dir: str | Path) -> list[Path]:
+    return sorted(Path(data_dir).glob(SHARD_PATTERN.replace("{:05d}", "*")))
+
+
+def _ontonotes_sentences(split: str) -> Iterator[Sentence]:
+    from datasets import load_dataset
+
+    dataset = load_dataset(*ONTONOTES, split=split)
+    tag_names = dataset.features["sentences"][0]["named_entities"].feature.names
+    for document in dataset:
+        for sentence in document["sentences"]:
+            yield sentence["words"], [tag_names[tag] for tag in sentence["named_entities"]]
+
+
+def convert_ontonotes(data_dir: str | Path, split: str = "train", shard_size: int = SHARD_SIZE,
+                      workers: int = os.cpu_count() or 1) -> list[Path]:
+    """
+    Converts an OntoNotes split into DocBin shards of `shard_size` sentences, built by `workers` processes.
+
+    Shards already on disk are kept, so an interrupted conversion continues where it stopped.
+    """
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return write_shards(data_dir, _ontonotes_sentences(split), shard_size, workers)
+
+
+def write_shards(data_dir: Path, sentences: Iterable[Sentence], shard_size: int = SHARD_SIZE,
+                 workers: int = os.cpu_count() or 1) -> list[Path]:
+    pending: list[Future[int]] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        shard: list[Sentence] = []
+        shard_index = 0
+        for sentence in itertools.chain(sentences, [None]):
+            if sentence is not None:
+                shard.append(sentence)
+                if len(shard) < shard_size:
+                    continue
+            if shard:
+                path = data_dir / SHARD_PATTERN.format(shard_index)
+                if not path.exists():
+                    # at most two shards per worker are held in memory at a time
+                    while len(pending) >= 2 * workers:
+                        pending.pop(0).result()
+                    pending.append(pool.submit(write_shard, path, shard))
+                shard_index += 1
+                shard = []
+        for future in pending:
+            future.result()
+    return list_shards(data_dir)
+
+
+def shard_order(shards: list[Path], seed: int, epoch: int) -> list[Path]:
+    """
+    Shuffles the shards the same way for the same seed and epoch, so a resumed run sees the same order.
+    """
+    order = sorted(shards)
+    random.Random(f"{seed}-{epoch}").shuffle(order)
+    return order
+
+
+def read_examples(nlp: spacy.Language, path: Path, seed: int, epoch: int) -> list[Example]:
+    """
+    Loads one shard as training examples, shuffled the same way for the same seed and epoch.
+    """
+    examples = []
+    for reference in DocBin().from_disk(path).get_docs(nlp.vocab):
+        predicted = Doc(nlp.vocab, words=[token.text for token in reference],
+                        spaces=[bool(token.whitespace_) for token in reference])
+        examples.append(Example(predicted, reference))
+    random.Random(f"{seed}-{epoch}-{path.name}").shuffle(examples)
+    return examples
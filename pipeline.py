@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+
+from gmail import GMAIL_BATCH_SIZE, fetch_raw_messages, parse_letter, sync_message_ids
+from google_calendar import CALENDAR_BATCH_SIZE, CALENDAR_LOG_HEADER, add_events
+from model.main_model import letters_prediction
+from utils.api_utils import AppType, account_key, create_service
+from utils.error_handling import http_error_catcher
+from utils.metrics import EMAILS_FETCHED, EMAILS_PREDICTED, EMAILS_SKIPPED, STAGE_SECONDS
+from utils.storage import save_history_id
+
+STOP = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PipelineConfig:
+    fetch_batch_size: int = GMAIL_BATCH_SIZE
+    fetch_concurrency: int = int(os.getenv('PIPELINE_FETCH_CONCURRENCY', 2))
+    parse_concurrency: int = int(os.getenv('PIPELINE_PARSE_CONCURRENCY', 2))
+    predict_batch_size: int = int(os.getenv('PIPELINE_PREDICT_BATCH_SIZE', 8))
+    predict_concurrency: int = int(os.getenv('PIPELINE_PREDICT_CONCURRENCY', 1))
+    calendar_batch_size: int = CALENDAR_BATCH_SIZE
+    calendar_concurrency: int = int(os.getenv('PIPELINE_CALENDAR_CONCURRENCY', 2))
+    queue_size: int = int(os.getenv('PIPELINE_QUEUE_SIZE', 64))
+
+
+Stage = Callable[[asyncio.Queue[Any], asyncio.Queue[Any]], Coroutine[Any, Any, None]]
+
+
+async def _run_stage(worker: Stage, workers: int, queue_in: asyncio.Queue[Any], queue_out: asyncio.Queue[Any],
+                     downstream_workers: int = 0) -> None:
+    """
+    Runs `workers` copies of a stage and passes one STOP marker per downstream worker once they all finish.
+    """
+    async with asyncio.TaskGroup() as group:
+        for _ in range(workers):
+            group.create_task(worker(queue_in, queue_out))
+    for _ in range(downstream_workers):
+        await queue_out.put(STOP)
+
+
+async def _get_batch(queue: asyncio.Queue[Any], batch_size: int) -> tuple[list[Any], bool]:
+    """
+    Waits for an item and takes up to `batch_size` items that are ready; returns them and whether STOP was reached.
+    """
+    batch: list[Any] = []
+    item = await queue.get()
+    while item is not STOP:
+        batch.append(item)
+        if len(batch) >= batch_size or queue.empty():
+            break
+        item = queue.get_nowait()
+    return batch, item is STOP
+
+
+async def run_pipeline(creds: Credentials, config: PipelineConfig | None = None,
+                       executor: Executor | None = None) -> tuple[int, str]:
+    """
+    Processes new letters in overlapping stages: fetch -> parse -> predict -> calendar insert.
+
+    The stages are connected by bounded queues, so a letter reaches the calendar as soon as it is predicted, while
+    the next letters are still being downloaded. Blocking API calls run in threads and NLP runs in `executor`.
+    The history id is stored only once every stage has finished and every letter was downloaded and written to the
+    calendar, as in the serial script. Returns the number of new letters and the calendar log.
+    """
+    config = config or PipelineConfig()
+    loop = asyncio.get_running_loop()
+    account = account_key(creds)
+
+    message_ids: list[str] = []
+    with http_error_catcher():
+        gmail_service = create_service(creds, app=AppType.GMAIL)
+        message_ids, history_id = await asyncio.to_thread(sync_message_ids, gmail_service, account)
+        if not message_ids:
+            save_history_id(account, history_id)
+    if not message_ids:
+        return 0, 'No new letters.'
+
+    chunks: asyncio.Queue[Any] = asyncio.Queue()
+    raw_messages: asyncio.Queue[Any] = asyncio.Queue(config.queue_size)
+    letters: asyncio.Queue[Any] = asyncio.Queue(config.queue_size)
+    predictions: asyncio.Queue[Any] = asyncio.Queue(config.queue_size)
+    logs: asyncio.Queue[Any] = asyncio.Queue()
+    failed_ids: list[str] = []
+    unwritten_ids: list[str] = []
+    letter_count = 0
+
+    for start in range(0, len(message_ids), config.fetch_batch_size):
+        chunks.put_nowait(message_ids[start:start + config.fetch_batch_size])
+    for _ in range(config.fetch_concurrency):
+        chunks.put_nowait(STOP)
+
+    def fetch_chunk(chunk: list[str]) -> dict[str, str]:
+        with STAGE_SECONDS.time(stage='fetch'):
+            try:
+                raw_messages, chunk_failed_ids = fetch_raw_messages(create_service(creds, app=AppType.GMAIL), chunk)
+            except HttpError as error:
+                logger.error("An error occurred: %s", error)
+                raw_messages, chunk_failed_ids = {}, chunk
+        failed_ids.extend(chunk_failed_ids)
+        return raw_messages
+
+    def parse_raw(raw_message: str) -> dict[str, str] | None:
+        with STAGE_SECONDS.time(stage='parse'):
+            return parse_letter(raw_message)
+
+    def insert_events(batch: list[tuple[str, dict[str, Any], dict[str, str]]]) -> str:
+        batch_predictions = {email_id: prediction for email_id, prediction, _ in batch}
+        batch_letters = {email_id: letter for email_id, _, letter in batch}
+        with STAGE_SECONDS.time(stage='calendar'):
+            log, _, batch_failed_ids = add_events(create_service(creds, app=AppType.CALENDAR), batch_predictions,
+                                                  batch_letters, config.calendar_batch_size)
+        unwritten_ids.extend(batch_failed_ids)
+        return log.removeprefix(CALENDAR_LOG_HEADER)
+
+    async def fetch(queue_in: asyncio.Queue[Any], queue_out: asyncio.Queue[Any]) -> None:
+        while (chunk := await queue_in.get()) is not STOP:
+            for item in (await asyncio.to_thread(fetch_chunk, chunk)).items():
+                await queue_out.put(item)
+
+    async def parse(queue_in: asyncio.Queue[Any], queue_out: asyncio.Queue[Any]) -> None:
+        nonlocal letter_count
+        while (item := await queue_in.get()) is not STOP:
+            message_id, raw_message = item
+            letter = await asyncio.to_thread(parse_raw, raw_message)
+            if letter is not None:
+                letter_count += 1
+                EMAILS_FETCHED.inc()
+                await queue_out.put((message_id, letter))
+
+    async def predict(queue_in: asyncio.Queue[Any], queue_out: asyncio.Queue[Any]) -> None:
+        stopped = False
+        while not stopped:
+            items, stopped = await _get_batch(queue_in, config.predict_batch_size)
+            batch = dict(items)
+            if batch:
+                # a letter whose date or time cannot be read is skipped by letters_prediction, not the whole batch
+                with STAGE_SECONDS.time(stage='predict'):
+                    batch_predictions = await loop.run_in_executor(executor, letters_prediction, batch)
+                EMAILS_PREDICTED.inc(len(batch))
+                EMAILS_SKIPPED.inc(len(batch) - len(batch_predictions))
+                for message_id, prediction in batch_predictions.items():
+                    await queue_out.put((message_id, prediction, batch[message_id]))
+
+    async def insert(queue_in: asyncio.Queue[Any], queue_out: asyncio.Queue[Any]) -> None:
+        stopped = False
+        while not stopped:
+            batch, stopped = await _get_batch(queue_in, config.calendar_batch_size)
+            if batch:
+                await queue_out.put(await asyncio.to_thread(insert_events, batch))
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(_run_stage(fetch, config.fetch_concurrency, chunks, raw_messages, config.parse_concurrency))
+        group.create_task(_run_stage(parse, config.parse_concurrency, raw_messages, letters,
+                                     config.predict_concurrency))
+        group.create_task(_run_stage(predict, config.predict_concurrency, letters, predictions,
+                                     config.calendar_concurrency))
+        group.create_task(_run_stage(insert, config.calendar_concurrency, predictions, logs))
+
+    if failed_ids:
+        logger.warning("Keeping the history id of account %s, %s letters could not be downloaded", account,
+                       len(failed_ids))
+    elif unwritten_ids:
+        logger.warning("Keeping the history id of account %s, %s events could not be written", account,
+                       len(unwritten_ids))
+    else:
+        save_history_id(account, history_id)
+    return letter_count, CALENDAR_LOG_HEADER + ''.join(logs.get_nowait() for _ in range(logs.qsize()))
@@ -0,0 +1,145 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    key: str
+    func: Callable[[], int]
+    interval: float
+    next_run: float
+    running: bool = False
+    cancelled: bool = False
+    last_duration: float = 0.0
+    runs: int = 0
+
+
+class Scheduler:
+    """
+    Runs one periodic job per account on a fixed-size worker pool.
+
+    A job returns the number of new letters it found: its interval shrinks towards `min_period` while mail keeps
+    arriving and grows towards `max_period` while the mailbox is idle. A job never overlaps with itself, a cycle
+    that overran its interval delays the next one by its own duration, and due jobs wait while every worker is busy.
+    """
+
+    def __init__(self, max_workers: int = 4, period: float = 30, min_period: float | None = None,
+                 max_period: float | None = None, jitter: float = 0.1) -> None:
+        self.max_workers = max_workers
+        self.period = period
+        self.min_period = min_period if min_period is not None else period / 2
+        self.max_period = max_period if max_period is not None else period * 10
+        self.jitter = jitter
+        self._jobs: dict[str, Job] = {}
+        self._active = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler')
+        self._thread: threading.Thread | None = None
+
+    def schedule(self, key: str, func: Callable[[], int]) -> bool:
+        """
+        Adds a job for `key`; returns False if the key already has one.
+
+        A job cancelled while running is taken over by the new one, which starts once the running cycle ends.
+        """
+        with self._condition:
+            job = self._jobs.get(key)
+            if job is not None:
+                if not job.cancelled:
+                    return False
+                job.func, job.cancelled = func, False
+                return True
+            self._start()
+            first_run = time.monotonic() + random.uniform(0, self.jitter * self.period)
+            self._jobs[key] = Job(key=key, func=func, interval=self.period, next_run=first_run)
+            self._condition.notify()
+            return True
+
+    def cancel(self, key: str) -> bool:
+        """
+        Removes the job of `key`, or after its current cycle if it is running; returns False if there is none.
+        """
+        with self._condition:
+            job = self._jobs.get(key)
+            if job is None or job.cancelled:
+                return False
+            if job.running:
+                job.cancelled = True
+            else:
+                del self._jobs[key]
+            return True
+
+    def jobs(self) -> list[Job]:
+        with self._condition:
+            return [job for job in self._jobs.values() if not job.cancelled]
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def _dispatch(self) -> None:
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                waiting = [job for job in self._jobs.values() if not job.running]
+                due = sorted((job for job in waiting if job.next_run <= now), key=lambda job: job.next_run)
+                for job in due[:self.max_workers - self._active]:
+                    job.running = True
+                    self._active += 1
+                    self._executor.submit(self._run, job)
+
+                waiting = [job for job in waiting if not job.running]
+                timeout = None
+                if self._active < self.max_workers and waiting:
+                    timeout = max(0.0, min(job.next_run for job in waiting) - now)
+                self._condition.wait(timeout)
+
+    def _run(self, job: Job) -> int:
+        start_time = time.monotonic()
+        new_letters = 0
+        try:
+            new_letters = job.func()
+        except Exception:
+            logger.exception("Job %s failed", job.key)
+        finally:
+            with self._condition:
+                self._reschedule(job, new_letters, start_time)
+                self._condition.notify()
+        return new_letters
+
+    def _reschedule(self, job: Job, new_letters: int, start_time: float) -> None:
+        end_time = time.monotonic()
+        job.running = False
+        job.runs += 1
+        job.last_duration = end_time - start_time
+        self._active -= 1
+        if job.cancelled:
+            del self._jobs[job.key]
+            return
+        if new_letters > 0:
+            job.interval = max(self.min_period, job.interval / 2)
+        else:
+            job.interval = min(self.max_period, job.interval * 1.5)
+
+        if job.last_duration > job.interval:
+            next_run = end_time + job.last_duration
+        else:
+            next_run = start_time + job.interval
+        job.next_run = next_run + random.uniform(0, self.jitter * job.interval)
@@ -1,45 +1,100 @@
-from utils.api_utils import create_service, AppType
+from utils.api_utils import create_service, AppType, account_key
 from google_calendar import add_event
-from gmail import get_letters
+from gmail import sync_letters
 from google.oauth2.credentials import Credentials
 from model.main_model import letters_prediction
+from pipeline import run_pipeline
+from utils.credential_store import CredentialStore
+from utils.metrics import EMAILS_FETCHED, EMAILS_PREDICTED, EMAILS_SKIPPED, STAGE_SECONDS
+from utils.storage import save_history_id
 
+import asyncio
+import logging
 import os.path
-from google.auth.transport.requests import Request
+from dataclasses import dataclass
 from google_auth_oauthlib.flow import InstalledAppFlow
 SCOPES = ['https://www.googleapis.com/auth/calendar', 'https://www.googleapis.com/auth/gmail.readonly']
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'serial')  # 'serial' or 'async'
+
+logger = logging.getLogger(__name__)
+
+
+def _authorize() -> Credentials:
+    flow = InstalledAppFlow.from_client_secrets_file('auth/credentials.json', SCOPES)
+    creds = flow.run_local_server(port=0)
+    with open('auth/token.json', 'w') as token_file:
+        token_file.write(creds.to_json())
+    return creds
 
 
 def get_credentials() -> Credentials:
+    store = CredentialStore()
     creds = None
     if os.path.exists('auth/token.json'):
         creds = Credentials.from_authorized_user_file('auth/token.json', SCOPES)
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('auth/credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
+    if not creds or not creds.refresh_token:
+        creds = _authorize()
 
-        with open('auth/token.json', 'w') as token_file:
-            token_file.write(creds.to_json())
-    return creds
+    # the state database keeps the freshest token, so a stale token.json never replaces a refreshed one
+    stored = store.get(store.save(creds))
+    if stored is None:
+        # the refresh found the grant revoked and removed the token, so the account has to be authorized again
+        creds = _authorize()
+        store.save(creds)
+        return creds
+    return stored
+
+
+@dataclass
+class ScriptResult:
+    letters: int
+    log: str
+
+    def __str__(self) -> str:
+        return self.log
+
+
+def script(creds: Credentials) -> ScriptResult:
+    with STAGE_SECONDS.time(stage='script'):
+        if PIPELINE_MODE == 'async':
+            letters, log = asyncio.run(run_pipeline(creds))
+            return ScriptResult(letters=letters, log=log)
+        return _serial_script(creds)
 
 
-def script(creds: Credentials) -> str:
+def _serial_script(creds: Credentials) -> ScriptResult:
     # work with gmail
-    gmail_service = create_service(creds, app=AppType.GMAIL)
-    letters = get_letters(gmail_service)
+    with STAGE_SECONDS.time(stage='fetch'):
+        gmail_service = create_service(creds, app=AppType.GMAIL)
+        account = account_key(creds)
+        letters, history_id = sync_letters(gmail_service, account)
+    if not letters:
+        if history_id is not None:
+            save_history_id(account, history_id)
+        return ScriptResult(letters=0, log='No new letters.')
+    EMAILS_FETCHED.inc(len(letters))
 
-    prediction_results = letters_prediction(letters)
+    with STAGE_SECONDS.time(stage='predict'):
+        prediction_results = letters_prediction(letters)
+    EMAILS_PREDICTED.inc(len(letters))
+    EMAILS_SKIPPED.inc(len(letters) - len(prediction_results))
 
     # work with calendar
-    calendar_service = create_service(creds, app=AppType.CALENDAR)
-    log = add_event(calendar_service, prediction_results, letters)
-    return log
+    with STAGE_SECONDS.time(stage='calendar'):
+        calendar_service = create_service(creds, app=AppType.CALENDAR)
+        log, failed_ids = add_event(calendar_service, prediction_results, letters)
+    # the cursor only moves once the letters are in the calendar, so a failed cycle sees them again; the ledger
+    # keeps the events that were written from being created twice
+    if failed_ids:
+        logger.warning("Keeping the history id of account %s, %s events could not be written", account,
+                       len(failed_ids))
+    elif history_id is not None:
+        save_history_id(account, history_id)
+    return ScriptResult(letters=len(letters), log=log)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
     creds = get_credentials()
     print(script(creds))
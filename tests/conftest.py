@@ -0,0 +1,182 @@
+import base64
+from email.message import EmailMessage
+from enum import Enum
+from typing import Any, Callable
+
+import pytest
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+import utils.storage
+
+
+@pytest.fixture(scope='function')
+def state_db(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(utils.storage, 'STATE_DB', str(tmp_path / 'state.db'))
+
+
+class EmailStructure(Enum):
+    PLAIN_ONLY = 'plain_only'
+    PLAIN_HTML = 'plain_html'
+    HTML_ONLY = 'html_only'
+    HTML_PLAIN = 'html_plain'
+    WRONG = 'wrong'
+
+
+def make_raw_message(structure: EmailStructure) -> str:
+    email_msg = EmailMessage()
+    email_msg['From'] = 'sender@example.com'
+    email_msg['To'] = 'receiver@example.com'
+    email_msg['Subject'] = 'Test Subject'
+    match structure:
+        case EmailStructure.PLAIN_ONLY:
+            email_msg.set_content('This is a test message.')
+        case EmailStructure.PLAIN_HTML:
+            email_msg.set_content("This is the plain text part of the message.")
+            email_msg.add_alternative("""\
+                <html>
+                  <body>
+                    <p>This is the HTML part of the message.</p>
+                  </body>
+                </html>
+                """, subtype='html')
+        case EmailStructure.HTML_ONLY:
+            email_msg.add_alternative("""\
+                <html>
+                  <body>
+                    <p>This is a test message.</p>
+                  </body>
+                </html>
+                """, subtype='html')
+        case EmailStructure.HTML_PLAIN:
+            email_msg.add_alternative("""\
+                <html>
+                  <body>
+                    <p>This is the HTML part of the message.</p>
+                  </body>
+                </html>
+                """, subtype='html')
+            email_msg.add_alternative("This is the plain text part of the message.")
+        case EmailStructure.WRONG:
+            email_msg.set_content("""\
+                <?xml version="1.0"?>
+                <data>
+                    <item>Hello, world!</item>
+                </data>
+                """, subtype='xml')
+
+    raw_email_bytes = email_msg.as_bytes()
+    return base64.urlsafe_b64encode(raw_email_bytes).decode('utf-8')
+
+
+class FakeRequest:
+    def __init__(self, response: dict[str, Any]) -> None:
+        self.response = response
+
+    def execute(self) -> dict[str, Any]:
+        return self.response
+
+
+class FakeBatch:
+    def __init__(self, service: 'FakeGmailService | FakeCalendarService', callback: Callable[..., None]) -> None:
+        self.service = service
+        self.callback = callback
+        self.requests: list[tuple[str, FakeRequest]] = []
+
+    def add(self, request: FakeRequest, request_id: str) -> None:
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        self.service.calls.append(('batch', len(self.requests)))
+        for request_id, request in self.requests:
+            statuses = self.service.failures.get(request_id)
+            if statuses:
+                self.callback(request_id, None, HttpError(Response({'status': statuses.pop(0)}), b'{}'))
+            else:
+                self.callback(request_id, request.execute(), None)
+
+
+class FakeGmailService:
+    def __init__(self, message_count: int, page_size: int = 100) -> None:
+        self.message_ids = [f'id{i}' for i in range(message_count)]
+        self.page_size = page_size
+        self.calls: list[tuple[str, Any]] = []
+        self.failures: dict[str, list[int]] = {}  # statuses returned by the next batch calls of a message
+
+    def users(self) -> 'FakeGmailService':
+        return self
+
+    def messages(self) -> 'FakeGmailService':
+        return self
+
+    def list(self, userId: str, labelIds: str | None, maxResults: int, pageToken: str | None = None,
+             q: str | None = None) -> FakeRequest:
+        self.calls.append(('list', maxResults))
+        start = int(pageToken or 0)
+        end = start + min(maxResults, self.page_size)
+        response: dict[str, Any] = {'messages': [{'id': message_id} for message_id in self.message_ids[start:end]],
+                                    'resultSizeEstimate': len(self.message_ids)}
+        if end < len(self.message_ids):
+            response['nextPageToken'] = str(end)
+        return FakeRequest(response)
+
+    def get(self, userId: str, id: str, format: str) -> FakeRequest:
+        return FakeRequest({'raw': make_raw_message(EmailStructure.PLAIN_ONLY)})
+
+    def new_batch_http_request(self, callback: Callable[..., None]) -> FakeBatch:
+        return FakeBatch(self, callback)
+
+    def history(self) -> 'FakeHistory':
+        return FakeHistory(self)
+
+    def getProfile(self, userId: str) -> FakeRequest:
+        self.calls.append(('profile', None))
+        return FakeRequest({'historyId': str(len(self.message_ids))})
+
+    def receive(self, count: int) -> None:
+        self.message_ids.extend(f'id{len(self.message_ids)}' for _ in range(count))
+
+
+class FakeHistory:
+    def __init__(self, service: FakeGmailService) -> None:
+        self.service = service
+
+    def list(self, userId: str, startHistoryId: str, historyTypes: str, labelId: str, maxResults: int,
+             pageToken: str | None = None) -> FakeRequest:
+        self.service.calls.append(('history', startHistoryId))
+        if int(startHistoryId) < 0:
+            raise HttpError(Response({'status': 404}), b'History expired')
+        added = [{'messagesAdded': [{'message': {'id': message_id}}]}
+                 for message_id in self.service.message_ids[int(startHistoryId):]]
+        return FakeRequest({'history': added, 'historyId': str(len(self.service.message_ids))})
+
+
+class FakeCalendarService:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, Any]] = []
+        self.failures: dict[str, list[int]] = {}  # statuses returned by the next batch calls of an email
+
+    def calendarList(self) -> 'FakeCalendarService':
+        return self
+
+    def events(self) -> 'FakeCalendarService':
+        return self
+
+    def list(self) -> FakeRequest:
+        return FakeRequest({'items': [{'id': 'other'}, {'id': 'me@example.com', 'primary': True}]})
+
+    def insert(self, calendarId: str, body: dict[str, Any]) -> FakeRequest:
+        event_id = f'event{len(self.calls)}'
+        self.calls.append(('insert', event_id))
+        return FakeRequest({'id': event_id, 'htmlLink': event_id})
+
+    def patch(self, calendarId: str, eventId: str, body: dict[str, Any]) -> FakeRequest:
+        self.calls.append(('patch', eventId))
+        return FakeRequest({'id': eventId, 'htmlLink': eventId})
+
+    def new_batch_http_request(self, callback: Callable[..., None]) -> FakeBatch:
+        return FakeBatch(self, callback)
+
+
+def make_prediction(start: str) -> dict[str, Any]:
+    return {'description': '', 'event_type': 'Meeting', 'start': {'dateTime': start}, 'end': {'dateTime': None}}
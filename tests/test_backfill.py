@@ -0,0 +1,118 @@
+from datetime import date
+from typing import Any
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('spacy')
+
+import backfill
+import gmail
+from backfill import BackfillConfig, BackfillProgress, run_backfill
+from conftest import FakeCalendarService, FakeGmailService, FakeRequest, make_prediction
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+from utils.api_utils import AppType
+from utils.transport import HTTP_MAX_RETRIES
+
+
+class FlakyGmailService(FakeGmailService):
+    def __init__(self, message_count: int, failing_page: str | None = None) -> None:
+        super().__init__(message_count, page_size=10)
+        self.failing_page = failing_page
+
+    def list(self, userId: str, labelIds: str | None, maxResults: int, pageToken: str | None = None,
+             q: str | None = None) -> FakeRequest:
+        if pageToken is not None and pageToken == self.failing_page:
+            self.failing_page = None
+            raise HttpError(Response({'status': 500}), b'Backend error')
+        return super().list(userId, labelIds, maxResults, pageToken, q)
+
+
+def fake_prediction(letters: dict[str, dict[str, str]]) -> dict[str, dict[str, Any]]:
+    return {message_id: make_prediction('2024-01-17T09:00:00')
+            for message_id in letters if int(message_id[2:]) % 2 == 0}
+
+
+@pytest.fixture(scope='function')
+def services(state_db: None, monkeypatch: pytest.MonkeyPatch) -> tuple[FlakyGmailService, FakeCalendarService]:
+    gmail_service, calendar_service = FlakyGmailService(message_count=25), FakeCalendarService()
+    monkeypatch.setattr(backfill, 'create_service',
+                        lambda creds, app: gmail_service if app == AppType.GMAIL else calendar_service)
+    monkeypatch.setattr(backfill, 'letters_prediction', fake_prediction)
+    monkeypatch.setattr(backfill, 'account_key', lambda creds: 'account')
+    return gmail_service, calendar_service
+
+
+def calls(service: Any, name: str) -> list[tuple[str, Any]]:
+    return [call for call in service.calls if call[0] == name]
+
+
+def test_backfill_walks_every_page(services: tuple[FlakyGmailService, FakeCalendarService]) -> None:
+    gmail_service, calendar_service = services
+    config = BackfillConfig(workers=3, rate=1000, page_size=10, chunk_size=4)
+    progress = run_backfill(Credentials('token'), config)
+
+    assert (progress.processed, progress.events, progress.total, progress.done) == (25, 13, 25, True)
+    assert len(calls(gmail_service, 'list')) == 3
+    assert sorted(calls(gmail_service, 'batch')) == [('batch', 1)] + [('batch', 2)] * 2 + [('batch', 4)] * 5
+    # one calendar batch per page
+    assert calls(calendar_service, 'batch') == [('batch', 5), ('batch', 5), ('batch', 3)]
+    assert len(calls(calendar_service, 'insert')) == 13
+
+    gmail_service.calls.clear()
+    assert run_backfill(Credentials('token'), config).done
+    assert gmail_service.calls == []
+
+
+def test_backfill_resumes_from_checkpoint(services: tuple[FlakyGmailService, FakeCalendarService]) -> None:
+    gmail_service, calendar_service = services
+    gmail_service.failing_page = '20'
+    config = BackfillConfig(rate=1000, page_size=10)
+    with pytest.raises(HttpError):
+        run_backfill(Credentials('token'), config)
+    assert len(calls(calendar_service, 'insert')) == 10
+
+    gmail_service.calls.clear()
+    progress = run_backfill(Credentials('token'), config)
+    assert calls(gmail_service, 'list') == [('list', 10)]
+    assert (progress.processed, progress.events, progress.resumed_at) == (25, 13, 20)
+    assert len(calls(calendar_service, 'insert')) == 13
+
+    # another date range has its own checkpoint, and the ledger keeps its letters from getting a second event
+    ranged = BackfillConfig(rate=1000, page_size=10, after=date(2024, 1, 1), before=date(2024, 2, 1))
+    assert ranged.query == 'after:2024/01/01 before:2024/02/01'
+    progress = run_backfill(Credentials('token'), ranged)
+    assert (progress.processed, progress.events) == (25, 0)
+    assert len(calls(calendar_service, 'insert')) == 13
+
+
+def test_backfill_repeats_page_with_failures(services: tuple[FlakyGmailService, FakeCalendarService],
+                                             monkeypatch: pytest.MonkeyPatch) -> None:
+    gmail_service, calendar_service = services
+    monkeypatch.setattr(gmail.time, 'sleep', lambda seconds: None)
+    config = BackfillConfig(rate=1000, page_size=10)
+
+    # a message given up on after the retries keeps the checkpoint at its page
+    gmail_service.failures = {'id13': [503] * (HTTP_MAX_RETRIES + 1)}
+    progress = run_backfill(Credentials('token'), config)
+    assert (progress.processed, progress.events, progress.done) == (10, 10, False)
+
+    # and so does an event that could not be written
+    calendar_service.failures = {'id22': [400]}
+    progress = run_backfill(Credentials('token'), config)
+    assert (progress.processed, progress.events, progress.done) == (20, 12, False)
+
+    progress = run_backfill(Credentials('token'), config)
+    assert (progress.processed, progress.events, progress.done) == (25, 13, True)
+    # only the rejected insert was sent twice
+    assert len(calls(calendar_service, 'insert')) == 14
+
+
+def test_backfill_progress() -> None:
+    progress = BackfillProgress(processed=150, total=1000, resumed_at=50)
+    progress.started -= 10
+    assert progress.rate == pytest.approx(10, rel=0.01)
+    assert progress.eta == pytest.approx(85, rel=0.01)
+    assert str(progress).startswith('150/1000 messages (15.0%), 0 events, 10.0 messages/s, ETA 1m 2')
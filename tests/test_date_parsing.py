@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+
+import pytest
+
+from model.date_parsing import _parse_date_on, _parse_single_time, letter_sent_time, parse_date, parse_time
+
+
+@dataclass
+class TimeCase:
+    name: str
+    text: str
+    expected: tuple[time, time | None]
+
+    def __str__(self):
+        return f"test_{self.name}"
+
+
+TIME_CASES = [
+    TimeCase(name='pm', text='5 pm', expected=(time(17, 0), None)),
+    TimeCase(name='pm_dots', text='5:30 p.m.', expected=(time(17, 30), None)),
+    TimeCase(name='midnight', text='12 am', expected=(time(0, 0), None)),
+    TimeCase(name='24h', text='17:30', expected=(time(17, 30), None)),
+    TimeCase(name='range', text='14:00 - 15:00', expected=(time(14, 0), time(15, 0))),
+    TimeCase(name='range_no_spaces', text='9am-10:30am', expected=(time(9, 0), time(10, 30))),
+    TimeCase(name='oclock_word', text="five o'clock", expected=(time(5, 0), None)),
+    TimeCase(name='oclock_digit', text="7 o'clock", expected=(time(7, 0), None)),
+    TimeCase(name='dateparser', text='noon', expected=(time(12, 0), None)),
+    TimeCase(name='ru_evening', text='5 вечера', expected=(time(17, 0), None)),
+    TimeCase(name='ru_morning_minutes', text='9.30 утра', expected=(time(9, 30), None)),
+    TimeCase(name='ru_night', text='12 ночи', expected=(time(0, 0), None)),
+    TimeCase(name='ru_noon', text='полдень', expected=(time(12, 0), None)),
+    TimeCase(name='ru_afternoon', text='в 2 дня', expected=(time(14, 0), None)),
+    TimeCase(name='ru_afternoon_minutes', text='2.30 дня', expected=(time(14, 30), None)),
+    TimeCase(name='ru_range', text='9 утра - 11.30 утра', expected=(time(9, 0), time(11, 30))),
+]
+
+
+@pytest.mark.parametrize("case", TIME_CASES, ids=str)
+def test_parse_time(case: TimeCase) -> None:
+    assert parse_time(case.text) == case.expected
+
+
+def test_parse_date_in_language() -> None:
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%d.%m.%Y")
+    assert parse_date('завтра', ('ru',)) == tomorrow
+    assert parse_time('17:00', ('ru',)) == (time(17, 0), None)
+
+
+def test_parse_time_invalid() -> None:
+    with pytest.raises(ValueError):
+        parse_time('whenever')
+
+
+@pytest.mark.parametrize("text", ['3 дня', 'через 2 дня', '3 дня назад'])
+def test_parse_time_day_count(text: str) -> None:
+    # "дня" without "в" counts days rather than naming the afternoon
+    with pytest.raises(ValueError):
+        parse_time(text, ('ru',))
+
+
+def test_parse_date_relative() -> None:
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%d.%m.%Y")
+    assert parse_date('Tomorrow') == tomorrow
+    assert parse_date('in 1 day') == tomorrow
+    next_year = date.today().year + 1
+    assert parse_date(f'{next_year}-03-01') == f'01.03.{next_year}'
+
+
+def test_parse_date_past() -> None:
+    with pytest.raises(ValueError):
+        parse_date('2020-01-01')
+
+
+def test_parse_date_as_of_sending() -> None:
+    sent = letter_sent_time('Wed, 17 Jan 2024 12:00:00 -0000')
+    assert sent == datetime(2024, 1, 17, 12, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    assert parse_date('tomorrow', now=datetime(2024, 1, 17, 12)) == '18.01.2024'
+    assert parse_date('2024-01-20', now=datetime(2024, 1, 17, 12)) == '20.01.2024'
+    assert parse_time('in 2 hours', now=datetime(2024, 1, 17, 12)) == (time(14, 0), None)
+    assert letter_sent_time(None) is None
+    assert letter_sent_time('yesterday-ish') is None
+
+
+def test_parse_date_cache_follows_day() -> None:
+    first, _ = _parse_date_on('tomorrow', date(2024, 1, 17), ('en',))
+    hits = _parse_date_on.cache_info().hits
+    assert _parse_date_on('tomorrow', date(2024, 1, 17), ('en',))[0] == first
+    assert _parse_date_on.cache_info().hits == hits + 1
+    assert _parse_date_on('tomorrow', date(2024, 1, 18), ('en',))[0] == first + timedelta(days=1)
+
+
+def test_parse_time_cache_follows_clock() -> None:
+    assert _parse_single_time('in 2 hours', datetime(2024, 1, 17, 9, 0), ('en',)) == time(11, 0)
+    assert _parse_single_time('in 2 hours', datetime(2024, 1, 17, 10, 30), ('en',)) == time(12, 30)
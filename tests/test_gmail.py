@@ -1,14 +1,22 @@
 import base64
+import quopri
 from dataclasses import dataclass
+from email import message_from_bytes
 from email.header import Header
 from email.message import EmailMessage
-from enum import Enum
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from typing import Callable
 from datetime import datetime
 
 import pytest
 
-from gmail import decode_text, remove_empty_lines, parse_raw_message, form_json_data
+import utils.storage
+import gmail
+from conftest import EmailStructure, FakeGmailService, make_raw_message
+from gmail import (decode_payload, decode_text, remove_empty_lines, html_to_text, parse_raw_message, form_json_data,
+                   get_letters, sync_letters)
+from utils.transport import HTTP_MAX_RETRIES
 
 
 @dataclass
@@ -65,6 +73,19 @@ FORMAT_CASES = [
         text='\nHello, world!\n',
         expected='Hello, world!'
     ),
+    TextFormatCase(
+        name='html_to_text_0',
+        func=html_to_text,
+        text='<html><head><title>Ad</title><style>p {color: red}</style></head>'
+             '<body><!-- tracking --><p>Meet at <b>5&nbsp;pm</b></p><div>a &lt; b</div></body></html>',
+        expected='\nMeet at 5\xa0pm\n\na < b\n'
+    ),
+    TextFormatCase(
+        name='html_to_text_1',
+        func=html_to_text,
+        text='<p>Cut in the middle of a <a href="https://exa',
+        expected='\nCut in the middle of a '
+    ),
 ]
 
 
@@ -73,60 +94,6 @@ def test_text_formatting(case: TextFormatCase) -> None:
     assert case.func(case.text) == case.expected
 
 
-class EmailStructure(Enum):
-    PLAIN_ONLY = 'plain_only'
-    PLAIN_HTML = 'plain_html'
-    HTML_ONLY = 'html_only'
-    HTML_PLAIN = 'html_plain'
-    WRONG = 'wrong'
-
-
-def make_raw_message(structure: EmailStructure) -> str:
-    email_msg = EmailMessage()
-    email_msg['From'] = 'sender@example.com'
-    email_msg['To'] = 'receiver@example.com'
-    email_msg['Subject'] = 'Test Subject'
-    match structure:
-        case EmailStructure.PLAIN_ONLY:
-            email_msg.set_content('This is a test message.')
-        case EmailStructure.PLAIN_HTML:
-            email_msg.set_content("This is the plain text part of the message.")
-            email_msg.add_alternative("""\
-                <html>
-                  <body>
-                    <p>This is the HTML part of the message.</p>
-                  </body>
-                </html>
-                """, subtype='html')
-        case EmailStructure.HTML_ONLY:
-            email_msg.add_alternative("""\
-                <html>
-                  <body>
-                    <p>This is a test message.</p>
-                  </body>
-                </html>
-                """, subtype='html')
-        case EmailStructure.HTML_PLAIN:
-            email_msg.add_alternative("""\
-                <html>
-                  <body>
-                    <p>This is the HTML part of the message.</p>
-                  </body>
-                </html>
-                """, subtype='html')
-            email_msg.add_alternative("This is the plain text part of the message.")
-        case EmailStructure.WRONG:
-            email_msg.set_content("""\
-                <?xml version="1.0"?>
-                <data>
-                    <item>Hello, world!</item>
-                </data>
-                """, subtype='xml')
-
-    raw_email_bytes = email_msg.as_bytes()
-    return base64.urlsafe_b64encode(raw_email_bytes).decode('utf-8')
-
-
 @dataclass
 class RawMessageCase:
     name: str
@@ -181,6 +148,34 @@ def test_parse_raw_message_wrong(case) -> None:
     assert parsed_message == ''
 
 
+def test_parse_raw_message_skips_attachments_and_decodes_charset() -> None:
+    email_msg = MIMEMultipart()
+    attachment = MIMEText('Attached text')
+    attachment.add_header('Content-Disposition', 'attachment', filename='notes.txt')
+    email_msg.attach(attachment)
+    email_msg.attach(MIMEText('Встреча завтра в 5', 'plain', 'koi8-r'))
+    raw_message = base64.urlsafe_b64encode(email_msg.as_bytes()).decode('utf-8')
+
+    _, parsed_message = parse_raw_message(raw_message)
+    assert parsed_message == 'Встреча завтра в 5'
+
+
+def test_parse_raw_message_caps_body(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(gmail, 'MAX_BODY_CHARS', 9)
+    _, parsed_message = parse_raw_message(make_raw_message(EmailStructure.PLAIN_ONLY))
+    assert parsed_message == 'This is a'
+
+
+@pytest.mark.parametrize('encoding, encode', [('base64', base64.encodebytes), ('quoted-printable', quopri.encodestring),
+                                              ('8bit', lambda data: data)])
+def test_decode_payload_decodes_prefix(encoding: str, encode: Callable[[bytes], bytes]) -> None:
+    data = 'Встреча завтра в 5 вечера\n'.encode() * 2000
+    part = message_from_bytes(f'Content-Type: text/plain; charset=utf-8\nContent-Transfer-Encoding: {encoding}\n\n'
+                              .encode() + encode(data))
+    assert decode_payload(part, 1000) == data[:1000]
+    assert decode_payload(part, 10 ** 6) == data
+
+
 @pytest.fixture(scope='function')
 def email_message() -> EmailMessage:
     email_msg = EmailMessage()
@@ -200,3 +195,74 @@ def test_forming_json_dict(email_message: EmailMessage) -> None:
     assert 'send_date' in json_data and json_data['send_date'] == 'Wed, 17 Jan 2024 12:00:00 -0000'
     assert 'body' in json_data and json_data['body'] == 'This is a test message.'
 
+
+def test_get_letters_pages_and_batches() -> None:
+    service = FakeGmailService(message_count=230)
+    letters = get_letters(service, limit=1000)
+    assert list(letters) == service.message_ids
+    assert all(letter['body'] == 'This is a test message.' for letter in letters.values())
+    assert [call for call in service.calls if call[0] == 'list'] == [('list', 500)] * 3
+    assert [call for call in service.calls if call[0] == 'batch'] == [('batch', 50)] * 4 + [('batch', 30)]
+
+
+def test_get_letters_retries_rate_limited_messages(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(gmail.time, 'sleep', lambda seconds: None)
+    service = FakeGmailService(message_count=5)
+    service.failures = {'id1': [429, 503], 'id3': [429], 'id4': [404]}
+    letters = get_letters(service, limit=5)
+    assert list(letters) == ['id0', 'id1', 'id2', 'id3']
+    assert [call for call in service.calls if call[0] == 'batch'] == [('batch', 5), ('batch', 2), ('batch', 1)]
+
+
+def test_get_letters_respects_limit() -> None:
+    service = FakeGmailService(message_count=30)
+    letters = get_letters(service, limit=10)
+    assert list(letters) == service.message_ids[:10]
+    assert service.calls == [('list', 10), ('batch', 10)]
+
+
+def sync_and_save(service: FakeGmailService, account: str, limit: int = 10) -> dict[str, dict[str, str]]:
+    letters, history_id = sync_letters(service, account, limit)
+    if history_id is not None:
+        utils.storage.save_history_id(account, history_id)
+    return letters
+
+
+def test_sync_letters_incremental(state_db: None) -> None:
+    service = FakeGmailService(message_count=30)
+    assert list(sync_and_save(service, 'account', limit=10)) == service.message_ids[:10]
+    assert service.calls[0] == ('profile', None)
+
+    service.calls.clear()
+    assert sync_and_save(service, 'account') == {}
+    assert service.calls == [('history', '30')]
+
+    service.receive(2)
+    service.calls.clear()
+    assert list(sync_and_save(service, 'account')) == ['id30', 'id31']
+    assert service.calls == [('history', '30'), ('batch', 2)]
+
+
+def test_sync_letters_expired_cursor(state_db: None) -> None:
+    service = FakeGmailService(message_count=5)
+    utils.storage.save_history_id('account', '-1')
+    assert list(sync_and_save(service, 'account')) == service.message_ids
+    assert service.calls[:2] == [('history', '-1'), ('profile', None)]
+    assert utils.storage.get_history_id('account') == '5'
+
+
+def test_sync_letters_keeps_cursor_until_processed(state_db: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(gmail.time, 'sleep', lambda seconds: None)
+    service = FakeGmailService(message_count=5)
+    utils.storage.save_history_id('account', '3')
+    letters, history_id = sync_letters(service, 'account')
+    assert (list(letters), history_id) == (['id3', 'id4'], '5')
+    assert utils.storage.get_history_id('account') == '3'
+
+    # a letter given up on after the retries is listed again by the next sync
+    service.failures = {'id4': [503] * (HTTP_MAX_RETRIES + 1)}
+    letters, history_id = sync_letters(service, 'account')
+    assert (list(letters), history_id) == (['id3'], None)
+    # a letter that can never be downloaded does not hold the cursor back
+    service.failures = {'id4': [404]}
+    assert sync_letters(service, 'account') == ({'id3': letters['id3']}, '5')
@@ -2,8 +2,13 @@ from dataclasses import dataclass
 from typing import Any
 
 import pytest
+from googleapiclient.errors import HttpError
+from httplib2 import Response
 
-from google_calendar import create_event_structure
+import utils.storage
+import google_calendar
+from google_calendar import add_event, add_events, create_event_structure
+from conftest import FakeCalendarService, FakeRequest, make_prediction
 from datetime import datetime
 
 
@@ -83,3 +88,63 @@ def test_create_event_structure(case: StructureCase) -> None:
             assert attendee in result['attendees']
     else:
         assert 'attendees' not in result
+
+
+def test_add_event_is_idempotent(state_db: None) -> None:
+    service = FakeCalendarService()
+    emails = {'a': {'subject': 'Sync'}, 'b': {'subject': 'Retro'}}
+
+    add_event(service, {'a': make_prediction('2024-01-17T09:00:00'), 'b': make_prediction('2024-01-17T11:00:00')},
+              emails)
+    assert service.calls == [('insert', 'event0'), ('insert', 'event1')]
+
+    service.calls.clear()
+    add_event(service, {'a': make_prediction('2024-01-17T09:00:00'), 'b': make_prediction('2024-01-17T12:00:00')},
+              emails)
+    assert service.calls == [('patch', 'event1')]
+
+
+def test_add_event_reports_failed_events(state_db: None) -> None:
+    service = FakeCalendarService()
+    insert = service.insert
+
+    def insert_or_fail(calendarId: str, body: dict[str, Any]) -> FakeRequest:
+        if body['summary'] == 'Meeting: Retro':
+            raise HttpError(Response({'status': 503}), b'{}')
+        return insert(calendarId, body)
+
+    service.insert = insert_or_fail
+    emails = {'a': {'subject': 'Sync'}, 'b': {'subject': 'Retro'}}
+    log, failed_ids = add_event(service, {'a': make_prediction('2024-01-17T09:00:00'),
+                                          'b': make_prediction('2024-01-17T11:00:00')}, emails)
+    assert failed_ids == ['b']
+    assert log.count('Event created') == 1
+
+
+def test_add_events_without_primary_calendar(state_db: None) -> None:
+    service = FakeCalendarService()
+    service.list = lambda: FakeRequest({'items': [{'id': 'other'}]})
+    emails = {'a': {'subject': 'Sync'}}
+    assert add_events(service, {'a': make_prediction('2024-01-17T09:00:00')}, emails)[1:] == (0, ['a'])
+    assert service.calls == []
+
+
+def test_add_events_batches_and_retries(state_db: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(google_calendar.time, 'sleep', lambda seconds: None)
+    service = FakeCalendarService()
+    emails = {email_id: {'subject': email_id} for email_id in 'abcde'}
+    service.failures = {'b': [429], 'c': [503]}
+
+    predictions = {email_id: make_prediction('2024-01-17T09:00:00') for email_id in emails}
+    _, written, failed_ids = add_events(service, predictions, emails, batch_size=3)
+    assert (written, failed_ids) == (4, ['c'])
+    # the rate limited insert is repeated, the one failed by a server error may have been applied and is not
+    assert [call for call in service.calls if call[0] == 'batch'] == [('batch', 3), ('batch', 2), ('batch', 1)]
+    assert set(utils.storage.get_calendar_events('me@example.com', list(emails))) == {'a', 'b', 'd', 'e'}
+
+    event_id = utils.storage.get_calendar_events('me@example.com', ['b'])['b'][1]
+    service.calls.clear()
+    log, written, _ = add_events(service, {'a': make_prediction('2024-01-17T09:00:00'),
+                                           'b': make_prediction('2024-01-17T10:00:00')}, emails)
+    assert service.calls == [('patch', event_id), ('batch', 1)]
+    assert (log.count('Event updated'), written) == (1, 1)
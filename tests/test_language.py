@@ -0,0 +1,39 @@
+from dataclasses import dataclass
+
+import pytest
+
+from model.language import detect_language
+
+
+@dataclass
+class LanguageCase:
+    name: str
+    text: str
+    expected: str | None
+
+    def __str__(self):
+        return f"test_{self.name}"
+
+
+LANGUAGE_CASES = [
+    LanguageCase(name='english', text="Let's have a meeting tomorrow at 5 pm in Zoom", expected='en'),
+    LanguageCase(name='russian', text='Созвон завтра в 17:00 в Zoom', expected='ru'),
+    LanguageCase(name='russian_with_links',
+                 text='Ссылка: https://zoom.us/j/123456789?pwd=abcdefghijklmnopqrstuvwxyz, пишите на team@example.com',
+                 expected='ru'),
+    LanguageCase(name='ukrainian', text='Привіт, зустріч завтра о 17:00 у Zoom', expected='uk'),
+    LanguageCase(name='russian_quoting_ukrainian',
+                 text='Коллеги, напоминаю, что встреча по проекту «Дія» состоится завтра в 17:00 в переговорной '
+                      'на третьем этаже, просьба не опаздывать и подготовить отчёты', expected='ru'),
+    LanguageCase(name='german',
+                 text='Hallo, wir treffen uns morgen um 17 Uhr im Büro. Bitte bestätigen Sie den Termin bis Freitag, '
+                      'damit wir die Räume buchen können und alle Unterlagen vorbereitet sind. Vielen Dank',
+                 expected=None),
+    LanguageCase(name='chinese', text='会议明天下午五点', expected=None),
+    LanguageCase(name='no_letters', text='17:00 — 18:00', expected='en'),
+]
+
+
+@pytest.mark.parametrize("case", LANGUAGE_CASES, ids=str)
+def test_detect_language(case: LanguageCase) -> None:
+    assert detect_language(case.text) == case.expected
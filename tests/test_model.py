@@ -0,0 +1,314 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('spacy')
+
+import model.model_registry as registry
+
+
+class FakeModel:
+    instances = 0
+
+    def __init__(self, model_name: str, profile: str) -> None:
+        FakeModel.instances += 1
+        self.model_name = model_name
+        self.profile = profile
+
+
+@pytest.fixture(scope='function')
+def fake_registry(monkeypatch: pytest.MonkeyPatch) -> None:
+    FakeModel.instances = 0
+    monkeypatch.setattr(registry, 'MySpaCyModel', FakeModel)
+    monkeypatch.setattr(registry, '_models', {})
+
+
+def test_get_model_loads_once(fake_registry: None) -> None:
+    threads = [threading.Thread(target=registry.get_model) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeModel.instances == 1
+    assert registry.get_model() is registry.get_model()
+
+
+def test_get_model_per_name_and_profile(fake_registry: None) -> None:
+    assert registry.get_model('a').model_name == 'a'
+    assert registry.get_model('b').model_name == 'b'
+    assert registry.get_model('a', 'ner').profile == 'ner'
+    assert registry.get_model('a', 'ner') is not registry.get_model('a', 'full')
+    assert FakeModel.instances == 3
+
+
+@pytest.fixture(scope='function')
+def ruler_model(state_db: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    import spacy
+    import model.custom_spacy_model as custom_model
+
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([
+        {'label': 'TIME', 'pattern': [{'LOWER': '5'}, {'LOWER': 'pm'}]},
+        {'label': 'DATE', 'pattern': 'tomorrow'},
+    ])
+    monkeypatch.setattr(custom_model.spacy, 'load', lambda model_name, **kwargs: nlp)
+    monkeypatch.setattr(registry, '_models', {})
+
+
+def test_letters_prediction_batch(ruler_model: None) -> None:
+    from model.main_model import letters_prediction
+
+    meeting = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+               'sender': 'sender@example.com'}
+    newsletter = {'body': 'Our spring sale has started', 'subject': 'Sale', 'sender': 'shop@example.com'}
+    letters = {'a': newsletter, 'b': meeting, 'c': newsletter, 'd': meeting}
+
+    predictions = letters_prediction(letters, batch_size=2)
+    assert set(predictions) == {'b', 'd'}
+    assert predictions['b']['description'] == 'Reference: Zoom\n'
+    assert predictions['b']['start']['dateTime'].endswith('T17:00:00')
+
+
+def test_letters_prediction_scores_in_batches(ruler_model: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    import model.main_model
+    from model.main_model import letters_prediction
+
+    scored = []
+
+    def get_meeting_probabilities(letters, docs):
+        scored.append(len(docs))
+        return meeting_probabilities(letters, docs)
+
+    meeting_probabilities = model.main_model.get_meeting_probabilities
+    monkeypatch.setattr(model.main_model, 'get_meeting_probabilities', get_meeting_probabilities)
+    meeting = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+               'sender': 'sender@example.com'}
+    newsletter = {'body': 'Our spring sale is at 5 pm', 'subject': 'Sale', 'sender': 'shop@example.com'}
+    letters = {str(i): meeting if i % 2 else newsletter for i in range(10)}
+    assert set(letters_prediction(letters, batch_size=4, use_cache=False, prefilter_threshold=0)) == \
+        {'1', '3', '5', '7', '9'}
+    assert scored == [4, 4, 2]
+
+
+def test_letters_prediction_skips_unreadable_dates(ruler_model: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    import model.main_model
+    from model.main_model import letters_prediction
+
+    def parse_date(date_str: str, languages: tuple[str, ...], now: datetime) -> str:
+        raise ValueError("Invalid date format")
+
+    monkeypatch.setattr(model.main_model, 'parse_date', parse_date)
+    # sent tomorrow, so the meeting at 5 pm of the day it was sent has not ended yet
+    send_date = format_datetime(datetime.now(timezone.utc) + timedelta(days=1))
+    dated = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+             'sender': 'sender@example.com', 'send_date': send_date}
+    undated = {'body': "Let's have a meeting at 5 pm in Zoom", 'subject': 'Meeting', 'sender': 'sender@example.com',
+               'send_date': send_date}
+    assert list(letters_prediction({'a': dated, 'b': undated}, use_cache=False)) == ['b']
+
+
+def test_letters_prediction_as_of_sending(ruler_model: None) -> None:
+    from model.main_model import letters_prediction
+
+    meeting = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+               'sender': 'sender@example.com'}
+    sent = datetime.now(timezone.utc) + timedelta(days=3)
+    letters = {'a': dict(meeting, send_date=format_datetime(sent)),
+               'b': dict(meeting, send_date='Wed, 17 Jan 2024 12:00:00 +0300')}
+    predictions = letters_prediction(letters, use_cache=False)
+    # "tomorrow" is the day after the letter was sent, and the meeting of the letter from 2024 is over
+    day_after = sent.astimezone().date() + timedelta(days=1)
+    assert list(predictions) == ['a']
+    assert predictions['a']['start']['dateTime'] == f'{day_after.isoformat()}T17:00:00'
+
+
+@pytest.fixture(scope='function')
+def vector_model(monkeypatch: pytest.MonkeyPatch):
+    import numpy
+    import spacy
+    import model.custom_spacy_model as custom_model
+
+    nlp = spacy.blank('en')
+    for i, event_type in enumerate(custom_model.EVENT_TYPES):
+        vector = numpy.zeros(len(custom_model.EVENT_TYPES), dtype=numpy.float32)
+        vector[i] = 1
+        nlp.vocab.set_vector(event_type, vector)
+    nlp.vocab.set_vector('talk', numpy.array([0, 1, 0, 0, 0, 0], dtype=numpy.float32))
+    nlp.vocab.set_vector('gathering', numpy.array([1, 1, 0, 0, 0, 0], dtype=numpy.float32))
+    monkeypatch.setattr(custom_model.spacy, 'load', lambda model_name, **kwargs: nlp)
+    return custom_model.MySpaCyModel()
+
+
+def test_classify_event_types(vector_model) -> None:
+    docs = [vector_model.predict(text) for text in ('talk', 'gathering', 'nothing', 'Webinar')]
+    assert vector_model.classify_event_types(docs) == ['Call', 'Meeting', 'Unknown', 'Webinar']
+    assert vector_model.classify_event_type(docs[0]) == 'Call'
+
+
+def test_letters_prediction_process_pool(ruler_model: None) -> None:
+    from model.main_model import letters_prediction, shutdown_prediction_pool
+
+    meeting = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+               'sender': 'sender@example.com'}
+    newsletter = {'body': 'Our spring sale has started', 'subject': 'Sale', 'sender': 'shop@example.com'}
+    letters = {str(i): meeting if i % 3 == 0 else newsletter for i in range(10)}
+
+    try:
+        assert letters_prediction(letters, workers=2, chunk_size=3) == letters_prediction(letters)
+    finally:
+        shutdown_prediction_pool()
+
+
+def test_letters_prediction_cache(ruler_model: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    from model.main_model import letters_prediction
+
+    meeting = {'body': "Let's have a meeting tomorrow at 5 pm in Zoom", 'subject': 'Meeting',
+               'sender': 'sender@example.com'}
+    newsletter = {'body': 'Our spring sale has started', 'subject': 'Sale', 'sender': 'shop@example.com'}
+    predictions = letters_prediction({'a': meeting, 'b': newsletter})
+
+    def fail(*args, **kwargs):
+        raise AssertionError('the model must not run on cached letters')
+
+    monkeypatch.setattr(registry.get_model(), 'predict_batch', fail)
+    reformatted = dict(meeting, body=meeting['body'].replace(' ', '\n  '))
+    assert letters_prediction({'c': newsletter, 'd': reformatted}) == {'d': predictions['a']}
+
+
+def test_letters_prediction_prefilter(ruler_model: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    from model.main_model import letters_prediction
+
+    newsletter = {'body': 'Our spring sale has started', 'subject': 'Sale', 'sender': 'shop@example.com'}
+
+    def fail(*args, **kwargs):
+        raise AssertionError('the model must not run on pre-filtered letters')
+
+    monkeypatch.setattr(registry.get_model(), 'predict_batch', fail)
+    assert letters_prediction({'a': newsletter}) == {}
+
+
+def test_ner_profile_excludes_unused_components(tmp_path) -> None:
+    import spacy
+    from model.custom_spacy_model import MySpaCyModel
+
+    nlp = spacy.blank('en')
+    nlp.add_pipe('tok2vec')
+    nlp.add_pipe('tagger').add_label('NN')
+    ruler = nlp.add_pipe('entity_ruler')
+    nlp.initialize()
+    ruler.add_patterns([{'label': 'TIME', 'pattern': [{'LOWER': '5'}, {'LOWER': 'pm'}]}])
+    nlp.to_disk(tmp_path)
+
+    assert MySpaCyModel(str(tmp_path), 'full').nlp.pipe_names == ['tok2vec', 'tagger', 'entity_ruler']
+    ner_model = MySpaCyModel(str(tmp_path), 'ner')
+    assert ner_model.nlp.pipe_names == ['entity_ruler']
+    assert [ent.label_ for ent in ner_model.predict('See you at 5 pm').ents] == ['TIME']
+
+
+def test_fit_resumes_from_checkpoint(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import json
+    import spacy
+    import model.custom_spacy_model as custom_model
+    from model.training_data import write_shards
+
+    nlp = spacy.blank('en')
+    nlp.add_pipe('ner').add_label('TIME')
+    nlp.initialize()
+    nlp.to_disk(tmp_path / 'base')
+    sentences = [(['Meet', 'at', '5', 'pm'], ['O', 'O', 'B-TIME', 'I-TIME'])] * 4
+    shards = write_shards(tmp_path, iter(sentences), shard_size=2, workers=1)
+
+    shards_read = []
+    read_examples = custom_model.read_examples
+    monkeypatch.setattr(custom_model, 'read_examples', lambda *args: shards_read.append(args[1]) or read_examples(*args))
+    checkpoint_dir = tmp_path / 'checkpoints'
+    custom_model.MySpaCyModel(str(tmp_path / 'base')).fit(shards, tmp_path / 'out', checkpoint_dir, epochs=1)
+    assert json.loads((checkpoint_dir / 'state.json').read_text())['epoch'] == 1
+
+    shards_read.clear()
+    custom_model.MySpaCyModel(str(tmp_path / 'base')).fit(shards, tmp_path / 'out', checkpoint_dir, epochs=2)
+    assert len(shards_read) == 2
+    assert spacy.load(tmp_path / 'out').pipe_names == ['ner']
+
+
+def test_mmap_vectors(tmp_path) -> None:
+    import numpy
+    import spacy
+    from model.custom_spacy_model import MySpaCyModel
+
+    nlp = spacy.blank('en')
+    nlp.vocab.set_vector('meeting', numpy.array([1, 0, 0], dtype=numpy.float32))
+    nlp.vocab.set_vector('call', numpy.array([0, 1, 0], dtype=numpy.float32))
+    nlp.to_disk(tmp_path)
+
+    mapped = MySpaCyModel(str(tmp_path), mmap_vectors=True)
+    loaded = MySpaCyModel(str(tmp_path), mmap_vectors=False)
+    assert isinstance(mapped.nlp.vocab.vectors.data, numpy.memmap)
+    assert not isinstance(loaded.nlp.vocab.vectors.data, numpy.memmap)
+    assert (mapped.predict('meeting call').vector == loaded.predict('meeting call').vector).all()
+    assert (mapped.label_matrix == loaded.label_matrix).all()
+
+
+@pytest.fixture(scope='function')
+def language_models(state_db: None, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    import spacy
+    import model.custom_spacy_model as custom_model
+
+    english = spacy.blank('en')
+    english.add_pipe('entity_ruler').add_patterns([{'label': 'TIME', 'pattern': [{'LOWER': '5'}, {'LOWER': 'pm'}]}])
+    loaded = []
+
+    def load(model_name, **kwargs):
+        loaded.append(model_name)
+        return spacy.blank('ru') if model_name.startswith('ru_') else english
+
+    monkeypatch.setattr(custom_model.spacy, 'load', load)
+    monkeypatch.setattr(registry, '_models', {})
+    return loaded
+
+
+def test_letters_prediction_routes_by_language(language_models: list[str]) -> None:
+    from datetime import datetime, timedelta
+    from model.main_model import letters_prediction
+
+    english = {'body': "Let's have a meeting at 5 pm in Zoom", 'subject': 'Meeting', 'sender': 'sender@example.com'}
+    russian = {'body': 'Созвон завтра в 5 вечера в Zoom, встреча по проекту', 'subject': 'Созвон',
+               'sender': 'sender@example.com'}
+    ukrainian = {'body': 'Зустріч завтра о 17:00 у Zoom, будь ласка, підтвердіть', 'subject': 'Зустріч',
+                 'sender': 'sender@example.com'}
+
+    predictions = letters_prediction({'en': english, 'ru': russian, 'uk': ukrainian}, use_cache=False)
+    assert set(predictions) == {'en', 'ru'}
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    assert predictions['ru']['start']['dateTime'] == f'{tomorrow}T17:00:00'
+    assert predictions['en']['start']['dateTime'].endswith('T17:00:00')
+    # the Ukrainian letter has no pipeline, so nothing was loaded for it
+    assert sorted(language_models) == sorted(registry.LANGUAGE_MODELS.values())
+    assert 'time_ruler' in registry.get_language_model('ru').nlp.pipe_names
+    assert 'time_ruler' not in registry.get_language_model('en').nlp.pipe_names
+
+
+def test_russian_time_rules(language_models: list[str]) -> None:
+    nlp = registry.get_language_model('ru').nlp
+    doc = nlp('Созвон в 2 дня или в 5 вечера, отчёт через 2 дня, прошлый был 3 дня назад')
+    assert [ent.text for ent in doc.ents if ent.label_ == 'TIME'] == ['в 2 дня', '5 вечера']
+
+
+def test_prediction_version_per_language(language_models: list[str]) -> None:
+    from model.prediction_cache import prediction_version
+
+    prediction_version.cache_clear()
+    try:
+        version = prediction_version('ru')
+        # the version of Russian letters never loads the English pipeline
+        assert language_models == [registry.LANGUAGE_MODELS['ru']]
+        registry.get_language_model('ru').nlp.remove_pipe('time_ruler')
+        prediction_version.cache_clear()
+        assert prediction_version('ru') != version
+        assert prediction_version('ru').startswith('ru:')
+    finally:
+        prediction_version.cache_clear()
@@ -0,0 +1,140 @@
+import itertools
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from model.meeting_scorer import FEATURES, fit_logistic, get_scorer, load_scorer, save_scorer
+from model.patterns import (check_calendaring_phrases, check_conditional_statements, check_confirmatory_closures,
+                            check_sender_recipient_info, check_subject_and_body_for_meeting, contains_date_entity,
+                            contains_location_or_tool, contains_multiple_persons, contains_time_entity,
+                            contains_video_conferencing_ref, get_meeting_probabilities,
+                            get_meeting_probability)
+
+TEST_FILES = sorted(Path(__file__).parent.parent.joinpath('test_files').glob('*.json'))
+
+
+def make_doc(entities: list[tuple[str, str]]) -> SimpleNamespace:
+    return SimpleNamespace(ents=[SimpleNamespace(text=text, label_=label) for text, label in entities])
+
+
+def separate_checks_score(email_dict: dict[str, str], doc: SimpleNamespace) -> tuple[float, str | None]:
+    """The scoring as it was done with one helper call per feature."""
+    text = email_dict['body']
+    entities = [(ent.text, ent.label_) for ent in doc.ents]
+    checks = [
+        (contains_date_entity(entities), 0.1),
+        (check_sender_recipient_info(email_dict['sender'], doc), 0.02),
+        (check_calendaring_phrases(text), 0.02),
+        (check_conditional_statements(text), 0.03),
+        (check_confirmatory_closures(text), 0.02),
+        (contains_location_or_tool(entities, text), 0.1),
+        (contains_multiple_persons(entities), 0.13),
+        (check_subject_and_body_for_meeting(email_dict['subject'], text), 0.12),
+        (contains_video_conferencing_ref(text) is not None, 0.2),
+    ]
+    score = 0
+    for passed, weight in checks:
+        if passed:
+            score += weight
+    return score, contains_video_conferencing_ref(text)
+
+
+@dataclass
+class FeatureCase:
+    name: str
+    body: str
+    entities: list[tuple[str, str]]
+    subject: str = 'Hello'
+    sender: str = 'Anna Manager'
+
+    def __str__(self):
+        return f"test_{self.name}"
+
+
+ENTITY_SETS = [
+    [('5 pm', 'TIME')],
+    [('5 pm', 'TIME'), ('tomorrow', 'DATE'), ('Moscow', 'LOC')],
+    [('5 pm', 'TIME'), ('Ann', 'PERSON'), ('Bob', 'PERSON'), ('Kate', 'PERSON'), ('Manager', 'ORG')],
+]
+
+FEATURE_CASES = [
+    FeatureCase(name=f'{path.stem}_{i}', body=data['body'], subject=data['subject'], entities=entities)
+    for path in TEST_FILES
+    for data in [json.loads(path.read_text())]
+    for i, entities in enumerate(ENTITY_SETS)
+] + [
+    FeatureCase(name='tool_order', body='Join via Skype, or ZOOM if Skype fails', entities=ENTITY_SETS[0]),
+    FeatureCase(name='microsoft_teams', body='Microsoft Teams link below. Please confirm.', entities=ENTITY_SETS[0]),
+    FeatureCase(name='tool_inside_word', body='Our zoomers will schedule a call', entities=ENTITY_SETS[0]),
+    FeatureCase(name='recipient_title', body='If you are available', sender='Head of HR <hr@example.com>',
+                entities=ENTITY_SETS[0] + [('Head of HR', 'ORG')]),
+]
+
+
+@pytest.mark.parametrize("case", FEATURE_CASES, ids=str)
+def test_meeting_probability_matches_separate_checks(case: FeatureCase) -> None:
+    email_dict = {'body': case.body, 'subject': case.subject, 'sender': case.sender}
+    doc = make_doc(case.entities)
+    score, reference = separate_checks_score(email_dict, doc)
+
+    result = get_meeting_probability(email_dict, doc)
+    assert result['probability'] == pytest.approx(score)
+    assert result['is_meeting'] == (score > 0.15)
+    assert result['reference'] == reference
+
+
+def test_meeting_probability_without_time() -> None:
+    email_dict = {'body': 'Meeting in Zoom', 'subject': 'Meeting', 'sender': 'Anna'}
+    result = get_meeting_probability(email_dict, make_doc([('tomorrow', 'DATE')]))
+    assert not result['is_meeting'] and result['probability'] == 0
+
+
+def test_batch_scoring_matches_single_letters() -> None:
+    email_dicts = [{'body': case.body, 'subject': case.subject, 'sender': case.sender} for case in FEATURE_CASES]
+    docs = [make_doc(case.entities) for case in FEATURE_CASES]
+    email_dicts.append({'body': 'Meeting in Zoom', 'subject': 'Meeting', 'sender': 'Anna'})
+    docs.append(make_doc([('tomorrow', 'DATE')]))
+
+    batch = get_meeting_probabilities(email_dicts, docs)
+    for email_dict, doc, result in zip(email_dicts, docs, batch):
+        single = get_meeting_probability(email_dict, doc)
+        assert result == pytest.approx(single)
+
+
+def test_scorer_matches_sequential_sum() -> None:
+    scorer = get_scorer()
+    rows = np.array(list(itertools.product((0, 1), repeat=len(FEATURES))), dtype=float)
+    scores = scorer.probabilities(rows)
+    for row, score in zip(rows, scores):
+        expected = 0
+        for present, weight in zip(row, scorer.weights.tolist()):
+            if present:
+                expected += weight
+        assert score == expected
+        assert (score > scorer.threshold) == (expected > scorer.threshold)
+
+
+def test_scorer_config_round_trip(tmp_path) -> None:
+    scorer = get_scorer()
+    save_scorer(scorer, tmp_path / 'scoring.json')
+    loaded = load_scorer(tmp_path / 'scoring.json')
+    assert loaded.to_config() == scorer.to_config()
+    assert loaded.threshold == 0.15 and not loaded.logistic
+
+
+def test_fit_logistic_learns_separating_weights() -> None:
+    rng = np.random.default_rng(0)
+    features = rng.integers(0, 2, size=(500, len(FEATURES))).astype(float)
+    # meetings are the letters with a video conferencing reference or a date and meeting keywords
+    reference = features[:, FEATURES.index('reference')]
+    keywords = features[:, FEATURES.index('meeting_keywords')] * features[:, FEATURES.index('has_date')]
+    labels = np.maximum(reference, keywords)
+
+    scorer = fit_logistic(features, labels)
+    predicted = scorer.probabilities(features) > scorer.threshold
+    assert np.mean(predicted == labels) > 0.9
+    assert scorer.weights[FEATURES.index('reference')] > scorer.weights[FEATURES.index('confirmatory_closures')]
@@ -0,0 +1,99 @@
+import asyncio
+from typing import Any
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('spacy')
+
+import gmail
+import pipeline
+import utils.storage
+from pipeline import PipelineConfig, run_pipeline
+from conftest import FakeCalendarService, FakeGmailService, make_prediction
+from google.oauth2.credentials import Credentials
+from utils.api_utils import AppType
+from utils.transport import HTTP_MAX_RETRIES
+
+
+def fake_prediction(letters: dict[str, dict[str, str]]) -> dict[str, dict[str, Any]]:
+    return {message_id: make_prediction('2024-01-17T09:00:00') for message_id in letters if message_id.endswith('0')}
+
+
+@pytest.fixture(scope='function')
+def services(state_db: None, monkeypatch: pytest.MonkeyPatch) -> tuple[FakeGmailService, FakeCalendarService]:
+    gmail_service = FakeGmailService(message_count=25)
+    calendar_service = FakeCalendarService()
+    monkeypatch.setattr(pipeline, 'letters_prediction', fake_prediction)
+    monkeypatch.setattr(pipeline, 'account_key', lambda creds: 'account')
+    monkeypatch.setattr(pipeline, 'create_service',
+                        lambda creds, app: gmail_service if app == AppType.GMAIL else calendar_service)
+    return gmail_service, calendar_service
+
+
+def inserts(calendar_service: FakeCalendarService) -> list[tuple[str, Any]]:
+    return [call for call in calendar_service.calls if call[0] == 'insert']
+
+
+def test_run_pipeline(services: tuple[FakeGmailService, FakeCalendarService]) -> None:
+    gmail_service, calendar_service = services
+    config = PipelineConfig(fetch_batch_size=4, fetch_concurrency=2, parse_concurrency=3, predict_batch_size=3,
+                            predict_concurrency=2, calendar_concurrency=2, queue_size=2)
+
+    letters, log = asyncio.run(run_pipeline(Credentials('token'), config))
+    assert letters == 10
+    assert log.count('Event created') == 1
+    assert len(inserts(calendar_service)) == 1
+    assert ('batch', 1) in calendar_service.calls
+
+    gmail_service.receive(15)
+    letters, log = asyncio.run(run_pipeline(Credentials('token'), config))
+    assert letters == 15
+    assert log.count('Event created') == 1
+    assert len(inserts(calendar_service)) == 2
+
+
+def test_run_pipeline_without_new_letters(services: tuple[FakeGmailService, FakeCalendarService]) -> None:
+    asyncio.run(run_pipeline(Credentials('token')))
+    assert asyncio.run(run_pipeline(Credentials('token'))) == (0, 'No new letters.')
+
+
+def test_run_pipeline_keeps_cursor_after_failures(services: tuple[FakeGmailService, FakeCalendarService],
+                                                  monkeypatch: pytest.MonkeyPatch) -> None:
+    gmail_service, calendar_service = services
+    monkeypatch.setattr(gmail.time, 'sleep', lambda seconds: None)
+    utils.storage.save_history_id('account', '20')
+
+    # a letter given up on after the retries is listed again by the next cycle
+    gmail_service.failures = {'id21': [503] * (HTTP_MAX_RETRIES + 1)}
+    assert asyncio.run(run_pipeline(Credentials('token')))[0] == 4
+    assert utils.storage.get_history_id('account') == '20'
+
+    def fail(letters: dict[str, dict[str, str]]) -> dict[str, dict[str, Any]]:
+        raise RuntimeError('prediction failed')
+
+    monkeypatch.setattr(pipeline, 'letters_prediction', fail)
+    with pytest.raises(ExceptionGroup):
+        asyncio.run(run_pipeline(Credentials('token')))
+    assert utils.storage.get_history_id('account') == '20'
+
+    monkeypatch.setattr(pipeline, 'letters_prediction', fake_prediction)
+    assert asyncio.run(run_pipeline(Credentials('token')))[0] == 5
+    assert utils.storage.get_history_id('account') == '25'
+    # the event of the letter seen by the first cycle is not inserted again
+    assert len(inserts(calendar_service)) == 1
+
+
+def test_run_pipeline_keeps_cursor_after_calendar_failures(
+        services: tuple[FakeGmailService, FakeCalendarService]) -> None:
+    _, calendar_service = services
+    utils.storage.save_history_id('account', '20')
+
+    calendar_service.failures = {'id20': [400]}
+    letters, log = asyncio.run(run_pipeline(Credentials('token')))
+    assert (letters, log.count('Event created')) == (5, 0)
+    assert utils.storage.get_history_id('account') == '20'
+
+    letters, log = asyncio.run(run_pipeline(Credentials('token')))
+    assert (letters, log.count('Event created')) == (5, 1)
+    assert utils.storage.get_history_id('account') == '25'
@@ -0,0 +1,49 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+from model.prefilter import is_candidate, prefilter_report, prefilter_score
+
+TEST_FILES = Path(__file__).parent.parent.joinpath('test_files')
+
+
+@dataclass
+class PrefilterCase:
+    body: str
+    subject: str
+    expected: bool
+
+
+PREFILTER_TEST_CASES = [
+    PrefilterCase(body="Let's meet tomorrow at 5 pm", subject='Hello', expected=True),
+    PrefilterCase(body='The call starts at 17:30', subject='', expected=True),
+    PrefilterCase(body="See you at five o'clock", subject='Drinks', expected=True),
+    PrefilterCase(body='Встречаемся в 10 утра', subject='', expected=True),
+    PrefilterCase(body='Join us in Zoom, please confirm if you are available', subject='Meeting invitation',
+                  expected=True),
+    PrefilterCase(body='Our spring sale has started', subject='Sale', expected=False),
+    PrefilterCase(body='Please discuss the plan with your team', subject='Quarterly report', expected=False),
+]
+
+
+@pytest.mark.parametrize('test_case', PREFILTER_TEST_CASES)
+def test_is_candidate(test_case: PrefilterCase) -> None:
+    letter = {'body': test_case.body, 'subject': test_case.subject}
+    assert is_candidate(letter) == test_case.expected
+
+
+def test_zero_threshold_passes_everything() -> None:
+    assert prefilter_score({'body': 'Our spring sale has started', 'subject': 'Sale'}) == 0
+    assert is_candidate({'body': 'Our spring sale has started', 'subject': 'Sale'}, threshold=0)
+
+
+def test_prefilter_report() -> None:
+    letters = {path.stem: json.loads(path.read_text()) for path in TEST_FILES.glob('*.json')}
+    report = prefilter_report(letters, {'mail': {}, 'no_meeting': {}}, threshold=0.5)
+    assert report.letters == len(letters)
+    assert report.passed == 4
+    assert report.meetings == 2
+    assert report.recall == 0.5
+    assert prefilter_report(letters, {'mail': {}}, threshold=0).pass_rate == 1.0
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from scheduler import Scheduler
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_schedule_deduplicates_accounts() -> None:
+    scheduler = Scheduler(max_workers=2, period=0.05)
+    try:
+        assert scheduler.schedule('account', lambda: 0)
+        assert not scheduler.schedule('account', lambda: 0)
+        assert [job.key for job in scheduler.jobs()] == ['account']
+    finally:
+        scheduler.shutdown()
+
+
+def test_interval_adapts_to_mail_rate() -> None:
+    scheduler = Scheduler(max_workers=2, period=0.04, min_period=0.01, max_period=0.1, jitter=0)
+    try:
+        scheduler.schedule('busy', lambda: 3)
+        scheduler.schedule('idle', lambda: 0)
+        jobs = {job.key: job for job in scheduler.jobs()}
+        assert wait_for(lambda: jobs['busy'].runs >= 3 and jobs['idle'].runs >= 3)
+        assert jobs['busy'].interval == 0.01
+        assert jobs['idle'].interval > 0.04
+    finally:
+        scheduler.shutdown()
+
+
+def test_jobs_never_overlap_and_respect_pool_size() -> None:
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def slow_job() -> int:
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+        return 0
+
+    scheduler = Scheduler(max_workers=2, period=0.01, jitter=0)
+    try:
+        for i in range(4):
+            scheduler.schedule(f'account{i}', slow_job)
+        assert wait_for(lambda: all(job.runs >= 2 for job in scheduler.jobs()))
+        assert running['max'] == 2
+    finally:
+        scheduler.shutdown()
+
+
+def test_cancel_waits_for_running_cycle() -> None:
+    started, release = threading.Event(), threading.Event()
+    runs: list[str] = []
+
+    def old_job() -> int:
+        runs.append('old')
+        started.set()
+        release.wait()
+        return 0
+
+    scheduler = Scheduler(max_workers=2, period=0.01, jitter=0)
+    try:
+        scheduler.schedule('account', old_job)
+        assert started.wait(5)
+        assert scheduler.cancel('account')
+        assert not scheduler.cancel('account')
+        assert scheduler.jobs() == []
+        # the new job of the same account never runs alongside the cancelled cycle
+        assert scheduler.schedule('account', lambda: runs.append('new') or 0)
+        time.sleep(0.05)
+        assert runs == ['old']
+        release.set()
+        assert wait_for(lambda: 'new' in runs)
+        assert [job.key for job in scheduler.jobs()] == ['account']
+    finally:
+        scheduler.shutdown()
+
+
+def test_cancel_idle_job() -> None:
+    scheduler = Scheduler(max_workers=1, period=10)
+    try:
+        scheduler.schedule('account', lambda: 0)
+        assert scheduler.cancel('account')
+        assert scheduler.jobs() == []
+        assert not scheduler.cancel('other')
+    finally:
+        scheduler.shutdown()
@@ -0,0 +1,52 @@
+from dataclasses import dataclass
+
+import pytest
+
+pytest.importorskip('spacy')
+
+from model.training_data import iob_to_spans, list_shards, read_examples, shard_order, write_shards
+
+
+@dataclass
+class IobCase:
+    tags: list[str]
+    expected: list[tuple[int, int, str]]
+
+
+IOB_TEST_CASES = [
+    IobCase(tags=['O', 'O'], expected=[]),
+    IobCase(tags=['B-PERSON', 'I-PERSON', 'O', 'B-DATE'], expected=[(0, 2, 'PERSON'), (3, 4, 'DATE')]),
+    IobCase(tags=['B-TIME', 'B-TIME'], expected=[(0, 1, 'TIME'), (1, 2, 'TIME')]),
+    IobCase(tags=['I-ORG', 'I-GPE'], expected=[(0, 1, 'ORG'), (1, 2, 'GPE')]),
+]
+
+
+@pytest.mark.parametrize('test_case', IOB_TEST_CASES)
+def test_iob_to_spans(test_case: IobCase) -> None:
+    assert iob_to_spans(test_case.tags) == test_case.expected
+
+
+SENTENCES = [(['Meet', 'at', '5', 'pm', str(i)], ['O', 'O', 'B-TIME', 'I-TIME', 'O']) for i in range(7)]
+
+
+def test_write_and_read_shards(tmp_path) -> None:
+    import spacy
+
+    shards = write_shards(tmp_path, iter(SENTENCES), shard_size=3, workers=2)
+    assert [shard.name for shard in shards] == ['shard-00000.spacy', 'shard-00001.spacy', 'shard-00002.spacy']
+
+    nlp = spacy.blank('en')
+    examples = [example for shard in shard_order(shards, seed=0, epoch=0)
+                for example in read_examples(nlp, shard, seed=0, epoch=0)]
+    assert sorted(example.reference.text.strip() for example in examples) == sorted(' '.join(words) for words, _ in SENTENCES)
+    assert all([ent.text for ent in example.reference.ents] == ['5 pm'] for example in examples)
+    assert [example.reference.text for example in read_examples(nlp, shards[0], seed=0, epoch=0)] == \
+        [example.reference.text for example in read_examples(nlp, shards[0], seed=0, epoch=0)]
+
+
+def test_write_shards_keeps_existing(tmp_path) -> None:
+    write_shards(tmp_path, iter(SENTENCES[:3]), shard_size=3, workers=1)
+    first_shard = list_shards(tmp_path)[0]
+    modified = first_shard.stat().st_mtime_ns
+    assert len(write_shards(tmp_path, iter(SENTENCES), shard_size=3, workers=1)) == 3
+    assert first_shard.stat().st_mtime_ns == modified
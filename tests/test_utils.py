@@ -1,12 +1,330 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
 import pytest
+import requests
+import utils.api_utils
+import utils.credential_store
+import utils.storage
 
-from utils.api_utils import create_service, AppType
+from utils.credential_store import CredentialStore
+from utils.api_utils import InstrumentedHttpRequest, account_key, create_service, service_cache_info, AppType
+from utils.metrics import API_CALLS, API_ERRORS, Counter, Histogram, render_metrics
+from utils.transport import PooledHttp, QuotaLimiter, TokenBucket, request_cost
+import utils.transport
+from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+
+@pytest.fixture(scope='function')
+def email_addresses(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    lookups = []
+
+    def get_email_address(credentials: Credentials) -> str:
+        lookups.append(credentials.token)
+        return f'{credentials.token}@example.com'
+
+    monkeypatch.setattr(utils.api_utils, 'get_email_address', get_email_address)
+    return lookups
 
 
-def test_create_service() -> None:
+def test_account_key_is_stable(email_addresses: list[str]) -> None:
+    creds = Credentials('token', refresh_token='refresh')
+    assert account_key(creds) == account_key(creds)
+    assert email_addresses == ['token']
+    # an account authorized again gets a new refresh token but keeps its key
+    assert account_key(Credentials('token', refresh_token='other')) == account_key(creds)
+    assert account_key(Credentials('other')) != account_key(creds)
+
+
+def test_create_service(email_addresses: list[str]) -> None:
     creds = Credentials('something')
     for app in (AppType.GMAIL, AppType.CALENDAR):
         assert create_service(creds, app=app) is not None
 
     assert create_service(creds, app='test_app') is None
+
+
+def test_create_service_cached_per_thread(email_addresses: list[str]) -> None:
+    creds = Credentials('cached')
+    service = create_service(creds, app=AppType.GMAIL)
+    hits = service_cache_info()['hits']
+    assert create_service(creds, app=AppType.GMAIL) is service
+    assert service_cache_info()['hits'] == hits + 1
+    assert create_service(Credentials('other'), app=AppType.GMAIL) is not service
+
+    other_thread_services = []
+    thread = threading.Thread(target=lambda: other_thread_services.append(create_service(creds, app=AppType.GMAIL)))
+    thread.start()
+    thread.join()
+    assert other_thread_services[0] is not service
+
+
+def test_create_service_cache_is_bounded(email_addresses: list[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(utils.api_utils, 'SERVICE_CACHE_SIZE', 2)
+    monkeypatch.setattr(utils.api_utils, '_services', threading.local())
+    first, second, third = Credentials('first'), Credentials('second'), Credentials('third')
+    service = create_service(first, app=AppType.GMAIL)
+    create_service(second, app=AppType.GMAIL)
+    assert create_service(first, app=AppType.GMAIL) is service
+    evictions = service_cache_info()['evictions']
+    create_service(third, app=AppType.GMAIL)
+    assert service_cache_info()['evictions'] == evictions + 1
+    # the least recently used service was dropped
+    assert create_service(first, app=AppType.GMAIL) is service
+    assert len(utils.api_utils._services.cache) == 2
+
+    # credentials saved again for the same account replace its service
+    refreshed = Credentials('first')
+    assert create_service(refreshed, app=AppType.GMAIL) is not service
+    assert create_service(refreshed, app=AppType.GMAIL) is create_service(refreshed, app=AppType.GMAIL)
+
+
+def test_prediction_cache_eviction_and_purge(state_db: None) -> None:
+    utils.storage.save_cached_predictions({'a': 'null', 'b': '{}'}, 'v1', max_entries=3)
+    assert utils.storage.get_cached_predictions(['a']) == {'a': 'null'}
+    utils.storage.save_cached_predictions({'c': 'null', 'd': 'null'}, 'v1', max_entries=3)
+    assert set(utils.storage.get_cached_predictions(['a', 'b', 'c', 'd'])) == {'a', 'c', 'd'}
+
+    utils.storage.save_cached_predictions({'e': 'null'}, 'v2', max_entries=3)
+    utils.storage.purge_cached_predictions('v2')
+    assert set(utils.storage.get_cached_predictions(['a', 'b', 'c', 'd', 'e'])) == {'e'}
+
+    utils.storage.save_cached_predictions({'f': 'null'}, 'en:v1', max_entries=3)
+    utils.storage.save_cached_predictions({'g': 'null'}, 'ru:v1', max_entries=3)
+    utils.storage.purge_cached_predictions('ru:v2', scope='ru:')
+    assert set(utils.storage.get_cached_predictions(['e', 'f', 'g'])) == {'e', 'f'}
+
+
+def test_metrics_render() -> None:
+    counter = Counter('test_letters_total', 'Test letters.', ('kind',))
+    histogram = Histogram('test_latency_seconds', 'Test latency.', buckets=(0.1, 1.0))
+
+    threads = [threading.Thread(target=lambda: [counter.inc(kind='a') for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(2, kind='b')
+    counter.inc(kind='say "hi"\\\n')
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+
+    lines = render_metrics().splitlines()
+    assert '# TYPE test_letters_total counter' in lines
+    assert 'test_letters_total{kind="a"} 4000' in lines
+    assert 'test_letters_total{kind="b"} 2' in lines
+    assert 'test_letters_total{kind="say \\"hi\\"\\\\\\n"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_sum 5.55' in lines
+    assert 'test_latency_seconds_count 3' in lines
+
+
+def test_instrumented_request_counts_calls_and_errors() -> None:
+    method = 'gmail.users.test'
+    http = HttpMockSequence([({'status': '200'}, '{}'), ({'status': '500'}, '')])
+
+    def request() -> InstrumentedHttpRequest:
+        return InstrumentedHttpRequest(http, lambda response, content: content, 'https://example.com', methodId=method)
+
+    request().execute()
+    with pytest.raises(HttpError):
+        request().execute()
+    assert API_CALLS.value(api='gmail', method=method) == 2
+    assert API_ERRORS.value(api='gmail', method=method, status=500) == 1
+
+
+def test_token_bucket(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(utils.transport.time, 'sleep', lambda seconds: None)
+    bucket = TokenBucket(rate=1000)
+    assert bucket.acquire(1000) == 0
+    assert bucket.acquire(50) == pytest.approx(0.05, abs=0.01)
+    # larger than the capacity, charged in full
+    assert bucket.acquire(5000) == pytest.approx(5.05, abs=0.01)
+    assert bucket.acquire(1) == pytest.approx(5.05, abs=0.01)
+
+
+BATCH_BODY = (b'--boundary\r\nContent-Type: application/http\r\n\r\n'
+              b'GET /gmail/v1/users/me/messages/a?format=raw&alt=json HTTP/1.1\r\n\r\n'
+              b'--boundary\r\nContent-Type: application/http\r\n\r\n'
+              b'GET /gmail/v1/users/me/messages/b?format=raw&alt=json HTTP/1.1\r\n\r\n--boundary--')
+
+
+@pytest.mark.parametrize('method, uri, body, expected', [
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/messages/a?format=raw', None, ('gmail', 5, True)),
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/history?startHistoryId=1', None, ('gmail', 2, True)),
+    ('POST', 'https://gmail.googleapis.com/batch', BATCH_BODY, ('gmail', 10, True)),
+    ('POST', 'https://www.googleapis.com/batch/calendar/v3', b'', (None, 0, False)),
+    ('POST', 'https://www.googleapis.com/calendar/v3/calendars/primary/events', '{}', ('calendar', 1, False)),
+    ('POST', 'https://oauth2.googleapis.com/token', 'grant_type=refresh_token', (None, 0, False)),
+])
+def test_request_cost(method: str, uri: str, body: bytes | str | None, expected: tuple) -> None:
+    assert request_cost(method, uri, body) == expected
+
+
+class FakeResponse:
+    def __init__(self, status_code: int) -> None:
+        self.status_code = status_code
+        self.reason = 'reason'
+        self.headers = {'Content-Type': 'application/json', 'Retry-After': '0'}
+        self.content = b'{}'
+
+
+class FakeSession:
+    def __init__(self, statuses: list[int | Exception]) -> None:
+        self.statuses = statuses
+        self.calls = 0
+
+    def request(self, method: str, uri: str, **kwargs) -> FakeResponse:
+        self.calls += 1
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        return FakeResponse(status)
+
+
+@pytest.mark.parametrize('method, uri, statuses, expected_status, expected_calls', [
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/profile', [429, 503, 200], 200, 3),
+    ('POST', 'https://www.googleapis.com/calendar/v3/calendars/primary/events', [503], 503, 1),
+    ('POST', 'https://www.googleapis.com/calendar/v3/calendars/primary/events', [429, 200], 200, 2),
+    ('GET', 'https://gmail.googleapis.com/gmail/v1/users/me/profile', [500, 500, 500], 500, 3),
+])
+def test_pooled_http_retries(monkeypatch: pytest.MonkeyPatch, method: str, uri: str, statuses: list[int],
+                             expected_status: int, expected_calls: int) -> None:
+    session = FakeSession(statuses)
+    monkeypatch.setattr(utils.transport, 'get_session', lambda: session)
+    monkeypatch.setattr(utils.transport.time, 'sleep', lambda seconds: None)
+    limiter = QuotaLimiter({'gmail': 1000, 'calendar': 1000}, {})
+
+    response, content = PooledHttp('account', limiter=limiter, max_retries=2).request(uri, method)
+    assert response.status == expected_status
+    assert response['content-type'] == 'application/json'
+    assert session.calls == expected_calls
+
+
+REFUSED = requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused')))
+EVENTS_URI = 'https://www.googleapis.com/calendar/v3/calendars/primary/events'
+
+
+@pytest.mark.parametrize('method, statuses, expected_calls', [
+    ('GET', [requests.ReadTimeout(), requests.ConnectionError('Connection reset'), 200], 3),
+    ('POST', [requests.ConnectTimeout(), REFUSED, 200], 3),
+    ('POST', [requests.ReadTimeout()], 1),
+    ('POST', [requests.ConnectionError('Connection reset')], 1),
+])
+def test_pooled_http_retries_connection_errors(monkeypatch: pytest.MonkeyPatch, method: str,
+                                               statuses: list[int | Exception], expected_calls: int) -> None:
+    # a call that changes data is only sent again if it never reached the server
+    session = FakeSession(statuses)
+    monkeypatch.setattr(utils.transport, 'get_session', lambda: session)
+    monkeypatch.setattr(utils.transport.time, 'sleep', lambda seconds: None)
+    limiter = QuotaLimiter({'calendar': 1000}, {})
+
+    http = PooledHttp('account', limiter=limiter, max_retries=2)
+    if statuses[-1] == 200:
+        assert http.request(EVENTS_URI, method)[0].status == 200
+    else:
+        with pytest.raises(requests.RequestException):
+            http.request(EVENTS_URI, method)
+    assert session.calls == expected_calls
+
+
+def make_credentials(token: str, expires_in: float) -> Credentials:
+    return Credentials(token, refresh_token='refresh', client_id='client', client_secret='secret',
+                       token_uri='https://oauth2.googleapis.com/token',
+                       expiry=datetime.utcnow() + timedelta(seconds=expires_in))
+
+
+def test_open_db_creates_schema_once(state_db: None, monkeypatch) -> None:
+    statements: list[str] = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs) -> sqlite3.Connection:
+        connection = connect(*args, **kwargs)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    monkeypatch.setattr(utils.storage.sqlite3, 'connect', traced_connect)
+    utils.storage.save_history_id('account', '1')
+    assert utils.storage.get_history_id('account') == '1'
+    assert sum(statement.startswith('PRAGMA journal_mode') for statement in statements) == 1
+    assert sum(statement.lstrip().startswith('CREATE TABLE') for statement in statements) == 6
+
+
+def test_refresh_lease_is_exclusive(state_db: None) -> None:
+    assert utils.storage.acquire_refresh_lease('account', 'a', 30)
+    assert utils.storage.acquire_refresh_lease('account', 'a', 30)
+    assert not utils.storage.acquire_refresh_lease('account', 'b', 30)
+    utils.storage.release_refresh_lease('account', 'a')
+    assert utils.storage.acquire_refresh_lease('account', 'b', 30)
+    assert utils.storage.acquire_refresh_lease('other', 'a', -1)
+    assert utils.storage.acquire_refresh_lease('other', 'b', 30)
+
+
+def test_credential_store_refreshes_once(state_db: None, monkeypatch, email_addresses: list[str]) -> None:
+    refreshes = []
+
+    def refresh(credentials: Credentials, request) -> None:
+        refreshes.append(credentials.token)
+        time.sleep(0.05)
+        credentials.token = f'token-{len(refreshes)}'
+        credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+    first, second = CredentialStore(), CredentialStore()
+    account = first.save(make_credentials('token-0', 60))
+    credentials = first.get(account)
+
+    threads = [threading.Thread(target=store.refresh, args=(account,)) for store in (first, first, second, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert refreshes == ['token-0']
+    assert credentials.token == 'token-1'
+    assert second.get(account).token == 'token-1'
+    # an older token saved later does not replace the refreshed one
+    second.save(make_credentials('token-0', 60))
+    assert CredentialStore().get(account).token == 'token-1'
+    assert utils.storage.list_expiring_credentials(time.time() + 300) == []
+
+
+def test_credential_store_rechecks_token_after_lease(state_db: None, monkeypatch, email_addresses: list[str]) -> None:
+    monkeypatch.setattr(Credentials, 'refresh', lambda credentials, request: pytest.fail('refreshed twice'))
+    store = CredentialStore()
+    account = store.save(make_credentials('token-0', 60))
+
+    def acquire_refresh_lease(account: str, owner: str, duration: float) -> bool:
+        # another process refreshes the token and releases its lease just before this one takes it
+        refreshed = make_credentials('token-1', 3600)
+        utils.storage.save_credentials(account, refreshed.to_json(), time.time() + 3600)
+        return utils.storage.acquire_refresh_lease(account, owner, duration)
+
+    monkeypatch.setattr(utils.credential_store, 'acquire_refresh_lease', acquire_refresh_lease)
+    store.refresh(account)
+    assert store.get(account).token == 'token-1'
+
+
+def test_credential_store_removes_revoked_credentials(state_db: None, monkeypatch, email_addresses: list[str]) -> None:
+    errors = [RefreshError('temporarily unavailable', retryable=True), RefreshError('invalid_grant')]
+
+    def refresh(credentials: Credentials, request) -> None:
+        raise errors.pop(0)
+
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+    store = CredentialStore()
+    account = store.save(make_credentials('token-0', 60))
+    store.refresh(account)
+    assert store.get(account) is not None
+    store.refresh(account)
+    assert store.get(account) is None
+    assert utils.storage.load_credentials(account) is None
+    assert errors == []
@@ -1,24 +1,106 @@
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from enum import Enum
 
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build, Resource
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 from typing import Any
 
+from utils.metrics import record_api_call
+from utils.transport import HTTP_MAX_RETRIES, PooledHttp
+
 
 class AppType(Enum):
     GMAIL = 'gmail'
     CALENDAR = 'calendar'
 
 
+API_VERSIONS = {
+    AppType.GMAIL: 'v1',
+    AppType.CALENDAR: 'v3',
+}
+
+SERVICE_CACHE_SIZE = int(os.getenv('SERVICE_CACHE_SIZE', 32))  # services kept by each thread
+
+# httplib2 connections are not thread-safe, so every thread keeps its own services
+_services = threading.local()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'build_seconds': 0.0}
+_cache_stats_lock = threading.Lock()
+# the address of a Credentials object never changes, so it is looked up once
+_account_keys: weakref.WeakKeyDictionary[Credentials, str] = weakref.WeakKeyDictionary()
+_account_keys_lock = threading.Lock()
+
+
+class InstrumentedHttpRequest(HttpRequest):  # type: ignore[misc]  # googleapiclient ships no type hints
+    """
+    Counts every executed API call and its HTTP errors in the metrics.
+    """
+
+    def execute(self, *args: Any, **kwargs: Any) -> Any:
+        method_id = self.methodId or 'unknown'
+        try:
+            response = super().execute(*args, **kwargs)
+        except HttpError as error:
+            record_api_call(method_id, error.resp.status)
+            raise
+        record_api_call(method_id)
+        return response
+
+
 def create_service(credentials: Credentials, *, app: AppType) -> Resource | None:
-    match app:
-        case AppType.GMAIL:
-            return build('gmail', 'v1', credentials=credentials)
-        case AppType.CALENDAR:
-            return build("calendar", "v3", credentials=credentials)
-        case _:
-            return None
+    """
+    Returns a service for the account of `credentials`, building it only on the first call in the current thread.
+
+    Each thread keeps the SERVICE_CACHE_SIZE most recently used services, and a service is built again when the
+    account's Credentials object is replaced.
+
+    Services are built from the discovery documents bundled with googleapiclient, so no discovery request is made.
+    Their requests go through the shared connection pool, quota limiter and retries of utils.transport.
+    """
+    if app not in API_VERSIONS:
+        return None
+
+    services = getattr(_services, 'cache', None)
+    if services is None:
+        services = _services.cache = OrderedDict()
+    account = account_key(credentials)
+    key = (app, account)
+
+    # a service sends the token of the Credentials object it was built with, so new credentials need a new service
+    cached = services.get(key)
+    if cached is not None and cached[0] is credentials:
+        services.move_to_end(key)
+        with _cache_stats_lock:
+            _cache_stats['hits'] += 1
+        return cached[1]
+
+    start_time = time.perf_counter()
+    http = AuthorizedHttp(credentials, http=PooledHttp(account))
+    service = build(app.value, API_VERSIONS[app], http=http, static_discovery=True, cache_discovery=False,
+                    requestBuilder=InstrumentedHttpRequest)
+    services[key] = (credentials, service)
+    services.move_to_end(key)
+    evicted = len(services) > SERVICE_CACHE_SIZE
+    if evicted:
+        services.popitem(last=False)
+    with _cache_stats_lock:
+        _cache_stats['misses'] += 1
+        _cache_stats['evictions'] += evicted
+        _cache_stats['build_seconds'] += time.perf_counter() - start_time
+    return service
+
+
+def service_cache_info() -> dict[str, float]:
+    with _cache_stats_lock:
+        return dict(_cache_stats)
 
 
 def credentials_to_dict(credentials: Credentials) -> dict[str, Any]:
@@ -30,3 +112,25 @@ def credentials_to_dict(credentials: Credentials) -> dict[str, Any]:
         "client_secret": credentials.client_secret,
         "scopes": credentials.scopes,
     }
+
+
+def get_email_address(credentials: Credentials) -> str:
+    service = build('gmail', API_VERSIONS[AppType.GMAIL], credentials=credentials, static_discovery=True,
+                    cache_discovery=False, requestBuilder=InstrumentedHttpRequest)
+    return str(service.users().getProfile(userId='me').execute(num_retries=HTTP_MAX_RETRIES)['emailAddress'])
+
+
+def account_key(credentials: Credentials) -> str:
+    """
+    Returns the key of the Gmail account of `credentials`, derived from its address.
+
+    Unlike the tokens, the address stays the same when the account is authorized again, so the account keeps its
+    stored credentials, history cursor, services and scheduled job.
+    """
+    with _account_keys_lock:
+        account = _account_keys.get(credentials)
+    if account is None:
+        account = hashlib.sha256(get_email_address(credentials).lower().encode()).hexdigest()[:16]
+        with _account_keys_lock:
+            _account_keys[credentials] = account
+    return account
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timezone
+
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from utils.api_utils import account_key
+from utils.storage import (acquire_refresh_lease, delete_credentials, list_expiring_credentials, load_credentials,
+                           release_refresh_lease, save_credentials)
+
+REFRESH_MARGIN = int(os.getenv('CREDENTIALS_REFRESH_MARGIN', 5 * 60))  # seconds before expiry
+REFRESH_INTERVAL = int(os.getenv('CREDENTIALS_REFRESH_INTERVAL', 60))  # seconds between background checks
+REFRESH_LEASE = 30  # seconds a process may hold the right to refresh one account
+INLINE_REFRESH_MARGIN = 10  # seconds; a token this close to expiry is refreshed on the spot
+
+logger = logging.getLogger(__name__)
+
+
+def _expiry_timestamp(credentials: Credentials) -> float:
+    # google-auth keeps the expiry as a naive UTC datetime; a token without one never expires
+    if credentials.expiry is None:
+        return float('inf') if credentials.token else 0.0
+    return credentials.expiry.replace(tzinfo=timezone.utc).timestamp()
+
+
+class CredentialStore:
+    """
+    Keeps OAuth credentials in the state database and refreshes access tokens before they expire.
+
+    Each process holds one Credentials object per account and updates it in place, so services built from it
+    always send the latest token. A background thread refreshes tokens that expire within `refresh_margin`
+    seconds; a per-account lock within the process and a lease in the database across processes make sure a token
+    is refreshed only once, and the other processes pick the new token up from the database.
+    """
+
+    def __init__(self, refresh_margin: float = REFRESH_MARGIN, refresh_interval: float = REFRESH_INTERVAL) -> None:
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.owner = uuid.uuid4().hex
+        self._credentials: dict[str, Credentials] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def save(self, credentials: Credentials) -> str:
+        """
+        Adds or updates the credentials of an account and returns its key; a stored token that expires later
+        is kept.
+        """
+        account = account_key(credentials)
+        save_credentials(account, credentials.to_json(), _expiry_timestamp(credentials))
+        self._sync(account)
+        return account
+
+    def get(self, account: str) -> Credentials | None:
+        """
+        Returns the credentials of the account, or None if it is unknown.
+
+        The background refresh keeps the token valid, so the token is only refreshed here if it is about to expire
+        and the background thread has not caught it.
+        """
+        credentials = self._sync(account)
+        if credentials is not None and _expiry_timestamp(credentials) < time.time() + INLINE_REFRESH_MARGIN:
+            self.refresh(account, INLINE_REFRESH_MARGIN)
+            credentials = self._sync(account)
+        return credentials
+
+    def refresh(self, account: str, margin: float | None = None) -> None:
+        """
+        Refreshes the token of the account unless it stays valid for `margin` seconds or another refresh is running.
+
+        Waits for a refresh running in another thread or process and uses its token. Credentials whose grant was
+        revoked are removed, so the account has to be authorized again.
+        """
+        margin = self.refresh_margin if margin is None else margin
+        with self._account_lock(account):
+            deadline = time.time() + REFRESH_LEASE
+            while True:
+                credentials = self._sync(account)
+                if credentials is None or _expiry_timestamp(credentials) >= time.time() + margin:
+                    return
+                if acquire_refresh_lease(account, self.owner, REFRESH_LEASE):
+                    break
+                if time.time() > deadline:
+                    logger.warning("Gave up waiting for another process to refresh account %s", account)
+                    return
+                time.sleep(0.5)
+
+            try:
+                # another process may have refreshed the token and released its lease after the check above
+                credentials = self._sync(account)
+                if credentials is None or _expiry_timestamp(credentials) >= time.time() + margin:
+                    return
+                credentials.refresh(Request())
+                save_credentials(account, credentials.to_json(), _expiry_timestamp(credentials))
+                logger.info("Refreshed the token of account %s", account)
+            except RefreshError as error:
+                if error.retryable:
+                    logger.warning("Could not refresh the token of account %s, will retry: %s", account, error)
+                    return
+                logger.warning("Removing the credentials of account %s, its token cannot be refreshed: %s", account,
+                               error)
+                delete_credentials(account, time.time() + margin)
+                with self._lock:
+                    self._credentials.pop(account, None)
+            finally:
+                release_refresh_lease(account, self.owner)
+
+    def refresh_expiring(self) -> None:
+        for account in list_expiring_credentials(time.time() + self.refresh_margin):
+            self.refresh(account)
+
+    def start(self) -> None:
+        """
+        Starts the background refresh thread.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='credential-refresh', daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.refresh_expiring()
+            except Exception:
+                logger.exception("Background credential refresh failed")
+            self._stopped.wait(self.refresh_interval)
+
+    def _account_lock(self, account: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(account, threading.Lock())
+
+    def _sync(self, account: str) -> Credentials | None:
+        """
+        Updates the account's Credentials object from the database if another process stored a newer token.
+        """
+        data = load_credentials(account)
+        if data is None:
+            return None
+        stored = Credentials.from_authorized_user_info(json.loads(data))
+        with self._lock:
+            credentials = self._credentials.get(account)
+            if credentials is None:
+                credentials = self._credentials[account] = stored
+            elif _expiry_timestamp(stored) > _expiry_timestamp(credentials):
+                credentials.token = stored.token
+                credentials.expiry = stored.expiry
+            return credentials
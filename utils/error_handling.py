@@ -1,11 +1,14 @@
+import logging
 from contextlib import contextmanager
 
 from googleapiclient.errors import HttpError
 
+logger = logging.getLogger(__name__)
+
 
 @contextmanager
 def http_error_catcher() -> None:
     try:
         yield
     except HttpError as error:
-        print(f"An error occurred: {error}")
+        logger.error("An error occurred: %s", error)
@@ -0,0 +1,137 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+
+_metrics: list['Counter | Histogram'] = []
+
+LabelValues = tuple[str, ...]
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """
+    A monotonically increasing count, one series per combination of label values.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, one series per combination of label values.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[LabelValues, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            series = self._series.get(tuple(str(labels[name]) for name in self.labels))
+            return sum(series[0]) if series else 0
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, float('inf')), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total[0]}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+def render_metrics() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    return '\n'.join(line for metric in _metrics for line in metric.render()) + '\n'
+
+
+def record_api_call(method_id: str, status: int | None = None) -> None:
+    """
+    Counts a Google API call, and an error if it ended with an HTTP error `status`.
+    """
+    api = method_id.split('.', 1)[0]
+    API_CALLS.inc(api=api, method=method_id)
+    if status is not None:
+        API_ERRORS.inc(api=api, method=method_id, status=str(status))
+
+
+EMAILS_FETCHED = Counter('emails_fetched_total', 'Letters downloaded and parsed from Gmail.')
+EMAILS_PREDICTED = Counter('emails_predicted_total', 'Letters passed through the prediction.')
+EMAILS_SKIPPED = Counter('emails_skipped_total', 'Predicted letters without a meeting.')
+EMAILS_PREFILTERED = Counter('emails_prefiltered_total', 'Letters rejected by the pre-filter before the model.')
+CALENDAR_EVENTS = Counter('calendar_events_total', 'Calendar events by action: inserted, patched or unchanged.',
+                          ('action',))
+API_CALLS = Counter('api_calls_total', 'Google API calls.', ('api', 'method'))
+API_ERRORS = Counter('api_errors_total', 'Google API calls that failed with an HTTP error.', ('api', 'method', 'status'))
+API_RETRIES = Counter('api_retries_total', 'Google API requests repeated after a rate limit, 5xx or connection error.',
+                      ('api', 'status'))
+QUOTA_WAIT_SECONDS = Counter('quota_wait_seconds_total', 'Seconds spent waiting for API quota.', ('api',))
+STAGE_SECONDS = Histogram('stage_seconds', 'Latency of the script and its stages.', ('stage',))
+BACKFILL_MESSAGES = Counter('backfill_messages_total', 'Historical messages processed by the backfill.')
+EMAILS_BY_LANGUAGE = Counter('emails_by_language_total', 'Letters that passed the pre-filter, by detected language.',
+                             ('language',))
@@ -0,0 +1,238 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from typing import Iterator
+
+STATE_DB = os.getenv('STATE_DB', 'state/state.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS history_cursors (
+    account TEXT PRIMARY KEY,
+    history_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calendar_events (
+    calendar_id TEXT NOT NULL,
+    email_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    PRIMARY KEY (calendar_id, email_id)
+);
+CREATE TABLE IF NOT EXISTS prediction_cache (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    prediction TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prediction_cache_last_used ON prediction_cache (last_used);
+CREATE TABLE IF NOT EXISTS credentials (
+    account TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expiry REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refresh_leases (
+    account TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    account TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    page_token TEXT,
+    processed INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL,
+    PRIMARY KEY (account, scope)
+);
+'''
+SQLITE_MAX_VARIABLES = 500
+
+_initialized_dbs: set[str] = set()
+_initialized_lock = threading.Lock()
+
+
+@contextmanager
+def open_db() -> Iterator[sqlite3.Connection]:
+    """
+    Opens the local state database, commits on success and rolls back on error.
+
+    The schema is created and WAL mode, which the file keeps, is switched on by the first call of a process.
+    """
+    path = STATE_DB
+    with _initialized_lock:
+        if path not in _initialized_dbs:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with closing(sqlite3.connect(path, timeout=30)) as connection:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+            _initialized_dbs.add(path)
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def get_history_id(account: str) -> str | None:
+    with open_db() as connection:
+        row = connection.execute('SELECT history_id FROM history_cursors WHERE account = ?', (account,)).fetchone()
+    return row[0] if row else None
+
+
+def save_history_id(account: str, history_id: str) -> None:
+    with open_db() as connection:
+        connection.execute('INSERT OR REPLACE INTO history_cursors (account, history_id) VALUES (?, ?)',
+                           (account, history_id))
+
+
+def get_calendar_events(calendar_id: str, email_ids: list[str]) -> dict[str, tuple[str, str]]:
+    """
+    Looks up the events already created for the given emails.
+
+    Returns a mapping from email id to a (fingerprint, event id) pair.
+    """
+    events = {}
+    with open_db() as connection:
+        for start in range(0, len(email_ids), SQLITE_MAX_VARIABLES):
+            chunk = email_ids[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = connection.execute(f'SELECT email_id, fingerprint, event_id FROM calendar_events '
+                                      f'WHERE calendar_id = ? AND email_id IN ({placeholders})', (calendar_id, *chunk))
+            events.update({email_id: (fingerprint, event_id) for email_id, fingerprint, event_id in rows})
+    return events
+
+
+def save_calendar_event(calendar_id: str, email_id: str, fingerprint: str, event_id: str) -> None:
+    with open_db() as connection:
+        connection.execute('INSERT OR REPLACE INTO calendar_events (calendar_id, email_id, fingerprint, event_id) '
+                           'VALUES (?, ?, ?, ?)', (calendar_id, email_id, fingerprint, event_id))
+
+
+def save_calendar_events(calendar_id: str, events: list[tuple[str, str, str]]) -> None:
+    """
+    Records several (email id, fingerprint, event id) rows in one transaction.
+    """
+    with open_db() as connection:
+        connection.executemany('INSERT OR REPLACE INTO calendar_events (calendar_id, email_id, fingerprint, event_id) '
+                               'VALUES (?, ?, ?, ?)', [(calendar_id, *event) for event in events])
+
+
+def get_cached_predictions(keys: list[str]) -> dict[str, str]:
+    """
+    Returns the stored predictions for the given keys and marks them as recently used.
+    """
+    predictions: dict[str, str] = {}
+    now = time.time()
+    with open_db() as connection:
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = connection.execute(f'SELECT key, prediction FROM prediction_cache WHERE key IN ({placeholders})',
+                                      chunk)
+            predictions.update(rows)
+            connection.execute(f'UPDATE prediction_cache SET last_used = ? WHERE key IN ({placeholders})',
+                               (now, *chunk))
+    return predictions
+
+
+def save_cached_predictions(predictions: dict[str, str], version: str, max_entries: int) -> None:
+    """
+    Stores predictions and evicts the least recently used entries beyond `max_entries`.
+    """
+    now = time.time()
+    with open_db() as connection:
+        connection.executemany('INSERT OR REPLACE INTO prediction_cache (key, version, prediction, last_used) '
+                               'VALUES (?, ?, ?, ?)',
+                               [(key, version, prediction, now) for key, prediction in predictions.items()])
+        connection.execute('DELETE FROM prediction_cache WHERE key IN '
+                           '(SELECT key FROM prediction_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                           (max_entries,))
+
+
+def purge_cached_predictions(version: str, scope: str = '') -> None:
+    """
+    Drops the entries of versions other than `version` that start with `scope`, by default of every version.
+    """
+    with open_db() as connection:
+        connection.execute('DELETE FROM prediction_cache WHERE version != ? AND substr(version, 1, ?) = ?',
+                           (version, len(scope), scope))
+
+
+def load_credentials(account: str) -> str | None:
+    with open_db() as connection:
+        row = connection.execute('SELECT data FROM credentials WHERE account = ?', (account,)).fetchone()
+    return row[0] if row else None
+
+
+def save_credentials(account: str, data: str, expiry: float) -> bool:
+    """
+    Stores the credentials unless the stored ones expire later; returns whether they were stored.
+    """
+    with open_db() as connection:
+        cursor = connection.execute('INSERT INTO credentials (account, data, expiry) VALUES (?, ?, ?) '
+                                    'ON CONFLICT (account) DO UPDATE SET data = excluded.data, expiry = excluded.expiry '
+                                    'WHERE excluded.expiry >= credentials.expiry', (account, data, expiry))
+        return cursor.rowcount > 0
+
+
+def delete_credentials(account: str, before: float) -> None:
+    """
+    Removes the credentials of the account if they expire before `before`, so credentials stored meanwhile by a
+    new authorization are kept.
+    """
+    with open_db() as connection:
+        connection.execute('DELETE FROM credentials WHERE account = ? AND expiry < ?', (account, before))
+
+
+def list_expiring_credentials(before: float) -> list[str]:
+    with open_db() as connection:
+        rows = connection.execute('SELECT account FROM credentials WHERE expiry < ?', (before,))
+        return [account for account, in rows]
+
+
+def acquire_refresh_lease(account: str, owner: str, duration: float) -> bool:
+    """
+    Takes the right to refresh the account's token for `duration` seconds, unless another owner holds it.
+    """
+    now = time.time()
+    with open_db() as connection:
+        cursor = connection.execute('INSERT INTO refresh_leases (account, owner, expires_at) VALUES (?, ?, ?) '
+                                    'ON CONFLICT (account) DO UPDATE SET owner = excluded.owner, '
+                                    'expires_at = excluded.expires_at '
+                                    'WHERE refresh_leases.expires_at < ? OR refresh_leases.owner = excluded.owner',
+                                    (account, owner, now + duration, now))
+        return cursor.rowcount > 0
+
+
+def release_refresh_lease(account: str, owner: str) -> None:
+    with open_db() as connection:
+        connection.execute('DELETE FROM refresh_leases WHERE account = ? AND owner = ?', (account, owner))
+
+
+def get_backfill_checkpoint(account: str, scope: str) -> tuple[str | None, int, int, int, bool] | None:
+    """
+    Returns the next page token, processed messages, created events, estimated total and whether the backfill of
+    the scope is done, or None if it never started.
+    """
+    with open_db() as connection:
+        row = connection.execute('SELECT page_token, processed, events, total, done FROM backfill_checkpoints '
+                                 'WHERE account = ? AND scope = ?', (account, scope)).fetchone()
+    return (row[0], row[1], row[2], row[3], bool(row[4])) if row else None
+
+
+def save_backfill_checkpoint(account: str, scope: str, page_token: str | None, processed: int, events: int,
+                             total: int, done: bool) -> None:
+    with open_db() as connection:
+        connection.execute('INSERT OR REPLACE INTO backfill_checkpoints '
+                           '(account, scope, page_token, processed, events, total, done) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (account, scope, page_token, processed, events, total, done))
+
+
+def delete_backfill_checkpoint(account: str, scope: str) -> None:
+    with open_db() as connection:
+        connection.execute('DELETE FROM backfill_checkpoints WHERE account = ? AND scope = ?', (account, scope))
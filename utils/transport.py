@@ -0,0 +1,253 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any
+from urllib.parse import urlsplit
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from utils.metrics import API_RETRIES, QUOTA_WAIT_SECONDS
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))  # connections kept per host
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 60))  # seconds
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 5))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', 0.5))  # seconds
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 32))  # seconds
+
+# Quota units per second. Gmail allows 15,000 units per user and 1,200,000 per project a minute,
+# Calendar 600 queries per user and 10,000 per project a minute.
+USER_QUOTAS = {
+    'gmail': float(os.getenv('GMAIL_USER_QUOTA', 250)),
+    'calendar': float(os.getenv('CALENDAR_USER_QUOTA', 10)),
+}
+PROJECT_QUOTAS = {
+    'gmail': float(os.getenv('GMAIL_PROJECT_QUOTA', 20000)),
+    'calendar': float(os.getenv('CALENDAR_PROJECT_QUOTA', 166)),
+}
+# (api, HTTP method, path pattern, quota units); the first match wins, every other call of an API costs its default
+QUOTA_COSTS = [
+    ('gmail', 'GET', re.compile(r'/gmail/v1/users/[^/]+/messages/[^/?]+'), 5),
+    ('gmail', 'GET', re.compile(r'/gmail/v1/users/[^/]+/messages'), 5),
+    ('gmail', 'GET', re.compile(r'/gmail/v1/users/[^/]+/history'), 2),
+    ('gmail', 'GET', re.compile(r'/gmail/v1/users/[^/]+/profile'), 1),
+]
+DEFAULT_QUOTA_COSTS = {'gmail': 5, 'calendar': 1}
+API_PATH_REGEX = re.compile(r'/(gmail|calendar)/')
+BATCH_PART_REGEX = re.compile(rb'^(GET|POST|PUT|PATCH|DELETE) (/\S+) HTTP/1\.1', re.MULTILINE)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'PATCH'}
+
+logger = logging.getLogger(__name__)
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the process-wide session, whose connection pool is shared by every account and thread.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+        return _session
+
+
+class TokenBucket:
+    """
+    Hands out up to `rate` units a second, with bursts of up to `capacity` units.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units: float) -> float:
+        """
+        Takes `units` and blocks until the bucket has refilled enough to pay for them; returns the seconds waited.
+
+        Units that are not available yet put the bucket in debt, which later requests wait out as well, so a request
+        larger than the capacity is charged in full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= units
+            delay = max(-self._tokens / self.rate, 0.0)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class QuotaLimiter:
+    """
+    Keeps one token bucket per API and user and one per API for the whole project.
+    """
+
+    def __init__(self, user_quotas: dict[str, float], project_quotas: dict[str, float]) -> None:
+        self.user_quotas = user_quotas
+        self.project_quotas = project_quotas
+        self._buckets: dict[tuple[str, str | None], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, api: str, account: str | None, rate: float) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get((api, account))
+            if bucket is None:
+                bucket = self._buckets[(api, account)] = TokenBucket(rate)
+            return bucket
+
+    def acquire(self, api: str, account: str, units: float) -> float:
+        waited = 0.0
+        if api in self.user_quotas:
+            waited += self._bucket(api, account, self.user_quotas[api]).acquire(units)
+        if api in self.project_quotas:
+            waited += self._bucket(api, None, self.project_quotas[api]).acquire(units)
+        return waited
+
+
+QUOTA_LIMITER = QuotaLimiter(USER_QUOTAS, PROJECT_QUOTAS)
+
+
+def _call_cost(api: str, method: str, path: str) -> int:
+    for cost_api, cost_method, pattern, units in QUOTA_COSTS:
+        if cost_api == api and cost_method == method and pattern.match(path):
+            return units
+    return DEFAULT_QUOTA_COSTS.get(api, 1)
+
+
+def request_cost(method: str, uri: str, body: Any) -> tuple[str | None, int, bool]:
+    """
+    Returns the API of a request, its quota units and whether it is safe to repeat.
+
+    A batch request costs the sum of the calls inside it, and is safe to repeat if they all only read.
+    """
+    path = urlsplit(uri).path
+    if path == '/batch' or path.startswith('/batch/'):
+        if isinstance(body, str):
+            body = body.encode()
+        parts = [(part_method.decode(), urlsplit(part_path.decode()).path)
+                 for part_method, part_path in BATCH_PART_REGEX.findall(body or b'')]
+        # the Gmail batch endpoint is just /batch, so the API is taken from the calls inside
+        match = API_PATH_REGEX.match(parts[0][1]) if parts else None
+        if match is None:
+            return None, 0, False
+        api = match.group(1)
+        units = sum(_call_cost(api, part_method, part_path) for part_method, part_path in parts)
+        return api, units, all(part_method == 'GET' for part_method, _ in parts)
+
+    match = API_PATH_REGEX.match(path)
+    if match is None:
+        return None, 0, method in IDEMPOTENT_METHODS
+    return match.group(1), _call_cost(match.group(1), method, path), method in IDEMPOTENT_METHODS
+
+
+def is_retryable(status: int, content: bytes | str | None) -> bool:
+    if status in RETRY_STATUSES:
+        return True
+    if status == 403 and content:
+        content = content.encode() if isinstance(content, str) else content
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def failed_to_connect(error: requests.RequestException) -> bool:
+    """
+    Tells whether a request failed while connecting, before any of it reached the server.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+def backoff_delay(attempt: int, retry_after: str | None = None) -> float:
+    """
+    Exponential backoff with jitter, or the server's Retry-After if it asks for longer.
+    """
+    delay = random.uniform(0.5, 1) * min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+class PooledHttp:
+    """
+    An httplib2.Http replacement for googleapiclient that sends requests through the shared pooled session.
+
+    Calls to the Gmail and Calendar APIs first take their quota units from the limiter, and are retried with
+    backoff on 429, rate limit 403 and 5xx responses and on connection errors. Calls that change data are not
+    retried on 5xx responses or on errors after the connection was made, e.g. a read timeout, since the change may
+    have been applied.
+    """
+    follow_redirects = True
+    redirect_codes = frozenset({300, 301, 302, 303, 307})
+
+    def __init__(self, account: str, limiter: QuotaLimiter = QUOTA_LIMITER, max_retries: int = HTTP_MAX_RETRIES,
+                 timeout: float = HTTP_TIMEOUT) -> None:
+        self.account = account
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def request(self, uri: str, method: str = 'GET', body: Any = None, headers: dict[str, str] | None = None,
+                redirections: int = httplib2.DEFAULT_MAX_REDIRECTS, connection_type: Any = None,
+                **kwargs: Any) -> tuple[httplib2.Response, bytes]:
+        api, units, repeatable = request_cost(method, uri, body)
+        attempt = 0
+        while True:
+            if api is not None and units:
+                waited = self.limiter.acquire(api, self.account, units)
+                if waited:
+                    QUOTA_WAIT_SECONDS.inc(waited, api=api)
+
+            try:
+                response = get_session().request(method, uri, data=body, headers=headers, timeout=self.timeout,
+                                                 allow_redirects=self.follow_redirects)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt >= self.max_retries or not (repeatable or failed_to_connect(error)):
+                    raise
+                logger.warning("Retrying %s %s after %s", method, uri, error)
+                API_RETRIES.inc(api=api or 'other', status='connection')
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            status = response.status_code
+            retry = is_retryable(status, response.content) and (repeatable or status < 500)
+            if not retry or attempt >= self.max_retries:
+                return _to_httplib2_response(response), response.content
+            logger.warning("Retrying %s %s after HTTP %s", method, uri, status)
+            API_RETRIES.inc(api=api or 'other', status=str(status))
+            time.sleep(backoff_delay(attempt, response.headers.get('retry-after')))
+            attempt += 1
+
+    def close(self) -> None:
+        # the connections belong to the shared session
+        pass
+
+
+def _to_httplib2_response(response: requests.Response) -> httplib2.Response:
+    info = {name.lower(): value for name, value in response.headers.items()}
+    # requests has already decoded the body
+    info.pop('content-encoding', None)
+    info['status'] = str(response.status_code)
+    httplib2_response = httplib2.Response(info)
+    httplib2_response.reason = response.reason
+    return httplib2_response